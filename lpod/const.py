@@ -115,6 +115,14 @@ ODF_STYLES = 'styles.xml'
 ODF_MANIFEST = 'META-INF/manifest.xml'
 
 
+# Parts already compressed, stored in the Zip archive as they are
+ODF_COMPRESSED_MEDIA_TYPES = ('image/png', 'image/jpeg', 'image/gif',
+        'audio/mpeg', 'audio/ogg', 'video/mp4', 'video/mpeg', 'video/ogg',
+        'application/zip')
+ODF_COMPRESSED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.mp3',
+        '.ogg', '.oga', '.ogv', '.mp4', '.mpg', '.mpeg', '.zip')
+
+
 # Presentation classes (for layout)
 ODF_CLASSES = ('title', 'outline', 'subtitle', 'text', 'graphic', 'object',
         'chart', 'table', 'orgchart', 'page', 'notes', 'handout')
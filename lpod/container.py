@@ -29,29 +29,246 @@
 import os
 import sys
 import shutil
-from copy import deepcopy
+from re import compile
+from copy import copy, deepcopy
 from cStringIO import StringIO
-from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, BadZipfile
+from mmap import mmap, ACCESS_READ
+from multiprocessing.pool import ThreadPool
+from struct import pack, unpack
+from tempfile import mkstemp
+from time import localtime, time
+from zlib import compressobj, crc32, DEFLATED, Z_DEFAULT_COMPRESSION
+from zlib import Z_SYNC_FLUSH
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo, BadZipfile
+from zipfile import sizeFileHeader, structFileHeader
+from zipfile import _FH_FILENAME_LENGTH, _FH_EXTRA_FIELD_LENGTH
+
+# Import from lxml
+from lxml.etree import fromstring, tostring, Element, ElementTree
 
 # Import from lpod
 from const import ODF_MIMETYPES, ODF_PARTS, ODF_TYPES, ODF_MANIFEST
 from const import ODF_CONTENT, ODF_META, ODF_SETTINGS, ODF_STYLES
-from const import ODF_EXTENSIONS
+from const import ODF_EXTENSIONS, ODF_COMPRESSED_EXTENSIONS
+from const import ODF_COMPRESSED_MEDIA_TYPES
+from element import ODF_NAMESPACES
 from manifest import odf_manifest
 from utils import _get_abspath  #, obsolete
 from scriptutils import printwarn
 
 
+# To scan the XML-only ODF
+_xml_root = compile(r'<office:document[\s>]')
+_xml_section = compile(r'<office:document-(content|meta|settings|styles)[\s/>]')
+_xml_child = compile(r'<office:(meta|settings|scripts|font-face-decls|styles|'
+                     r'automatic-styles|master-styles|body)[\s/>]')
+_xml_attribute_value = compile(r'="([^"]*)"')
+_xml_mimetype = compile(r'\soffice:mimetype="([^"]*)"')
+_xml_attribute = compile(r'[\w:.-]+="[^"]*"')
+_xml_xmlns = compile(r'\sxmlns:([\w.-]+)=')
+_xml_xmlns_decl = compile(r'(xmlns:([\w.-]+)="[^"]*")')
+
+# Children of the root of the XML-only ODF, in order, and by part
+_xml_children = ('meta', 'settings', 'scripts', 'font-face-decls', 'styles',
+                 'automatic-styles', 'master-styles', 'body')
+_xml_part_children = (
+        (ODF_CONTENT, ('scripts', 'font-face-decls', 'automatic-styles',
+                       'body')),
+        (ODF_META, ('meta',)),
+        (ODF_SETTINGS, ('settings',)),
+        (ODF_STYLES, ('font-face-decls', 'styles', 'automatic-styles',
+                      'master-styles')))
+
+# Size of the chunks when copying compressed parts between archives
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Size of the window of data deflate may refer back to
+DEFLATE_WINDOW_SIZE = 32 * 1024
+
+# Size of the data between the points where inflating a streamed member can
+# be restarted, see "odf_row_index"
+SYNC_FLUSH_SIZE = 4 * 1024 * 1024
+
+
+
+def _write_zip_member(filezip, zinfo, data):
+    """Write an already compressed member in the Zip archive. "data" is a
+    string or an iterable of strings. CRC and sizes must be set in "zinfo".
+    """
+    fp = filezip.fp
+    zinfo.header_offset = fp.tell()
+    filezip._writecheck(zinfo)
+    filezip._didModify = True
+    fp.write(zinfo.FileHeader())
+    if isinstance(data, str):
+        fp.write(data)
+    else:
+        for chunk in data:
+            fp.write(chunk)
+    filezip.filelist.append(zinfo)
+    filezip.NameToInfo[zinfo.filename] = zinfo
+
+
+def _get_zip_member_offset(fp, info):
+    """Return the position of the data of the given member in the file of
+    the Zip archive.
+    """
+    fp.seek(info.header_offset)
+    header = unpack(structFileHeader, fp.read(sizeFileHeader))
+    return (info.header_offset + sizeFileHeader + header[_FH_FILENAME_LENGTH]
+            + header[_FH_EXTRA_FIELD_LENGTH])
+
+
+
+class _zip_member_writer(object):
+    """File-like object compressing what is written to it at the end of
+    the Zip archive, and computing the CRC.
+
+    The compressed data is flushed every SYNC_FLUSH_SIZE bytes, so
+    inflating can be restarted from there.
+    """
+
+    def __init__(self, fp, level=Z_DEFAULT_COMPRESSION):
+        self.fp = fp
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+        self.next_flush = SYNC_FLUSH_SIZE
+        if level == 0:
+            self.compressor = None
+        else:
+            self.compressor = compressobj(level, DEFLATED, -15)
+
+
+    def write(self, data):
+        self.crc = crc32(data, self.crc)
+        self.file_size += len(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+            if self.file_size >= self.next_flush:
+                data += self.compressor.flush(Z_SYNC_FLUSH)
+                self.next_flush = self.file_size + SYNC_FLUSH_SIZE
+        self.compress_size += len(data)
+        self.fp.write(data)
+
+
+    def close(self):
+        self.crc = self.crc & 0xffffffff
+        if self.compressor is not None:
+            data = self.compressor.flush()
+            self.compress_size += len(data)
+            self.fp.write(data)
+            self.compressor = None
+
+
+
+def _open_zip_member(filezip, zinfo, level=Z_DEFAULT_COMPRESSION):
+    """Start a member in the Zip archive. Return the file-like object to
+    write the uncompressed data to, to give to "_close_zip_member".
+    """
+    fp = filezip.fp
+    zinfo.header_offset = fp.tell()
+    zinfo.CRC = zinfo.compress_size = zinfo.file_size = 0
+    filezip._writecheck(zinfo)
+    filezip._didModify = True
+    fp.write(zinfo.FileHeader())
+    return _zip_member_writer(fp, level)
+
+
+
+def _close_zip_member(filezip, zinfo, member):
+    """End a member started by "_open_zip_member". The header is completed
+    afterwards, like ZipFile.write does.
+    """
+    fp = filezip.fp
+    member.close()
+    zinfo.CRC = member.crc
+    zinfo.compress_size = member.compress_size
+    zinfo.file_size = member.file_size
+    position = fp.tell()
+    fp.seek(zinfo.header_offset + 14, 0)
+    fp.write(pack('<LLL', zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+    fp.seek(position, 0)
+    filezip.filelist.append(zinfo)
+    filezip.NameToInfo[zinfo.filename] = zinfo
+
+
+
+def _write_zip_member_stream(filezip, zinfo, writer,
+        level=Z_DEFAULT_COMPRESSION):
+    """Write a member in the Zip archive, calling "writer" with a file-like
+    object to write the uncompressed data to.
+    """
+    member = _open_zip_member(filezip, zinfo, level)
+    writer(member)
+    _close_zip_member(filezip, zinfo, member)
+
+
+
+def _crc32(data):
+    return crc32(data) & 0xffffffff
+
+
+
+def _deflate(data, start=0, end=None, level=Z_DEFAULT_COMPRESSION):
+    """Return the raw deflate stream of the given data, as stored in a Zip
+    archive.
+
+    Give "start" and "end" to compress only a block of the data. The block
+    is compressed with the window of data preceding it, and unless it is the
+    last one, ends byte-aligned without the final bit. So the blocks are
+    concatenated in a single deflate stream.
+    """
+    size = len(data)
+    if end is None:
+        end = size
+    compressor = compressobj(level, DEFLATED, -15)
+    if start > 0:
+        # Prime the compressor with the window, output is discarded
+        window_start = max(0, start - DEFLATE_WINDOW_SIZE)
+        compressor.compress(buffer(data, window_start, start - window_start))
+        compressor.flush(Z_SYNC_FLUSH)
+    compressed = compressor.compress(buffer(data, start, end - start))
+    if end < size:
+        return compressed + compressor.flush(Z_SYNC_FLUSH)
+    return compressed + compressor.flush()
+
+
+
+def _deflate_async(pool, data, block_size=None,
+        level=Z_DEFAULT_COMPRESSION):
+    """Submit the compression of the data to the given thread pool, in
+    blocks of "block_size" bytes if given.
+
+    Return the async results of the CRC, and of the compressed blocks.
+    """
+    size = len(data)
+    if not block_size or size <= block_size:
+        return pool.apply_async(_crc32, (data,)), [
+                pool.apply_async(_deflate, (data, 0, None, level))]
+    blocks = []
+    for start in xrange(0, size, block_size):
+        end = min(start + block_size, size)
+        blocks.append(pool.apply_async(_deflate, (data, start, end, level)))
+    return pool.apply_async(_crc32, (data,)), blocks
+
+
+
 class odf_container(object):
     """Representation of the ODF file.
+
+    If "lazy" is True, the file is memory-mapped instead of being read in
+    memory, and only the parts actually requested are inflated.
     """
     # The archive file
     __zipfile = None
     # Using zip archive
     __packaging = None  # None, 'zip', 'flat', 'folder'
+    # Offsets of the sections of the XML-only ODF
+    __xml_offsets = None
 
 
-    def __init__(self, path_or_file):
+    def __init__(self, path_or_file, lazy=False):
         want_folder = False
         if isinstance(path_or_file, basestring):
             # Path
@@ -79,8 +296,17 @@ class odf_container(object):
                 mimetype = ODF_EXTENSIONS['odt']
             self.__parts = {'mimetype': mimetype}
             self.__parts_ts = {'mimetype': timestamp}
+            self.__parts_modified = set()
+            self.__writers = {}
         else:
-            self.__data = data = file.read()
+            data = None
+            if lazy:
+                data = self.__map_file(file)
+                if isinstance(path_or_file, basestring):
+                    file.close()
+            if data is None:
+                data = file.read()
+            self.__data = data
             zip_expected = data[:4] == 'PK\x03\x04'
             # Most probably zipped document
             try:
@@ -99,6 +325,8 @@ class odf_container(object):
                 message = 'Document of unknown type "%s"' % mimetype
                 raise ValueError(message)
             self.__parts = {'mimetype': mimetype}
+            self.__parts_modified = set()
+            self.__writers = {}
 
 
     #
@@ -111,39 +339,279 @@ class odf_container(object):
         return self.__data
 
 
+    def __map_file(self, file):
+        """Map the given file in memory, read-only. Return None if the file
+        cannot be mapped (not a real file, empty file...).
+        """
+        try:
+            if file.tell() != 0:
+                return None
+            fileno = file.fileno()
+        except (AttributeError, EnvironmentError):
+            return None
+        try:
+            return mmap(fileno, 0, access=ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            return None
+
+
+    def __is_source(self, target):
+        """Is the target path the mapped file we read from?
+        """
+        if not isinstance(self.__data, mmap) or self.path is None:
+            return False
+        if not isinstance(target, basestring):
+            return False
+        return os.path.realpath(target) == os.path.realpath(self.path)
+
+
+    def __replace_source(self, temp_path, target, packaging):
+        """Move the saved file over the mapped file we read from, and map it
+        instead. The former mapping stays valid for the clones sharing it.
+        """
+        if os.path.exists(target):
+            os.chmod(temp_path, os.stat(target).st_mode & 0777)
+        try:
+            os.rename(temp_path, target)
+        except OSError:
+            # Windows does not replace files
+            os.remove(target)
+            os.rename(temp_path, target)
+        self.__zipfile = None
+        self.__xml_offsets = None
+        self.__packaging = packaging
+        file = open(target, 'rb')
+        self.__data = self.__map_file(file)
+        if self.__data is None:
+            self.__data = file.read()
+        file.close()
+        # The loaded parts are the saved ones now
+        self.__parts_modified = set()
+        self.__writers = {}
+
+
     # XML implementation
 
+    def __get_xml_offsets(self):
+        """Scan the XML-only ODF once for the children of the root element,
+        "office:meta", "office:body", etc. The sections of the XML parts
+        nested in the root, as written by former versions, are read too.
+
+        Return a dict of {name: (start, end)} offsets of each child, by
+        qualified name, or of each section, by path, and of the root start
+        tag, the mimetype being an attribute of it.
+        """
+        if self.__xml_offsets is not None:
+            return self.__xml_offsets
+        data = self.__get_data()
+        offsets = {}
+        match = _xml_root.search(data)
+        if match is None:
+            raise ValueError("bad OpenDocument format")
+        start = match.start()
+        end = data.find('>', match.end())
+        if end == -1:
+            raise ValueError("bad OpenDocument format")
+        offsets[None] = (start, end + 1)
+        pos = end + 1
+        # Nested parts
+        while True:
+            match = _xml_section.search(data, pos)
+            if match is None:
+                break
+            name = match.group(1)
+            end_tag = '</office:document-%s>' % name
+            end = data.find(end_tag, match.end())
+            if end == -1:
+                raise ValueError("unclosed section '%s'" % name)
+            pos = end + len(end_tag)
+            offsets[name + '.xml'] = (match.start(), pos)
+        if len(offsets) > 1:
+            self.__xml_offsets = offsets
+            return offsets
+        # Children of the root
+        while True:
+            match = _xml_child.search(data, pos)
+            if match is None:
+                break
+            name = 'office:' + match.group(1)
+            end = data.find('>', match.end() - 1)
+            if end == -1:
+                raise ValueError("unclosed element '%s'" % name)
+            if data[end - 1] == '/':
+                pos = end + 1
+            else:
+                end_tag = '</%s>' % name
+                end = data.find(end_tag, end)
+                if end == -1:
+                    raise ValueError("unclosed element '%s'" % name)
+                pos = end + len(end_tag)
+            offsets[name] = (match.start(), pos)
+        self.__xml_offsets = offsets
+        return offsets
+
+
     def __get_xml_parts(self):
         """Get the list of members in the XML-only ODF.
         """
-        raise NotImplementedError
+        offsets = self.__get_xml_offsets()
+        if ODF_CONTENT in offsets:
+            return ['mimetype'] + sorted(path for path in offsets
+                                         if path is not None)
+        parts = []
+        for path, names in _xml_part_children:
+            for name in names:
+                if 'office:' + name in offsets:
+                    parts.append(path)
+                    break
+        return ['mimetype'] + sorted(parts)
 
 
     def __get_xml_part(self, name):
         """Get bytes of a part from the XML-only ODF. No cache.
+
+        The parts borrow the namespace declarations of the root element,
+        so they can be parsed alone.
         """
-        if name not in ODF_PARTS and name != 'mimetype':
+        if name in ODF_PARTS:
+            name = name + '.xml'
+        elif name != 'mimetype' and name[:-4] not in ODF_PARTS:
             raise ValueError("Third-party parts are not supported "
                                "in an XML-only ODF document")
         data = self.__get_data()
+        offsets = self.__get_xml_offsets()
+        start, end = offsets[None]
+        root = data[start:end]
         if name == 'mimetype':
-            start_attr = 'office:mimetype="'
-            start = data.index(start_attr) + len(start_attr)
-            end = data.index('"', start)
-            part = data[start:end]
+            match = _xml_mimetype.search(root)
+            if match is None:
+                raise ValueError("missing mimetype")
+            return match.group(1)
+        if ODF_CONTENT not in offsets:
+            return self.__make_xml_part(name, data, offsets, root)
+        if name not in offsets:
+            raise ValueError('part "%s" not found' % name)
+        start, end = offsets[name]
+        part = data[start:end]
+        # Declare the namespaces of the root not declared by the section
+        tag_end = len('<office:document-') + len(name) - len('.xml')
+        declared = set(_xml_xmlns.findall(part[:part.find('>') + 1]))
+        xmlns = [declaration
+                 for declaration, prefix in _xml_xmlns_decl.findall(root)
+                 if prefix not in declared]
+        if not xmlns:
+            return part
+        return ''.join((part[:tag_end], ' ', ' '.join(xmlns), part[tag_end:]))
+
+
+    def __make_xml_part(self, path, data, offsets, root):
+        """Make a part from the children of the root element of the
+        XML-only ODF it is made of. The automatic styles are split between
+        content and styles, those used by the styles going to the latter.
+        """
+        for part_path, names in _xml_part_children:
+            if part_path == path:
+                break
         else:
-            start_tag = '<office:document-%s>' % name
-            start = data.index(start_tag)
-            end_tag = '</office:document-%s>' % name
-            end = data.index(end_tag) + len(end_tag)
-            part = data[start:end]
-        return part
+            raise ValueError('part "%s" not found' % path)
+        attributes = ' '.join(attribute
+                for attribute in _xml_attribute.findall(root)
+                if not attribute.startswith('office:mimetype='))
+        sections = []
+        for name in names:
+            start, end = offsets.get('office:' + name, (0, 0))
+            sections.append(data[start:end])
+        if not ''.join(sections):
+            raise ValueError('part "%s" not found' % path)
+        tag = 'office:document-' + path[:-4]
+        part = '<%s %s>%s</%s>' % (tag, attributes, ''.join(sections), tag)
+        if 'office:automatic-styles' not in offsets or path not in (
+                ODF_CONTENT, ODF_STYLES):
+            return part
+        # The page layouts and the styles used by the common and master
+        # styles go to the styles, the others to the content
+        used = set()
+        for name in ('office:styles', 'office:master-styles'):
+            start, end = offsets.get(name, (0, 0))
+            used.update(_xml_attribute_value.findall(data, start, end))
+        root = fromstring(part)
+        page_layout = '{%s}page-layout' % ODF_NAMESPACES['style']
+        style_name = '{%s}name' % ODF_NAMESPACES['style']
+        automatic = root.find('{%s}automatic-styles' % ODF_NAMESPACES['office'])
+        for style in list(automatic.iterchildren(tag=Element)):
+            in_styles = (style.tag == page_layout
+                         or style.get(style_name) in used)
+            if in_styles != (path == ODF_STYLES):
+                automatic.remove(style)
+        return tostring(root)
 
 
     def __save_xml(self, file):
-        """Save an XML-only ODF from the available parts.
+        """Save an XML-only ODF from the available parts, their children
+        merged under the root element "office:document".
         """
-        raise NotImplementedError
+        parts = self.__parts
+        writers = self.__writers
+        office = ODF_NAMESPACES['office']
+        style_name = '{%s}name' % ODF_NAMESPACES['style']
+        nsmap = {}
+        version = None
+        children = {}
+        for path in ODF_META, ODF_SETTINGS, ODF_CONTENT, ODF_STYLES:
+            if path in writers:
+                data = StringIO()
+                writers[path](data)
+                data = data.getvalue()
+            elif path in parts:
+                data = parts[path]
+            elif self.__data is not None and path in self.get_parts():
+                data = self.get_part(path)
+            else:
+                data = None
+            if data is None:
+                printwarn("missing '%s'" % path)
+                continue
+            root = fromstring(data)
+            for prefix, uri in root.nsmap.iteritems():
+                if prefix is not None:
+                    nsmap.setdefault(prefix, uri)
+            if version is None:
+                version = root.get('{%s}version' % office)
+            for child in root.iterchildren(tag=Element):
+                children.setdefault(child.tag, []).append(child)
+        document = Element('{%s}document' % office, nsmap=nsmap)
+        if version is not None:
+            document.set('{%s}version' % office, version)
+        document.set('{%s}mimetype' % office, parts['mimetype'])
+        for name in _xml_children:
+            elements = children.get('{%s}%s' % (office, name))
+            if not elements:
+                continue
+            first = elements[0]
+            # Both content and styles have some
+            if name in ('font-face-decls', 'automatic-styles'):
+                seen = set((child.tag, child.get(style_name))
+                           for child in first)
+                for element in elements[1:]:
+                    for child in element.iterchildren(tag=Element):
+                        key = (child.tag, child.get(style_name))
+                        if key not in seen:
+                            seen.add(key)
+                            first.append(child)
+            first.tail = '\n '
+            document.append(first)
+        if len(document):
+            document.text = '\n '
+            document[-1].tail = '\n'
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        ElementTree(document).write(file, encoding='UTF-8')
+        # Binary parts would have to be embedded in the XML
+        for path in parts:
+            if (parts[path] is None or path in ('mimetype', ODF_MANIFEST)
+                    or path in ODF_PARTS or path[:-4] in ODF_PARTS
+                    or path.endswith('/')):
+                continue
+            printwarn("'%s' not supported in an XML-only ODF document" % path)
 
 
     # Zip implementation
@@ -174,49 +642,208 @@ class odf_container(object):
         return zipfile.read(path)
 
 
-    def __save_zip(self, file):
+    def __copy_zip_part(self, source, path):
+        """Yield the compressed bytes of a member of the source archive, so
+        it is copied without being inflated and deflated again.
+        """
+        info = source.getinfo(path)
+        fp = source.fp
+        fp.seek(_get_zip_member_offset(fp, info))
+        remaining = info.compress_size
+        while remaining > 0:
+            # Another member may have been read in between
+            position = fp.tell()
+            chunk = fp.read(min(remaining, COPY_CHUNK_SIZE))
+            if not chunk:
+                raise BadZipfile("truncated member '%s'" % path)
+            remaining -= len(chunk)
+            yield chunk
+            fp.seek(position + len(chunk))
+
+
+    def __get_media_types(self):
+        """Return the {path: media type} of the manifest, if any.
+        """
+        try:
+            # Loaded and kept for the manifest below
+            self.get_part(ODF_MANIFEST)
+        except (KeyError, ValueError, IOError):
+            return {}
+        manifest = odf_manifest(ODF_MANIFEST, self)
+        return dict(manifest.get_path_medias())
+
+
+    def __save_zip(self, file, workers=None, block_size=None,
+            compression=None, level=None):
         """Save a Zip ODF from the available parts.
+
+        Parts of the source archive that were not modified are copied
+        compressed, without being inflated and deflated again. Other parts
+        are compressed by "workers" threads if given, parts bigger than
+        "block_size" being split in blocks compressed in parallel. Parts
+        given by a writer are streamed, unless compressed by the threads:
+        then they are written in memory first.
+
+        The zlib level of a part is looked up in "compression" by path,
+        then media type and extension, else it is "level". Level 0 means
+        stored.
+
+        "file" may be a Zip object opened for writing, the parts already
+        written in it are kept.
         """
-        # Parts were loaded by "save"
+        # Modified parts were loaded by "save"
         parts = self.__parts
-        compression = ZIP_DEFLATED
-        try:
-            filezip = ZipFile(file, 'w', compression=compression)
-        except RuntimeError:
-            # No zlib module
-            compression = ZIP_STORED
-            filezip = ZipFile(file, 'w', compression=compression)
+        modified = self.__parts_modified
+        writers = self.__writers
+        source = None
+        if self.__packaging == 'zip' and self.__data is not None:
+            source = self.__get_zipfile()
+            source_names = set(source.namelist())
+        if isinstance(file, ZipFile):
+            filezip = file
+        else:
+            filezip = ZipFile(file, 'w', compression=ZIP_DEFLATED)
+        written = set(filezip.NameToInfo)
+        # Compression policy
+        policy = dict.fromkeys(ODF_COMPRESSED_MEDIA_TYPES, 0)
+        policy.update(dict.fromkeys(ODF_COMPRESSED_EXTENSIONS, 0))
+        if compression is not None:
+            policy.update(compression)
+        if level is None:
+            level = Z_DEFAULT_COMPRESSION
+        media_types = self.__get_media_types()
+
+        def get_level(path):
+            if path in policy:
+                return policy[path]
+            media_type = media_types.get(path)
+            if media_type in policy:
+                return policy[media_type]
+            extension = os.path.splitext(path)[1].lower()
+            return policy.get(extension, level)
+
+        def is_copied(path):
+            return (source is not None and path in source_names
+                    and path not in modified)
+
+        def copy_raw(path):
+            info = source.getinfo(path)
+            zinfo = ZipInfo(info.filename, info.date_time)
+            zinfo.compress_type = info.compress_type
+            zinfo.external_attr = info.external_attr
+            zinfo.create_system = info.create_system
+            zinfo.CRC = info.CRC
+            zinfo.compress_size = info.compress_size
+            zinfo.file_size = info.file_size
+            _write_zip_member(filezip, zinfo,
+                    self.__copy_zip_part(source, path))
+
+        def new_zinfo(path, compress_type):
+            zinfo = ZipInfo(path, localtime(time())[:6])
+            zinfo.compress_type = compress_type
+            zinfo.external_attr = 0600 << 16
+            return zinfo
+
+        def write(path, compress_type, crc, blocks, data=None):
+            if data is None:
+                data = parts[path]
+            zinfo = new_zinfo(path, compress_type)
+            zinfo.file_size = len(data)
+            zinfo.CRC = crc
+            zinfo.compress_size = sum(len(block) for block in blocks)
+            _write_zip_member(filezip, zinfo, blocks)
+
+        def stream(path, level):
+            compress_type = ZIP_STORED if level == 0 else ZIP_DEFLATED
+            zinfo = new_zinfo(path, compress_type)
+            _write_zip_member_stream(filezip, zinfo, writers[path], level)
+
         # Parts to save, except manifest at the end
-        part_names = parts.keys()
+        part_names = set(parts)
+        part_names.update(writers)
+        if source is not None:
+            part_names.update(source_names)
+        part_names = [path for path in part_names
+                      if path not in parts or parts[path] is not None]
         try:
             part_names.remove(ODF_MANIFEST)
-        except KeyError:
+        except ValueError:
             printwarn("missing '%s'" % ODF_MANIFEST)
+            manifest = []
+        else:
+            manifest = [ODF_MANIFEST]
         # "Pretty-save" parts in some order
         # mimetype requires to be first and uncompressed
         filezip.compression = ZIP_STORED
         try:
-            filezip.writestr('mimetype', parts['mimetype'])
-            filezip.compression = compression
+            if 'mimetype' not in written:
+                filezip.writestr('mimetype', parts['mimetype'])
             part_names.remove('mimetype')
         except:
             printwarn("missing 'mimetype'")
         # XML parts
+        ordered = []
         for path in ODF_CONTENT, ODF_META, ODF_SETTINGS, ODF_STYLES:
-            if path not in parts:
+            if path not in part_names:
                 printwarn("missing '%s'" % path)
                 continue
-            filezip.writestr(path, parts[path])
+            ordered.append(path)
             part_names.remove(path)
-        # Everything else
-        for path in part_names:
-            data = parts[path]
-            if data is None:
-                # Deleted
-                continue
-            filezip.writestr(path, data)
-        # Manifest
-        filezip.writestr(ODF_MANIFEST, parts[ODF_MANIFEST])
+        # Everything else, then the manifest
+        ordered.extend(part_names)
+        ordered.extend(manifest)
+        ordered = [path for path in ordered if path not in written]
+        if workers is None or workers < 2:
+            for path in ordered:
+                if is_copied(path):
+                    copy_raw(path)
+                    continue
+                path_level = get_level(path)
+                if path in writers:
+                    stream(path, path_level)
+                    continue
+                data = parts[path]
+                if path_level == 0:
+                    write(path, ZIP_STORED, _crc32(data), [data])
+                else:
+                    write(path, ZIP_DEFLATED, _crc32(data),
+                            [_deflate(data, level=path_level)])
+        else:
+            # Compress in parallel, zlib releases the GIL, but write in order
+            pool = ThreadPool(workers)
+            try:
+                datas = {}
+                jobs = {}
+                for path in ordered:
+                    if is_copied(path):
+                        continue
+                    if path in writers:
+                        # Written while the pool works on the previous parts
+                        data = StringIO()
+                        writers[path](data)
+                        data = datas[path] = data.getvalue()
+                    else:
+                        data = parts[path]
+                    path_level = get_level(path)
+                    if path_level != 0:
+                        jobs[path] = _deflate_async(pool, data,
+                                block_size=block_size, level=path_level)
+                for path in ordered:
+                    if is_copied(path):
+                        copy_raw(path)
+                        continue
+                    data = datas.pop(path, None)
+                    if path in jobs:
+                        crc, blocks = jobs.pop(path)
+                        write(path, ZIP_DEFLATED, crc.get(),
+                                [block.get() for block in blocks], data)
+                    else:
+                        if data is None:
+                            data = parts[path]
+                        write(path, ZIP_STORED, _crc32(data), [data], data)
+            finally:
+                pool.close()
+                pool.join()
         filezip.close()
 
 
@@ -286,7 +913,9 @@ class odf_container(object):
         if isinstance(folder, basestring) and not isinstance(folder, unicode):
             folder = folder.decode(encoding)
         # Parts were loaded by "save"
-        parts = self.__parts
+        parts = dict(self.__parts)
+        for path in self.__writers:
+            parts[path] = self.get_part(path)
         # Parts to save, except manifest at the end
         part_names = parts.keys()
         try:
@@ -336,6 +965,11 @@ class odf_container(object):
     def get_part(self, path):
         """Get the bytes of a part of the ODF.
         """
+        writer = self.__writers.get(path)
+        if writer is not None:
+            file = StringIO()
+            writer(file)
+            return file.getvalue()
         loaded_parts = self.__parts
         if path in loaded_parts:
             part = loaded_parts[path]
@@ -360,32 +994,72 @@ class odf_container(object):
         return part
 
 
+    def open_part(self, path):
+        """Return a file-like object to read a part of the ODF, inflated on
+        the fly from the Zip ODF instead of being loaded in memory.
+        """
+        if path in self.__writers or path in self.__parts:
+            return StringIO(self.get_part(path))
+        if self.__packaging == 'zip':
+            # A Zip object of its own, not to share the file position
+            zipfile = ZipFile(StringIO(self.__get_data()))
+            return zipfile.open(path)
+        elif self.__packaging == 'folder':
+            return open(os.path.join(self.__data, path), 'rb')
+        return StringIO(self.__get_xml_part(path))
+
+
     def set_part(self, path, data):
         """Replace or add a new part.
         """
         self.__parts[path] = data
+        self.__parts_modified.add(path)
+        self.__writers.pop(path, None)
+
+
+    def set_part_writer(self, path, writer):
+        """Replace or add a new part, written when saving by calling
+        "writer" with a file-like object, so the part is not kept in memory.
+        """
+        self.__parts.pop(path, None)
+        self.__parts_modified.add(path)
+        self.__writers[path] = writer
 
 
     def del_part(self, path):
         """Mark a part for deletion.
         """
         self.__parts[path] = None
+        self.__parts_modified.add(path)
+        self.__writers.pop(path, None)
 
 
     def clone(self):
         """Make a copy of this container with no path.
         """
-        # FIXME must load parts before?
         clone = object.__new__(self.__class__)
         for name in self.__dict__:
             # "__zipfile" is not safe to copy
             # but can be recreated from "__data"
             if name in ('path', '_odf_container__zipfile'):
                 setattr(clone, name, None)
+            elif name == '_odf_container__data':
+                # Immutable bytes or read-only mapping, no need to copy
+                setattr(clone, name, self.__data)
+            elif name == '_odf_container__writers':
+                # Take a snapshot of the parts written by them
+                setattr(clone, name, {})
             else:
                 value = getattr(self, name)
-                value = deepcopy(value)
+                if isinstance(value, (dict, set)):
+                    # Parts are immutable bytes, shared until "set_part"
+                    # replaces them on either side
+                    value = copy(value)
+                else:
+                    value = deepcopy(value)
                 setattr(clone, name, value)
+        for path in self.__writers:
+            clone.__parts[path] = self.get_part(path)
         return clone
 
 
@@ -407,7 +1081,8 @@ class odf_container(object):
                 printwarn(str(e))
 
 
-    def save(self, target=None, packaging=None, backup=False):
+    def save(self, target=None, packaging=None, backup=False, workers=None,
+            block_size=None, compression=None, level=None):
         """Save the container to the given target, a path or a file-like
         object.
 
@@ -416,11 +1091,28 @@ class odf_container(object):
 
         Arguments:
 
-            target -- str or file-like
+            target -- str, file-like, or Zip object opened for writing
 
             packaging -- 'zip' or 'flat', or for debugging purpose 'folder'
 
             backup -- boolean
+
+            workers -- int, number of threads compressing the Zip parts
+
+            block_size -- int, compress in parallel blocks of that size
+                          within a single part, requires "workers"
+
+            compression -- dict of zlib levels by path, media type or
+                           extension, e.g. {'image/png': 0, '.xml': 9}
+
+            level -- int, zlib level of the other parts, 0 to store them
+
+        Pictures and other media already compressed are stored, unless
+        told otherwise by "compression". Parts not modified keep the
+        compression they had in the source archive.
+
+        When saving in a Zip object, the parts it already contains are not
+        written again.
         """
         if isinstance(target, basestring) and not isinstance(target, unicode):
             encoding = sys.getfilesystemencoding()
@@ -435,10 +1127,9 @@ class odf_container(object):
         packaging = packaging.strip().lower()
         if packaging not in ('zip', 'flat', 'folder'):
             raise ValueError('packaging type "%s" not supported' % packaging)
-        # Load parts else they will be considered deleted
-        for path in self.get_parts():
-            if path not in parts:
-                self.get_part(path)
+        if isinstance(target, ZipFile) and packaging != 'zip':
+            raise ValueError('packaging type "%s" not supported in a Zip '
+                             'object' % packaging)
         # Open output file
         close_after = False
         if target is None:
@@ -448,11 +1139,25 @@ class odf_container(object):
                 target = target[:-1]
             while target.endswith('.folder'):
                 target = target.split('.folder', 1)[0]
+        # Don't write over the file we are mapping from
+        remap = self.__is_source(target) and packaging != 'folder'
+        # Load parts else they will be considered deleted, unless they can
+        # be copied from the source archive
+        if (packaging != self.__packaging
+                or packaging not in ('zip', 'flat') or self.__data is None):
+            for path in self.get_parts():
+                if path not in parts and path not in self.__writers:
+                    self.get_part(path)
         if packaging in ('zip', 'flat'):
             if isinstance(target, basestring):
                 if backup:
                     self._do_backup(target)
-                dest_file = open(target, 'wb')
+                if remap:
+                    # Write aside, then replace
+                    fd, temp_path = mkstemp(dir=os.path.dirname(target))
+                    dest_file = os.fdopen(fd, 'wb')
+                else:
+                    dest_file = open(target, 'wb')
                 close_after = True
             else:
                 dest_file = target
@@ -475,7 +1180,9 @@ class odf_container(object):
             dest_file = target
         # Serialize
         if packaging == 'zip':
-            self.__save_zip(dest_file)
+            self.__save_zip(dest_file, workers=workers,
+                    block_size=block_size, compression=compression,
+                    level=level)
         elif packaging == 'flat':
             self.__save_xml(dest_file)
         else: # folder
@@ -483,33 +1190,97 @@ class odf_container(object):
         # Close files we opened ourselves
         if close_after:
             dest_file.close()
+        if remap:
+            self.__replace_source(temp_path, target, packaging)
 
 
 
-def odf_get_container(path_or_file):
+def odf_get_container(path_or_file, lazy=False):
     """Return an odf_container instance of the ODF document stored at the
     given local path or in the given (open) file-like object.
+
+    If "lazy" is True, the file is memory-mapped and parts are only
+    inflated when requested, instead of reading the whole archive in memory.
     """
-    return odf_container(path_or_file)
+    return odf_container(path_or_file, lazy=lazy)
 
 
 
-def odf_new_container(path_or_file):
-    """Return an odf_container instance based on the given template.
+# Templates ready to be cloned, by path, with their modification time
+_template_cache = {}
+
+
+
+def _get_template_path(path_or_file):
+    """Return the absolute path of the template, or None for a file-like
+    object.
     """
     if path_or_file in ODF_TYPES:
-        path_or_file = _get_abspath(ODF_TYPES[path_or_file])
+        return _get_abspath(ODF_TYPES[path_or_file])
+    if isinstance(path_or_file, basestring):
+        return os.path.abspath(path_or_file)
+    return None
+
+
+
+def _get_template(path_or_file):
+    """Return the container of the given template, from the cache if it
+    was not modified since. Don't modify it, clone it.
+    """
+    path = _get_template_path(path_or_file)
+    if path is None:
+        return _make_template(path_or_file)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        # Let the container report it
+        return _make_template(path)
+    cached = _template_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    template = _make_template(path)
+    _template_cache[path] = (mtime, template)
+    return template
+
+
+
+def _make_template(path_or_file):
     template_container = odf_get_container(path_or_file)
-    # Return a copy of the template container
-    clone = template_container.clone()
+    # Work on a copy of the template container
+    template = template_container.clone()
     # Change type from template to regular
-    mimetype = clone.get_part('mimetype').replace('-template', '')
-    clone.set_part('mimetype', mimetype)
+    mimetype = template.get_part('mimetype').replace('-template', '')
+    template.set_part('mimetype', mimetype)
     # Update the manifest
-    manifest = odf_manifest(ODF_MANIFEST, clone)
+    manifest = odf_manifest(ODF_MANIFEST, template)
     manifest.set_media_type('/', mimetype)
-    clone.set_part(ODF_MANIFEST, manifest.serialize())
-    return clone
+    template.set_part(ODF_MANIFEST, manifest.serialize())
+    # Load the parts, the clones will share them
+    for path in template.get_parts():
+        template.get_part(path)
+    return template
+
+
+
+def odf_clear_template_cache(path_or_file=None):
+    """Forget the given template, or all of them, so it is read again by
+    the next "odf_new_container" or "odf_new_document".
+
+    Templates modified on disk are read again anyway.
+    """
+    if path_or_file is None:
+        _template_cache.clear()
+    else:
+        _template_cache.pop(_get_template_path(path_or_file), None)
+
+
+
+def odf_new_container(path_or_file):
+    """Return an odf_container instance based on the given template.
+
+    Templates are cached, see "odf_clear_template_cache".
+    """
+    return _get_template(path_or_file).clone()
 
 #odf_new_document_from_template = obsolete('odf_new_document_from_template',
 #        odf_new_container)
@@ -26,17 +26,235 @@
 #    http://www.apache.org/licenses/LICENSE-2.0
 #
 
+# Import from the Standard Library
+from cStringIO import StringIO
+from re import compile, escape
+
+# Import from lxml
+from lxml.etree import fromstring, parse, tostring, PI
+
 # Import from lpod
 #from utils import obsolete
+from element import ODF_NAMESPACES
 from xmlpart import odf_xmlpart
 
 
+_xml_root = compile(r'<(?![?!])([\w.:-]+)')
+_xml_start_tag_end = compile(r'''[^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>''')
+_xml_xmlns_decl = compile(r'xmlns:([\w.-]+)="([^"]*)"')
+
+
+
+def _index_tables(data):
+    """Find the byte ranges of the tables of the spreadsheet in the given
+    content part, without parsing it.
+
+    Return the content with the tables emptied, the ranges (start, end) of
+    the tables, None for tables already empty, and the start and end tags
+    of the root element. Return None if the tables cannot be found.
+    """
+    root = _xml_root.search(data)
+    if root is None:
+        return None
+    root_tag_end = _xml_start_tag_end.match(data, root.end())
+    if root_tag_end is None:
+        return None
+    root_start = data[root.start():root_tag_end.end()]
+    prefixes = dict((uri, prefix) for prefix, uri
+                    in _xml_xmlns_decl.findall(root_start))
+    office = prefixes.get(ODF_NAMESPACES['office'])
+    table = prefixes.get(ODF_NAMESPACES['table'])
+    if office is None or table is None:
+        return None
+    start = data.find('<%s:spreadsheet' % office, root_tag_end.end())
+    end = data.find('</%s:spreadsheet>' % office, start)
+    if start == -1 or end == -1:
+        return None
+    tags = compile(r'<(/?)%s:table(?=[\s/>])' % escape(table))
+    skeleton = []
+    tables = []
+    position = 0
+    depth = 0
+    for match in tags.finditer(data, start, end):
+        if match.group(1):
+            depth -= 1
+            if depth == 0:
+                table_end = data.index('>', match.end()) + 1
+                tables.append((table_start, table_end))
+                # Only the start tag is kept, empty
+                skeleton.append(data[position:tag_end - 1])
+                skeleton.append('/>')
+                position = table_end
+            continue
+        tag_end = _xml_start_tag_end.match(data, match.end())
+        if tag_end is None:
+            return None
+        if data[tag_end.end() - 2] == '/':
+            if depth == 0:
+                tables.append(None)
+            continue
+        if depth == 0:
+            table_start = match.start()
+            tag_end = tag_end.end()
+        depth += 1
+    if depth != 0:
+        return None
+    skeleton.append(data[position:])
+    return ''.join(skeleton), tables, root_start, '</%s>' % root.group(1)
+
+
+
 class odf_content(odf_xmlpart):
+    """The content part.
+
+    If "lazy_tables" is True, the tables of a spreadsheet are only parsed
+    when got by "get_table" or "get_tables". Until then they are empty in
+    the tree, and the ones never got are written back as they were read.
+    """
+    lazy_tables = False
+    # The tables not parsed, with their range in the data read
+    __unloaded = ()
+    __data = None
+    __root_tags = None
+
+
+    def _parse(self):
+        if not self.lazy_tables:
+            return odf_xmlpart._parse(self)
+        data = self.container.get_part(self.part_name)
+        index = _index_tables(data)
+        if index is None:
+            return parse(StringIO(data))
+        skeleton, tables, root_start, root_end = index
+        tree = parse(StringIO(skeleton))
+        spreadsheet = tree.find('//{%s}spreadsheet' % ODF_NAMESPACES['office'])
+        table_tag = '{%s}table' % ODF_NAMESPACES['table']
+        placeholders = list(spreadsheet.iterchildren(table_tag))
+        if len(placeholders) != len(tables):
+            # Not all at the top of the spreadsheet
+            return parse(StringIO(data))
+        unloaded = []
+        for position, (placeholder, table) in enumerate(zip(placeholders,
+                                                            tables)):
+            if table is not None:
+                start, end = table
+                unloaded.append((position, placeholder, start, end))
+        self.__unloaded = unloaded
+        self.__data = data
+        self.__root_tags = root_start, root_end
+        return tree
+
+
+    def _load_tables(self, name=None, count=None):
+        """Parse the tables left unloaded: all of them, or those of the
+        given name, or those among the first "count" ones.
+        """
+        unloaded = self.__unloaded
+        if not unloaded:
+            return
+        name_attribute = '{%s}name' % ODF_NAMESPACES['table']
+        root_start, root_end = self.__root_tags
+        data = self.__data
+        kept = []
+        for table in unloaded:
+            position, placeholder, start, end = table
+            if ((name is not None and placeholder.get(name_attribute) != name)
+                    or (count is not None and position >= count)):
+                kept.append(table)
+                continue
+            # Parsed within the root for the namespaces
+            element = fromstring(root_start + data[start:end] + root_end)[0]
+            element.tail = placeholder.tail
+            placeholder.getparent().replace(placeholder, element)
+        self.__unloaded = kept
+        if not kept:
+            self.__data = self.__root_tags = None
+
+
+    def write(self, file, pretty=False, xml_declaration=True):
+        # Parsed first to know the tables left unloaded
+        self.get_root()
+        unloaded = self.__unloaded
+        if not unloaded:
+            return odf_xmlpart.write(self, file, pretty=pretty,
+                    xml_declaration=xml_declaration)
+        tree = unloaded[0][1].getroottree()
+        # The tables not parsed are replaced by markers while serializing
+        markers = []
+        for position, placeholder, start, end in unloaded:
+            marker = PI('lpod-table', str(position))
+            marker.tail = placeholder.tail
+            placeholder.getparent().replace(placeholder, marker)
+            markers.append(marker)
+        try:
+            data = tostring(tree, encoding='UTF-8', pretty_print=pretty)
+        finally:
+            for marker, table in zip(markers, unloaded):
+                marker.getparent().replace(marker, table[1])
+        if xml_declaration:
+            file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        source = self.__data
+        offset = 0
+        for position, placeholder, start, end in unloaded:
+            marker = '<?lpod-table %d?>' % position
+            index = data.index(marker, offset)
+            file.write(buffer(data, offset, index - offset))
+            file.write(buffer(source, start, end - start))
+            offset = index + len(marker)
+        file.write(buffer(data, offset))
+
+
+    def serialize(self, pretty=False):
+        self.get_root()
+        if not self.__unloaded:
+            return odf_xmlpart.serialize(self, pretty=pretty)
+        file = StringIO()
+        self.write(file, pretty=pretty)
+        data = file.getvalue()
+        # Lxml with pretty_print is adding a empty line
+        if pretty:
+            data = data.strip()
+        return data
+
+
+    def clone(self, container=None):
+        # The clone has the whole tree
+        self._load_tables()
+        return odf_xmlpart.clone(self, container=container)
+
 
     def get_body(self):
         return self.get_root().get_document_body()
 
 
+    def iter_body(self, tags=None):
+        """Yield the children of the body, or its elements of the given tag
+        name(s) at any depth, e.g. "text:p". The part is read without building
+        the whole tree when not already loaded, so the elements are only valid
+        until the next one is yielded: read-only, don't keep them, clone them.
+
+        Arguments:
+
+            tags -- str or tuple of str
+
+        Return: iterator of odf_element
+        """
+        if tags is not None:
+            return self.iter_elements(tags)
+        if self._is_loaded():
+            return iter(self.get_body().get_children())
+        body_tag = '{%s}body' % ODF_NAMESPACES['office']
+
+        def is_match(element):
+            parent = element.getparent()
+            if parent is None:
+                return False
+            grand_parent = parent.getparent()
+            return grand_parent is not None and grand_parent.tag == body_tag
+
+        return self._iterparse(is_match)
+
+
     # The following two seem useless but they match styles API
 
     def _get_style_contexts(self, family):
@@ -31,7 +31,9 @@
 import sys
 import os
 from copy import deepcopy
+from functools import partial
 from mimetypes import guess_type
+from multiprocessing import Pool
 from operator import itemgetter
 from uuid import uuid4
 
@@ -40,6 +42,8 @@ from __init__ import __version__
 from const import ODF_CONTENT, ODF_META, ODF_SETTINGS, ODF_STYLES
 from const import ODF_MANIFEST
 from container import odf_get_container, odf_new_container, odf_container
+from container import _get_template, _get_template_path
+from container import odf_clear_template_cache as _clear_template_cache
 from content import odf_content
 from manifest import odf_manifest
 from meta import odf_meta
@@ -111,7 +115,12 @@ def _get_part_class(path):
 
 class odf_document(object):
     """Abstraction of the ODF document.
+
+    If "lazy_tables" is True, the tables of the content are only parsed
+    when got by "get_table" or "get_tables", see "odf_content".
     """
+    lazy_tables = False
+
     def __init__(self, container):
         if not isinstance(container, odf_container):
             raise TypeError("container is not an ODF container")
@@ -155,6 +164,8 @@ class odf_document(object):
         part = xmlparts.get(path)
         if part is None:
             xmlparts[path] = part = cls(path, container)
+            if path == ODF_CONTENT:
+                part.lazy_tables = self.lazy_tables
         return part
 
 
@@ -214,6 +225,27 @@ class odf_document(object):
         return self.__body
 
 
+    def iter_body(self, tags=None):
+        """Yield the children of the body, or its elements of the given tag
+        name(s) at any depth, e.g. "text:p", reading the content without
+        building the whole tree. For read-only processing of big documents:
+        the elements are only valid until the next one is yielded.
+
+        Arguments:
+
+            tags -- str or tuple of str
+
+        Return: iterator of odf_element
+
+        Example::
+
+            >>> document = odf_get_document('big.odt', lazy=True)
+            >>> for paragraph in document.iter_body('text:p'):
+            ...     print paragraph.get_text(recursive=True)
+        """
+        return self.get_part(ODF_CONTENT).iter_body(tags)
+
+
     def get_formatted_text(self, rst_mode=False):
         # For the moment, only "type='text'"
         type = self.get_type()
@@ -400,13 +432,15 @@ class odf_document(object):
         Return: odf_document
         """
         clone = object.__new__(self.__class__)
+        # Parts share the container of the document
+        container = self.container.clone()
         for name in self.__dict__:
             if name == 'container':
-                setattr(clone, name, self.container.clone())
+                setattr(clone, name, container)
             elif name == '_odf_document__xmlparts':
                 xmlparts = {}
                 for key, value in self.__xmlparts.iteritems():
-                    xmlparts[key] = value.clone()
+                    xmlparts[key] = value.clone(container)
                 setattr(clone, name, xmlparts)
             else:
                 value = getattr(self, name)
@@ -415,11 +449,13 @@ class odf_document(object):
         return clone
 
 
-    def save(self, target=None, packaging=None, pretty=False, backup=False):
+    def save(self, target=None, packaging=None, pretty=False, backup=False,
+            workers=None, block_size=None, compression=None, level=None,
+            compact=False):
         """Save the document, at the same place it was opened or at the given
         target path. Target can also be a file-like object. It can be saved
-        as a Zip file (default) or a flat XML file (unimplemented). XML parts
-        can be pretty printed.
+        as a Zip file (default) or a flat XML file. XML parts can be pretty
+        printed.
 
         Arguments:
 
@@ -430,18 +466,92 @@ class odf_document(object):
             pretty -- bool
 
             backup -- boolean
+
+            workers -- int, number of threads compressing the Zip parts
+
+            block_size -- int, compress in parallel blocks of that size
+                          within a single part, requires "workers"
+
+            compression -- dict of zlib levels by path, media type or
+                           extension, e.g. {'image/png': 0, '.xml': 9}
+
+            level -- int, zlib level of the other parts, 0 to store them
+
+            compact -- bool, merge the identical adjacent cells, rows and
+                       columns of the tables before
         """
+        if compact:
+            for table in self.get_body().get_tables():
+                table.compact()
         # Some advertising
         meta = self.get_part(ODF_META)
         if not meta._generator_modified:
             meta.set_generator(u"lpOD Python %s" % __version__)
-        # Synchronize data with container
+        # Synchronize data with container, unmodified parts keep their bytes
+        # and the others are written from their tree when saving
         container = self.container
         for path, part in self.__xmlparts.iteritems():
-            if part is not None:
-                container.set_part(path, part.serialize(pretty))
+            if part is not None and (part._modified or pretty):
+                container.set_part_writer(path, partial(part.write,
+                    pretty=pretty))
+                part._modified = False
         # Save the container
-        container.save(target, packaging=packaging, backup=backup)
+        container.save(target, packaging=packaging, backup=backup,
+                workers=workers, block_size=block_size,
+                compression=compression, level=level)
+
+
+    def export_csv(self, dir, delimiter=',', quotechar='"',
+            lineterminator='\n', encoding='utf-8', processes=None):
+        """Write every table of the document as CSV in the given directory,
+        to a file named after the table. Tables of the same file name, once
+        the path separators replaced, get a "_2", "_3", etc. suffix. The
+        tables can be written in parallel by the given number of worker
+        processes.
+
+        Arguments:
+
+            dir -- str
+
+            delimiter -- str
+
+            quotechar -- str
+
+            lineterminator -- str
+
+            encoding -- str
+
+            processes -- int
+
+        Return: list of str, the paths written
+        """
+        options = {'delimiter': delimiter, 'quotechar': quotechar,
+                   'lineterminator': lineterminator, 'encoding': encoding}
+        jobs = []
+        names = set()
+        for table in self.get_body().get_tables():
+            name = table.get_name().replace(u'/', u'_').replace(os.sep, u'_')
+            unique_name = name
+            suffix = 1
+            while unique_name in names:
+                suffix += 1
+                unique_name = u'%s_%d' % (name, suffix)
+            names.add(unique_name)
+            path = os.path.join(dir, unique_name.encode('utf-8') + '.csv')
+            if processes is None:
+                table.to_csv(path, **options)
+                jobs.append(path)
+            else:
+                jobs.append((table.serialize(), path, options))
+        if processes is None:
+            return jobs
+        from table import _export_table_csv
+        pool = Pool(processes)
+        try:
+            return pool.map(_export_table_csv, jobs)
+        finally:
+            pool.close()
+            pool.join()
 
 
     #
@@ -755,10 +865,18 @@ class odf_document(object):
 # odf_document factories
 #
 
-def odf_get_document(path_or_file):
+def odf_get_document(path_or_file, lazy=False, lazy_tables=False):
     """Return an "odf_document" instance of the ODF document stored at the
     given local path or in the given (open) file-like object.
 
+    If "lazy" is True, the file is memory-mapped instead of being read in
+    memory, and only the parts actually used are inflated. Recommended for
+    big documents with many pictures.
+
+    If "lazy_tables" is True, the tables of a spreadsheet are only parsed
+    when got by "get_table" or "get_tables", the others are saved as they
+    were read. Recommended for workbooks with many sheets.
+
     Examples::
 
         >>> document = odf_get_document('/tmp/document.odt')
@@ -766,9 +884,33 @@ def odf_get_document(path_or_file):
         >>> document = odf_get_document(stringio)
         >>> file = urllib.urlopen('http://example.com/document.odt')
         >>> document = odf_get_document(file)
+        >>> document = odf_get_document('/tmp/big.ods', lazy=True)
+        >>> document = odf_get_document('/tmp/big.ods', lazy_tables=True)
+    """
+    container = odf_get_container(path_or_file, lazy=lazy)
+    document = odf_document(container)
+    document.lazy_tables = lazy_tables
+    return document
+
+
+
+# Templates with their styles and content parsed, by path
+_template_documents = {}
+
+
+
+def odf_clear_template_cache(path_or_file=None):
+    """Forget the given template, or all of them, with the documents parsed
+    from them, so it is read again by the next "odf_new_container" or
+    "odf_new_document".
+
+    Templates modified on disk are read again anyway.
     """
-    container = odf_get_container(path_or_file)
-    return odf_document(container)
+    _clear_template_cache(path_or_file)
+    if path_or_file is None:
+        _template_documents.clear()
+    else:
+        _template_documents.pop(_get_template_path(path_or_file), None)
 
 
 
@@ -791,6 +933,19 @@ def odf_new_document(path_or_file):
         >>> document = odf_new_document('text')
 
         >>> document = odf_new_document('spreadsheet')
+
+    Templates are cached with their styles and content parsed, see
+    "odf_clear_template_cache".
     """
-    container = odf_new_container(path_or_file)
-    return odf_document(container)
+    template = _get_template(path_or_file)
+    cached = _template_documents.get(_get_template_path(path_or_file))
+    # Valid as long as the template container itself
+    if cached is not None and cached[0] is template:
+        return cached[1].clone()
+    document = odf_document(template.clone())
+    document.get_part(ODF_STYLES).get_root()
+    document.get_part(ODF_CONTENT).get_root()
+    path = _get_template_path(path_or_file)
+    if path is not None:
+        _template_documents[path] = (template, document)
+    return document.clone()
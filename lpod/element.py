@@ -28,8 +28,9 @@
 
 # Import from the Standard Library
 import sys
-from copy import deepcopy
+from copy import copy, deepcopy
 import re
+from weakref import ref
 
 # Import from lxml
 from lxml.etree import fromstring, tostring, Element, _Element
@@ -205,6 +206,61 @@ def _make_odf_element(native_element, cache=None):
 
 
 
+# XML parts notified of the modifications of their tree, by id of the root
+__tracked_roots = {}
+
+def _track_modifications(native_root, part):
+    """Set "part._modified" when the tree of the given root element is
+    modified through odf_element. The part must keep the root alive.
+    """
+    key = id(native_root)
+    def forget(part_ref):
+        if __tracked_roots.get(key) is part_ref:
+            del __tracked_roots[key]
+    __tracked_roots[key] = ref(part, forget)
+
+
+
+def _set_repeated_attribute(native_element, name, value, repeated):
+    """Set back the attribute of repetition removed to compare the element,
+    with the given number of times when merged.
+    """
+    if repeated > 1:
+        native_element.set(name, str(repeated))
+    elif value is not None:
+        native_element.set(name, value)
+
+
+
+def _set_modified(native_element):
+    """Notify the XML part owning the given element, if any.
+    """
+    if not __tracked_roots:
+        return
+    root = native_element.getroottree().getroot()
+    part_ref = __tracked_roots.get(id(root))
+    if part_ref is not None:
+        part = part_ref()
+        if part is not None:
+            part._modified = True
+
+
+
+def _load_tables(native_element, name=None, count=None):
+    """Let the XML part owning the given element parse the tables it left
+    unloaded, if any. See "odf_content._load_tables".
+    """
+    if not __tracked_roots:
+        return
+    root = native_element.getroottree().getroot()
+    part_ref = __tracked_roots.get(id(root))
+    if part_ref is not None:
+        part = part_ref()
+        if part is not None and hasattr(part, '_load_tables'):
+            part._load_tables(name=name, count=count)
+
+
+
 #
 # Public API
 #
@@ -318,6 +374,8 @@ class odf_element(object):
         """
         current = self.__element
         element = element.__element
+        _set_modified(element)
+        _set_modified(current)
 
         if main_text:
             xpath_text = _xpath_text_main_descendant
@@ -433,6 +491,8 @@ class odf_element(object):
         """
         current = self.__element
         wrapper = element.__element
+        _set_modified(wrapper)
+        _set_modified(current)
         for text in _xpath_text_descendant(current):
             if not from_ in text:
                 continue
@@ -510,6 +570,7 @@ class odf_element(object):
 
     def _set_tag_raw(self, qname):
         element = self.__element
+        _set_modified(element)
         element.tag = '{%s}%s' % _decode_qname(qname)
 
     def set_tag(self, qname):
@@ -524,6 +585,7 @@ class odf_element(object):
         Return: odf_element or a subclass
         """
         element = self.__element
+        _set_modified(element)
         element.tag = '{%s}%s' % _decode_qname(qname)
         return _make_odf_element(element)
 
@@ -548,6 +610,51 @@ class odf_element(object):
             result.append((idx, max(value, 1)))
         return result
 
+
+    def _get_native_elements(self, xpath_instance):
+        """Return the elements of the XML library matched by the XPath, to
+        read many of them without wrapping each one.
+        """
+        return xpath_instance(self.__element)
+
+
+    def _merge_repeated(self, xpath_instance, name):
+        """Merge the adjacent children matched by the XPath which are
+        identical but for their "name" attribute of repetition, adding up
+        this attribute. Return the number of children removed.
+        """
+        uri, name = _decode_qname(name)
+        if uri is not None:
+            name = '{%s}%s' % (uri, name)
+        current = self.__element
+        removed = 0
+        previous = None
+        for sub_element in xpath_instance(current):
+            # Compared without the attribute, set back once the run ends
+            value = sub_element.attrib.pop(name, None)
+            key = tostring(sub_element, with_tail=False)
+            try:
+                repeated = max(int(value), 1)
+            except (TypeError, ValueError):
+                repeated = 1
+            if (previous is not None and key == previous_key
+                    and sub_element.getprevious() is previous):
+                previous_repeated += repeated
+                current.remove(sub_element)
+                removed += 1
+                continue
+            if previous is not None:
+                _set_repeated_attribute(previous, name, previous_value,
+                        previous_repeated)
+            previous, previous_key = sub_element, key
+            previous_value, previous_repeated = value, repeated
+        if previous is not None:
+            _set_repeated_attribute(previous, name, previous_value,
+                    previous_repeated)
+        if removed:
+            _set_modified(current)
+        return removed
+
     def get_elements(self, xpath_query):
         element = self.__element
         if isinstance(xpath_query, XPath):
@@ -588,6 +695,31 @@ class odf_element(object):
             return _make_odf_element(result[0])
         return None
 
+
+    def _get_indexed_element(self, xpath_instance, map, idx):
+        """Return the child at the ODF index "idx" among the children matched
+        by the XPath, from the array of these children kept along their cache
+        map, built on first use.
+        """
+        element = self.__element
+        index = map.elements
+        if index is None or index[0] is not element:
+            index = map.elements = (element, xpath_instance(element))
+        children = index[1]
+        if 0 <= idx < len(children):
+            return _make_odf_element(children[idx])
+        return None
+
+
+    def _set_indexed_elements(self, map, start, stop, elements):
+        """Replace the children from "start" to "stop" in the array kept
+        along the cache map, if built, by the given elements.
+        """
+        index = map.elements
+        if index is None or index[0] is not self.__element:
+            return
+        index[1][start:stop] = [element.__element for element in elements]
+
     def get_attributes(self):
         attributes = {}
         element = self.__element
@@ -612,6 +744,7 @@ class odf_element(object):
 
     def set_attribute(self, name, value):
         element = self.__element
+        _set_modified(element)
         uri, name = _decode_qname(name)
         if uri is not None:
             name = '{%s}%s' % (uri, name)
@@ -636,6 +769,7 @@ class odf_element(object):
 
     def del_attribute(self, name):
         element = self.__element
+        _set_modified(element)
         uri, name = _decode_qname(name)
         if uri is not None:
             name = '{%s}%s' % (uri, name)
@@ -658,6 +792,7 @@ class odf_element(object):
     def set_text(self, text):
         """Set the text content of the element.
         """
+        _set_modified(self.__element)
         try:
             self.__element.text = text
         except TypeError:
@@ -680,6 +815,7 @@ class odf_element(object):
 
         Inspired by lxml.
         """
+        _set_modified(self.__element)
         self.__element.tail = text
 
 
@@ -843,6 +979,7 @@ class odf_element(object):
         # As "get_text_content" returned all text nodes, "set_text_content"
         # will overwrite all text nodes and children that may contain them
         element = paragraph.__element
+        _set_modified(element)
         # Clear but the attributes
         del element[:]
         element.text = text
@@ -1060,6 +1197,8 @@ class odf_element(object):
         child_tag = element.get_tag()
         current = self.__element
         element = element.__element
+        _set_modified(element)
+        _set_modified(current)
         if start:
             text = current.text
             if text is not None:
@@ -1078,13 +1217,13 @@ class odf_element(object):
         elif xmlposition is LAST_CHILD:
             current.append(element)
         elif xmlposition is NEXT_SIBLING:
-            parent = current.getparent()
-            index = parent.index(current)
-            parent.insert(index + 1, element)
+            if current.getparent() is None:
+                raise ValueError("cannot insert next to the root element")
+            current.addnext(element)
         elif xmlposition is PREV_SIBLING:
-            parent = current.getparent()
-            index = parent.index(current)
-            parent.insert(index, element)
+            if current.getparent() is None:
+                raise ValueError("cannot insert next to the root element")
+            current.addprevious(element)
         else:
             raise ValueError("(xml)position must be defined")
 
@@ -1095,13 +1234,26 @@ class odf_element(object):
         if odf_elements:
             current = self.__element
             elements = [ element.__element for element in odf_elements]
+            for element in elements:
+                _set_modified(element)
+            _set_modified(current)
             current.extend(elements)
 
 
+    def _move_children(self, element):
+        """Move the children of the given element at the end of ourself, at
+        once.
+        """
+        current = self.__element
+        _set_modified(current)
+        current.extend(list(element.__element))
+
+
     def append(self, unicode_or_element):
         """Insert element or text in the last position.
         """
         current = self.__element
+        _set_modified(current)
 
         # Unicode ?
         if isinstance(unicode_or_element, unicode):
@@ -1121,6 +1273,7 @@ class odf_element(object):
                 text += unicode_or_element
                 current.text = text
         elif isinstance(unicode_or_element, odf_element):
+            _set_modified(unicode_or_element.__element)
             current.append(unicode_or_element.__element)
         else:
             raise TypeError('odf_element or unicode expected, not "%s"' % (
@@ -1148,6 +1301,7 @@ class odf_element(object):
             child = self
         else:
             parent = self
+        _set_modified(parent.__element)
         if keep_tail and child.__element.tail is not None:
             current = child.__element
             tail = current.tail
@@ -1173,6 +1327,8 @@ class odf_element(object):
         Warning : no clone for old element.
         """
         current = self.__element
+        _set_modified(new_element.__element)
+        _set_modified(current)
         current.replace(old_element.__element, new_element.__element)
 
 
@@ -1307,13 +1463,14 @@ class odf_element(object):
     def clear(self):
         """Remove text, children and attributes from the element.
         """
+        _set_modified(self.__element)
         self.__element.clear()
         if hasattr(self, '_tmap'):
-            self._tmap = []
+            self._tmap = self._tmap.__class__()
         if hasattr(self, '_cmap'):
-            self._cmap = []
+            self._cmap = self._cmap.__class__()
         if hasattr(self, '_rmap'):
-            self._rmap = []
+            self._rmap = self._rmap.__class__()
         if hasattr(self, '_indexes'):
             remember = False
             if '_rmap' in self._indexes:
@@ -1334,10 +1491,11 @@ class odf_element(object):
         root.append(clone)
         if hasattr(self, '_tmap'):
             if hasattr(self, '_rmap'):
-                return self.__class__(clone, (self._tmap[:], self._cmap[:],
-                                              self._rmap[:]))
+                return self.__class__(clone, (copy(self._tmap),
+                    copy(self._cmap), copy(self._rmap)))
             else:
-                return self.__class__(clone, (self._tmap[:], self._cmap[:]))
+                return self.__class__(clone, (copy(self._tmap),
+                    copy(self._cmap)))
         return self.__class__(clone)
 
 
@@ -1770,6 +1928,7 @@ class odf_element(object):
 
         Return: list of odf_table
         """
+        _load_tables(self.__element)
         return _get_elements(self, 'descendant::table:table',
                 table_style=style, content=content)
 
@@ -1787,6 +1946,13 @@ class odf_element(object):
 
         Return: odf_table or None if not found
         """
+        if content is not None or position < 0:
+            _load_tables(self.__element)
+        elif name is not None:
+            _load_tables(self.__element, name=name)
+        else:
+            # Tables before in document order are enough to count
+            _load_tables(self.__element, count=position + 1)
         if name is None and content is None:
             result = self._get_element_idx('descendant::table:table', position)
         else :
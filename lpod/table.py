@@ -28,26 +28,46 @@
 #
 
 # Import from the Standard Library
+from array import array
 from cStringIO import StringIO
-from csv import reader, Sniffer
+from csv import reader, writer, Sniffer, QUOTE_ALL
+from datetime import datetime
+from decimal import Decimal as dec
+from itertools import chain, count, islice, izip
+from json import dumps, loads
+from re import compile, escape, IGNORECASE, UNICODE
+from struct import pack
 from textwrap import wrap
-from bisect import bisect_left, insort
+from bisect import bisect_right
 import string
+from time import localtime, time
+from xml.sax.saxutils import unescape
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, BadZipfile
+from zlib import compress, decompress, decompressobj, Z_DEFAULT_COMPRESSION
+from zlib import error as zlib_error
+
+# Import from lxml
+from lxml.etree import iterparse, XMLPullParser, XMLSyntaxError
 
 # Import from lpod
+from const import ODF_CONTENT
+from container import odf_get_container
+from container import _open_zip_member, _close_zip_member
+from container import _get_zip_member_offset, COPY_CHUNK_SIZE
+from container import DEFLATE_WINDOW_SIZE, SYNC_FLUSH_SIZE
+from content import _xml_root, _xml_start_tag_end, _xml_xmlns_decl
 from datatype import Boolean, Date, DateTime, Duration
+from document import odf_new_document
 from element import odf_create_element, register_element_class, odf_element
-from element import _xpath_compile
+from element import _xpath_compile, _make_odf_element, ODF_NAMESPACES
+from element import NEXT_SIBLING, PREV_SIBLING
 from utils import get_value, _set_value_and_type, isiterable   #, obsolete
 
 
 
 _xpath_row = _xpath_compile('table:table-row')
-_xpath_row_idx = _xpath_compile('(table:table-row)[$idx]')
 _xpath_column = _xpath_compile('table:table-column')
-_xpath_column_idx = _xpath_compile('(table:table-column)[$idx]')
 _xpath_cell = _xpath_compile('(table:table-cell|table:covered-table-cell)')
-_xpath_cell_idx = _xpath_compile('(table:table-cell|table:covered-table-cell)[$idx]')
 
 
 
@@ -174,46 +194,132 @@ def _convert_coordinates(obj):
 
 
 
+def _decode_date_time(data):
+    # Two tests: "yyyy-mm-dd hh:mm:ss" or "yyyy-mm-ddThh:mm:ss"
+    return DateTime.decode(data.replace(' ', 'T'))
+
+
+
+def _decode_boolean(data):
+    # "True" or "False" with a .lower
+    return Boolean.decode(data.lower())
+
+
+
+# Tried in this order, the first one to decode the data wins
+_python_decoders = (int, float, Date.decode, _decode_date_time,
+        Duration.decode, _decode_boolean)
+
+# What int() accepts, and the start of what any other decoder accepts
+_int_pattern = compile(r'\s*[-+]?\d+\s*$', UNICODE)
+_typed_pattern = compile(r'\s*[-+]?(\d|\.\d|inf|nan|P)', IGNORECASE | UNICODE)
+
+
+
+def _guess_python_value(data):
+    """Return the position of the decoder of the most appropriate Python
+    type to load the unicode data, with regard to ODF types, and the value.
+    The position is None for a text.
+    """
+    for idx, decoder in enumerate(_python_decoders):
+        try:
+            return idx, decoder(data)
+        except ValueError:
+            pass
+    # TODO Try some other types ?
+    # So a text
+    return None, data
+
+
+
 def _get_python_value(data, encoding):
     """Try and guess the most appropriate Python type to load the data, with
     regard to ODF types.
     """
-    data = unicode(data, encoding)
-    # An int ?
-    try:
-        return int(data)
-    except ValueError:
-        pass
-    # A float ?
-    try:
-        return float(data)
-    except ValueError:
-        pass
-    # A Date ?
-    try:
-        return Date.decode(data)
-    except ValueError:
-        pass
-    # A DateTime ?
-    try:
-        # Two tests: "yyyy-mm-dd hh:mm:ss" or "yyyy-mm-ddThh:mm:ss"
-        return DateTime.decode(data.replace(' ', 'T'))
-    except ValueError:
-        pass
-    # A Duration ?
-    try:
-        return Duration.decode(data)
-    except ValueError:
-        pass
-    # A Boolean ?
-    try:
-        # "True" or "False" with a .lower
-        return Boolean.decode(data.lower())
-    except ValueError:
-        pass
-    # TODO Try some other types ?
-    # So a text
-    return data
+    return _guess_python_value(unicode(data, encoding))[1]
+
+
+
+def _make_python_decoder(idx):
+    """Return a function giving the same value than "_guess_python_value"
+    from unicode data, but first trying the decoder at position "idx",
+    expected to succeed, or directly returning a text if None.
+    """
+    if idx is None:
+        def decode(data):
+            # Most text can't be anything else
+            if (_typed_pattern.match(data) is None
+                    and data.lower() not in ('true', 'false')):
+                return data
+            return _guess_python_value(data)[1]
+        return decode
+    decoder = _python_decoders[idx]
+    def decode(data):
+        if not data:
+            return data
+        # Some data decoded as a float are integers
+        if idx == 1 and _int_pattern.match(data) is not None:
+            return int(data)
+        try:
+            # The decoders before can't decode what this one does
+            return decoder(data)
+        except ValueError:
+            return _guess_python_value(data)[1]
+    return decode
+
+
+
+def _iter_csv_values(lines, dialect, encoding, sample_size=100):
+    """Yield the lists of Python values read from the CSV lines, the type of
+    each column guessed from the first lines, trailing empty values removed.
+    """
+    rows = reader(lines, dialect)
+    sample = list(islice(rows, sample_size))
+    # Guess a type per column, text if more than one
+    columns = []
+    for line in sample:
+        for x, value in enumerate(line):
+            if x == len(columns):
+                columns.append(set())
+            if value:
+                columns[x].add(_guess_python_value(
+                    unicode(value, encoding))[0])
+    decoders = []
+    for guessed in columns:
+        if guessed == set([0, 1]):
+            guessed = set([1])
+        idx = guessed.pop() if len(guessed) == 1 else None
+        decoders.append(_make_python_decoder(idx))
+    default = _make_python_decoder(None)
+    for line in chain(sample, rows):
+        # rstrip line
+        while line and not line[-1].strip():
+            line.pop()
+        yield [(decoders[x] if x < len(decoders) else default)(
+                   unicode(value, encoding))
+               for x, value in enumerate(line)]
+
+
+
+def _shift_indexes(cache, odf_idx, removed, added):
+    """Update the cache of the items of a vault by ODF index, when "removed"
+    items from "odf_idx" were replaced by "added" new ones. The replaced
+    items are forgotten, the next ones shifted.
+    """
+    stop = odf_idx + removed
+    delta = added - removed
+    if delta == 0:
+        for idx in xrange(odf_idx, stop):
+            cache.pop(idx, None)
+        return
+    moved = []
+    for idx in cache.keys():
+        if idx < odf_idx:
+            continue
+        item = cache.pop(idx)
+        if idx >= stop:
+            moved.append((idx + delta, item))
+    cache.update(moved)
 
 
 
@@ -232,9 +338,8 @@ def _set_item_in_vault(position, item, vault, vault_scheme, vault_map_name, clon
     if odf_idx in cache:
         current_item = cache[odf_idx]
     else:
-        current_item = vault._get_element_idx2(vault_scheme, odf_idx)
-    vault._indexes[vault_map_name] = {}
-    target_idx = vault.index(current_item)
+        current_item = vault._get_indexed_element(vault_scheme, vault_map,
+                odf_idx)
     if odf_idx > 0:
         before_cache = vault_map[odf_idx - 1]
     else:
@@ -243,32 +348,44 @@ def _set_item_in_vault(position, item, vault, vault_scheme, vault_map_name, clon
     current_repeated = current_cache - before_cache
     repeated_before = position - current_pos
     repeated_after = current_repeated - repeated_before - repeated
+    if clone:
+        new_item = item.clone()
+    else:
+        new_item = item
+    if repeated_before == 0 and repeated_after == 0:
+        # Same slot, replace in place
+        vault.replace_element(current_item, new_item)
+        vault._set_indexed_elements(vault_map, odf_idx, odf_idx + 1,
+                [new_item])
+        _shift_indexes(cache, odf_idx, 1, 1)
+        return new_item
+    if repeated_after < 0:
+        # Index the overlapped items before changing the vault
+        vault._get_indexed_element(vault_scheme, vault_map, odf_idx)
     if repeated_before >= 1:
         #Update repetition
         current_item._set_repeated(repeated_before)
-        target_idx += 1
+        # Insert new element
+        current_item.insert(new_item, xmlposition=NEXT_SIBLING)
     else:
         # Replacing the first occurence
-        vault.delete(current_item)
-    # Insert new element
-    if clone:
-        new_item = item.clone()
-    else:
-        new_item = item
-    vault.insert(new_item, position = target_idx)
+        vault.replace_element(current_item, new_item)
     # Insert the remaining repetitions
     if repeated_after >= 1:
         after_item = current_item.clone()
         after_item._set_repeated(repeated_after)
-        vault.insert(after_item, position = target_idx + 1)
+        new_item.insert(after_item, xmlposition=NEXT_SIBLING)
     # setting a repeated item !
     if repeated_after < 0:
         # deleting some overlapped items
         deleting = repeated_after
+        next_idx = odf_idx + 1
         while deleting < 0:
-            delete_item = vault._get_element_idx2(vault_scheme, target_idx + 1)
+            delete_item = vault._get_indexed_element(vault_scheme, vault_map,
+                    next_idx)
             if delete_item is None:
                 break
+            next_idx += 1
             is_repeated = delete_item.get_repeated() or 1
             is_repeated += deleting
             if is_repeated > 1:
@@ -277,6 +394,19 @@ def _set_item_in_vault(position, item, vault, vault_scheme, vault_map_name, clon
                 vault.delete(delete_item)
             deleting = is_repeated
     # update cache
+    if repeated_after < 0:
+        vault._indexes[vault_map_name] = {}
+        vault_map.elements = None
+    else:
+        items = [new_item]
+        if repeated_before >= 1:
+            items.insert(0, current_item)
+        if repeated_after >= 1:
+            items.append(after_item)
+        vault._set_indexed_elements(vault_map, odf_idx, odf_idx + 1, items)
+        _shift_indexes(cache, odf_idx, 1, len(items))
+        if repeated_before >= 1:
+            cache[odf_idx] = current_item
     # remove existing
     idx = odf_idx
     map = _erase_map_once(vault_map, idx)
@@ -313,9 +443,8 @@ def _insert_item_in_vault(position, item, vault, vault_scheme, vault_map_name):
     if odf_idx in cache:
         current_item = cache[odf_idx]
     else:
-        current_item = vault._get_element_idx2(vault_scheme, odf_idx)
-    vault._indexes[vault_map_name] = {}
-    target_idx = vault.index(current_item)
+        current_item = vault._get_indexed_element(vault_scheme, vault_map,
+                odf_idx)
     if odf_idx > 0:
         before_cache = vault_map[odf_idx - 1]
     else:
@@ -327,20 +456,26 @@ def _insert_item_in_vault(position, item, vault, vault_scheme, vault_map_name):
     new_item = item.clone()
     if repeated_before >= 1:
         current_item._set_repeated(repeated_before)
-        vault.insert(new_item, position = target_idx + 1)
+        current_item.insert(new_item, xmlposition=NEXT_SIBLING)
         after_item = current_item.clone()
         after_item._set_repeated(repeated_after)
-        vault.insert(after_item, position = target_idx + 2)
+        new_item.insert(after_item, xmlposition=NEXT_SIBLING)
     else:
         # only insert new cell
-        vault.insert(new_item, position = target_idx)
+        current_item.insert(new_item, xmlposition=PREV_SIBLING)
     # update cache
     if repeated_before >= 1:
+        vault._set_indexed_elements(vault_map, odf_idx, odf_idx + 1,
+                [current_item, new_item, after_item])
+        _shift_indexes(cache, odf_idx, 1, 3)
+        cache[odf_idx] = current_item
         map = _erase_map_once(vault_map, odf_idx)
         map = _insert_map_once(map, odf_idx, repeated_before)
         map = _insert_map_once(map, odf_idx + 1, repeated)
         setattr(vault, vault_map_name, _insert_map_once(map, odf_idx + 2, repeated_after))
     else:
+        vault._set_indexed_elements(vault_map, odf_idx, odf_idx, [new_item])
+        _shift_indexes(cache, odf_idx, 0, 1)
         setattr(vault, vault_map_name, _insert_map_once(vault_map, odf_idx, repeated))
     return new_item
 
@@ -357,8 +492,8 @@ def _delete_item_in_vault(position, vault, vault_scheme, vault_map_name):
     if odf_idx in cache:
         current_item = cache[odf_idx]
     else:
-        current_item = vault._get_element_idx2(vault_scheme, odf_idx)
-    vault._indexes[vault_map_name] = {}
+        current_item = vault._get_indexed_element(vault_scheme, vault_map,
+                odf_idx)
     if odf_idx > 0:
         before_cache = vault_map[odf_idx - 1]
     else:
@@ -366,13 +501,289 @@ def _delete_item_in_vault(position, vault, vault_scheme, vault_map_name):
     current_pos = before_cache + 1
     current_repeated = current_cache - before_cache
     new_repeated = current_repeated - 1
+    vault_map.erase(odf_idx)
     if new_repeated >= 1:
         current_item._set_repeated(new_repeated)
-        setattr(vault, vault_map_name, vault_map[:odf_idx] + [(x - 1) for x in vault_map[odf_idx:]] )
+        vault_map.insert(odf_idx, new_repeated)
     else:
         # actual erase
         vault.delete(current_item)
-        setattr(vault, vault_map_name, vault_map[:odf_idx] + [(x - 1) for x in vault_map[odf_idx + 1:]] )
+        vault._set_indexed_elements(vault_map, odf_idx, odf_idx + 1, [])
+        _shift_indexes(cache, odf_idx, 1, 0)
+
+
+
+class _repeat_map(object):
+    """Cache map of the items (rows, columns or cells) of a table or a row,
+    to find them from the positions they cover with their repetitions.
+
+    Reads like the sorted list of the last position covered by each item,
+    by ODF index: map[odf_idx] is the position of the last repetition of
+    the item.
+
+    Items are kept in blocks, with Fenwick trees of the number of items and
+    of the number of positions in the blocks. So items are found from
+    positions, inserted and erased in O(log n), blocks being bounded.
+
+    "elements" is the array of the items themselves by ODF index, with the
+    element containing them, once built by the container of the map.
+    """
+    block_size = 256
+    elements = None
+
+    def __init__(self, repeated_seq=()):
+        self.__load(repeated_seq)
+
+
+    def __load(self, repeated_seq):
+        block_size = self.block_size
+        blocks = []
+        block = []
+        end = 0
+        for repeated in repeated_seq:
+            if len(block) == block_size:
+                blocks.append(block)
+                block = []
+                end = 0
+            end += repeated or 1
+            block.append(end)
+        blocks.append(block)
+        # In each block, the end of each item from the start of the block
+        self.__blocks = blocks
+        self.__rebuild()
+
+
+    def __rebuild(self):
+        blocks = self.__blocks
+        size = len(blocks)
+        counts = [0] * (size + 1)
+        positions = [0] * (size + 1)
+        for index, block in enumerate(blocks):
+            index += 1
+            counts[index] += len(block)
+            if block:
+                positions[index] += block[-1]
+            parent = index + (index & -index)
+            if parent <= size:
+                counts[parent] += counts[index]
+                positions[parent] += positions[index]
+        self.__counts = counts
+        self.__positions = positions
+        self.__length = sum(len(block) for block in blocks)
+        self.__total = sum(block[-1] for block in blocks if block)
+        step = 1
+        while step * 2 <= size:
+            step *= 2
+        self.__step = step
+
+
+    def __add(self, tree, index, delta):
+        index += 1
+        size = len(tree)
+        while index < size:
+            tree[index] += delta
+            index += index & -index
+
+
+    def __prefix(self, tree, index):
+        """Sum of the first "index" blocks.
+        """
+        result = 0
+        while index > 0:
+            result += tree[index]
+            index -= index & -index
+        return result
+
+
+    def __search(self, tree, value):
+        """Return the block where the sum reaches "value", and the rest of
+        "value" in that block.
+        """
+        index = 0
+        step = self.__step
+        size = len(tree) - 1
+        while step:
+            next = index + step
+            if next <= size and tree[next] <= value:
+                index = next
+                value -= tree[next]
+            step >>= 1
+        return index, value
+
+
+    def __len__(self):
+        return self.__length
+
+
+    def __iter__(self):
+        start = -1
+        for block in self.__blocks:
+            for end in block:
+                yield start + end
+            if block:
+                start += block[-1]
+
+
+    def __getitem__(self, odf_idx):
+        length = self.__length
+        if isinstance(odf_idx, slice):
+            start, stop, step = odf_idx.indices(length)
+            if step != 1:
+                return list(self)[odf_idx]
+            result = []
+            for odf_idx in xrange(start, stop):
+                result.append(self[odf_idx])
+            return result
+        if odf_idx < 0:
+            odf_idx += length
+        if not 0 <= odf_idx < length:
+            raise IndexError, "map index out of range"
+        if odf_idx == length - 1:
+            return self.__total - 1
+        index, local = self.__search(self.__counts, odf_idx)
+        return (self.__prefix(self.__positions, index)
+                + self.__blocks[index][local] - 1)
+
+
+    def __copy__(self):
+        clone = object.__new__(self.__class__)
+        clone.__blocks = [block[:] for block in self.__blocks]
+        clone.__counts = self.__counts[:]
+        clone.__positions = self.__positions[:]
+        clone.__length = self.__length
+        clone.__total = self.__total
+        clone.__step = self.__step
+        return clone
+
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+    def __repr__(self):
+        return '_repeat_map(%r)' % list(self)
+
+
+    def find(self, position):
+        """Return the ODF index of the item covering the given position, or
+        None if after the last one.
+        """
+        if position >= self.__total or not self.__length:
+            return None
+        if position < 0:
+            # Like bisect_left
+            return 0
+        index, rest = self.__search(self.__positions, position)
+        local = bisect_right(self.__blocks[index], rest)
+        return self.__prefix(self.__counts, index) + local
+
+
+    def insert(self, odf_idx, repeated):
+        """Insert an item covering "repeated" positions at the given ODF
+        index.
+        """
+        repeated = repeated or 1
+        length = self.__length
+        if odf_idx < 0 or odf_idx > length:
+            raise IndexError
+        blocks = self.__blocks
+        if odf_idx == length:
+            index = len(blocks) - 1
+            local = len(blocks[index])
+        else:
+            index, local = self.__search(self.__counts, odf_idx)
+        block = blocks[index]
+        if local > 0:
+            end = block[local - 1] + repeated
+        else:
+            end = repeated
+        block.insert(local, end)
+        if local + 1 < len(block):
+            block[local + 1:] = [x + repeated for x in block[local + 1:]]
+        self.__length = length + 1
+        self.__total += repeated
+        block_size = self.block_size
+        if len(block) > 2 * block_size:
+            # Split the block
+            before = block[block_size - 1]
+            blocks[index:index + 1] = [block[:block_size],
+                    [x - before for x in block[block_size:]]]
+            self.__rebuild()
+        else:
+            self.__add(self.__counts, index, 1)
+            self.__add(self.__positions, index, repeated)
+
+
+    def append(self, repeated):
+        self.insert(self.__length, repeated)
+
+
+    def erase(self, odf_idx):
+        """Remove the item at the given ODF index. Return the number of
+        positions it covered.
+        """
+        if odf_idx < 0 or odf_idx >= self.__length:
+            raise IndexError
+        blocks = self.__blocks
+        index, local = self.__search(self.__counts, odf_idx)
+        block = blocks[index]
+        end = block.pop(local)
+        if local > 0:
+            repeated = end - block[local - 1]
+        else:
+            repeated = end
+        if local < len(block):
+            block[local:] = [x - repeated for x in block[local:]]
+        self.__length -= 1
+        self.__total -= repeated
+        if not block and len(blocks) > 1:
+            del blocks[index]
+            self.__rebuild()
+        else:
+            self.__add(self.__counts, index, -1)
+            self.__add(self.__positions, index, -repeated)
+        return repeated
+
+
+    def extend(self, ends):
+        """Append the items of the given last positions, like a list of
+        them.
+        """
+        before = self.__total - 1
+        for end in ends:
+            self.append(end - before)
+            before = end
+
+
+    def clear(self):
+        """Remove all the items.
+        """
+        self.__blocks = [[]]
+        self.__rebuild()
+        self.elements = None
+
+
+    def __delitem__(self, odf_idx):
+        if isinstance(odf_idx, slice):
+            start, stop, step = odf_idx.indices(self.__length)
+            if (start, stop, step) == (0, self.__length, 1):
+                self.clear()
+                return
+            # The blocks are made again from the remaining items
+            repeats = []
+            before = -1
+            for end in self:
+                repeats.append(end - before)
+                before = end
+            del repeats[odf_idx]
+            self.__load(repeats)
+            self.elements = None
+            return
+        self.erase(odf_idx)
 
 
 
@@ -387,21 +798,8 @@ def _insert_map_once(map, odf_idx, repeated):
 
         odf_idx is NOT position (col or row), neither raw XML position, but ODF index
     """
-    repeated = repeated or 1
-    if odf_idx > len(map):
-        raise IndexError
-    if odf_idx > 0 :
-        before = map[odf_idx - 1]
-    else:
-        before = -1
-    juska = before + repeated # aka max position value for item
-    if odf_idx == len(map):
-        insort(map, juska)
-        return map
-    new_map = map[:odf_idx]
-    new_map.append(juska)
-    new_map.extend([(x + repeated) for x in map[odf_idx:]])
-    return new_map
+    map.insert(odf_idx, repeated)
+    return map
 
 
 
@@ -412,15 +810,7 @@ def _erase_map_once(map, odf_idx):
 
             odf_idx  --  index in ODF XML
     """
-    if odf_idx >= len(map):
-        raise IndexError
-    if odf_idx > 0 :
-        before = map[odf_idx - 1]
-    else:
-        before = -1
-    current = map[odf_idx]
-    repeated = current - before
-    map = map[:odf_idx] + [(x - repeated) for x in map[odf_idx + 1:]]
+    map.erase(odf_idx)
     return map
 
 
@@ -428,20 +818,14 @@ def _erase_map_once(map, odf_idx):
 def _make_cache_map(idx_repeated_seq):
     """Build the initial cache map of the table.
     """
-    map = []
-    for odf_idx, repeated in idx_repeated_seq:
-        map = _insert_map_once(map, odf_idx, repeated)
-    return map
+    return _repeat_map(repeated for odf_idx, repeated in idx_repeated_seq)
 
 
 
 def _find_odf_idx(map, position):
     """Find odf_idx in the map from the position (col or row).
     """
-    odf_idx = bisect_left(map, position)
-    if odf_idx < len(map):
-        return odf_idx
-    return None
+    return map.find(position)
 
 
 
@@ -893,8 +1277,8 @@ class odf_row(odf_element):
         if not hasattr(self, '_rmap'):
             self._compute_row_cache()
             if not hasattr(self, '_tmap'):
-                self._tmap = []
-                self._cmap = []
+                self._tmap = _repeat_map()
+                self._cmap = _repeat_map()
         if not hasattr(self, '_indexes'):
             self._indexes={}
             self._indexes['_rmap'] = {}
@@ -995,7 +1379,7 @@ class odf_row(odf_element):
         if isinstance(upper, odf_table):
             upper._compute_table_cache()
             if hasattr(self, '_tmap'):
-                del self._tmap[:]
+                self._tmap.clear()
                 self._tmap.extend(upper._tmap)
             else:
                 self._tmap = upper._tmap
@@ -1034,7 +1418,7 @@ class odf_row(odf_element):
         return w
 
 
-    def traverse(self, start=None, end=None):
+    def traverse(self, start=None, end=None, clone=True):
         """Yield as many cell elements as expected cells in the row, i.e.
         expand repetitions by returning the same cell as many times as
         necessary.
@@ -1045,7 +1429,13 @@ class odf_row(odf_element):
 
                 end -- int
 
+                clone -- bool
+
         Copies are returned, use ``set_cell`` to push them back.
+
+        If clone is False, the cells of the row are returned, the same one
+        for each repetition with x updated: read-only, clone them to modify
+        them or keep them.
         """
         idx = -1
         before = -1
@@ -1056,7 +1446,8 @@ class odf_row(odf_element):
                 if idx in self._indexes['_rmap']:
                     cell = self._indexes['_rmap'][idx]
                 else:
-                    cell = self._get_element_idx2(_xpath_cell_idx, idx)
+                    cell = self._get_indexed_element(_xpath_cell,
+                            self._rmap, idx)
                     self._indexes['_rmap'][idx] = cell
                 repeated = juska - before
                 before = juska
@@ -1064,7 +1455,7 @@ class odf_row(odf_element):
                     # Return a copy without the now obsolete repetition
                     if cell is None:
                         cell = odf_create_cell()
-                    else:
+                    elif clone:
                         cell = cell.clone()
                         if repeated > 1:
                             cell.set_repeated(None)
@@ -1094,7 +1485,8 @@ class odf_row(odf_element):
                 if idx in self._indexes['_rmap']:
                     cell = self._indexes['_rmap'][idx]
                 else:
-                    cell = self._get_element_idx2(_xpath_cell_idx, idx)
+                    cell = self._get_indexed_element(_xpath_cell,
+                            self._rmap, idx)
                     self._indexes['_rmap'][idx] = cell
                 repeated = juska - before
                 before = juska
@@ -1102,7 +1494,7 @@ class odf_row(odf_element):
                     if x <= end:
                         if cell is None:
                             cell = odf_create_cell()
-                        else:
+                        elif clone:
                             cell = cell.clone()
                             if repeated > 1 or (x == start and start > 0):
                                 cell.set_repeated(None)
@@ -1176,7 +1568,8 @@ class odf_row(odf_element):
             if idx in self._indexes['_rmap']:
                 cell = self._indexes['_rmap'][idx]
             else:
-                cell = self._get_element_idx2(_xpath_cell_idx, idx)
+                cell = self._get_indexed_element(_xpath_cell,
+                            self._rmap, idx)
                 self._indexes['_rmap'][idx] = cell
             return cell
         return None
@@ -1248,7 +1641,7 @@ class odf_row(odf_element):
             cell_back = self.append_cell(cell, _repeated=repeated, clone=clone)
         else:
             # Inside the defined row
-            _set_item_in_vault(x, cell, self, _xpath_cell_idx, '_rmap', clone=clone)
+            _set_item_in_vault(x, cell, self, _xpath_cell, '_rmap', clone=clone)
             cell.x = x
             cell.y = self.y
             cell_back = cell
@@ -1302,7 +1695,7 @@ class odf_row(odf_element):
         # Outside the defined row
         diff = x - self.get_width()
         if diff < 0:
-            _insert_item_in_vault(x, cell, self, _xpath_cell_idx, '_rmap')
+            _insert_item_in_vault(x, cell, self, _xpath_cell, '_rmap')
             cell.x = x
             cell.y = self.y
             cell_back = cell
@@ -1341,7 +1734,9 @@ class odf_row(odf_element):
         self._append(cell)
         if _repeated is None:
             _repeated = cell.get_repeated() or 1
-        self._rmap = _insert_map_once(self._rmap, len(self._rmap), _repeated)
+        odf_idx = len(self._rmap)
+        self._set_indexed_elements(self._rmap, odf_idx, odf_idx, [cell])
+        self._rmap = _insert_map_once(self._rmap, odf_idx, _repeated)
         cell.x = self.get_width() - 1
         cell.y = self.y
         return cell
@@ -1364,7 +1759,7 @@ class odf_row(odf_element):
         x = self._translate_x_from_any(x)
         if x >= self.get_width():
             return
-        _delete_item_in_vault(x, self, _xpath_cell_idx, '_rmap')
+        _delete_item_in_vault(x, self, _xpath_cell, '_rmap')
 
 
     def get_values(self, coord=None, cell_type=None,
@@ -1408,7 +1803,7 @@ class odf_row(odf_element):
         if cell_type:
             cell_type = cell_type.lower().strip()
             values = []
-            for cell in self.traverse(start = x, end = z):
+            for cell in self.traverse(start = x, end = z, clone=False):
                 # Filter the cells by cell_type
                 ctype = cell.get_type()
                 if not ctype or not (ctype == cell_type or cell_type == 'all'):
@@ -1422,7 +1817,8 @@ class odf_row(odf_element):
             return values
         else:
             return [ cell.get_value(get_type = get_type)
-                                for cell in self.traverse(start = x, end = z) ]
+                                for cell in self.traverse(start = x, end = z,
+                                                          clone=False) ]
 
 
     def set_cells(self, cells=[], start=0, clone=True):
@@ -1470,17 +1866,18 @@ class odf_row(odf_element):
 
             style -- cell style
         """
-        # fixme : if values n, n+ are same, use repeat
         if start is None:
             start = 0
         else:
             start = self._translate_x_from_any(start)
         if start == 0 and (len(values) >= self.get_width()):
             self.clear()
-            cells = ([odf_create_cell(value, style=style,
-                    cell_type=cell_type, currency=currency)
-                    for value in values])
-            self.extend_cells(cells)
+            if values:
+                # Identical adjacent cells are repeated
+                row, width = _row_encoder().get_row(values, cell_style=style,
+                        cell_type=cell_type, currency=currency)
+                self._move_children(odf_create_element(row))
+            self._compute_row_cache()
         else:
             x = start
             for value in values:
@@ -1506,6 +1903,20 @@ class odf_row(odf_element):
         self._indexes['_rmap'] = {}
 
 
+    def compact(self):
+        """Merge *in-place* the adjacent cells which are identical into
+        repeated cells.
+
+        Return: int, the number of cells removed
+        """
+        removed = self._merge_repeated(_xpath_cell,
+                'table:number-columns-repeated')
+        if removed:
+            self._compute_row_cache()
+            self._indexes['_rmap'] = {}
+        return removed
+
+
     def is_empty(self, aggressive=False):
         """Return whether every cell in the row has no value or the value
         evaluates to False (empty string), and no style.
@@ -1608,7 +2019,7 @@ class odf_column(odf_element):
         if isinstance(upper, odf_table):
             upper._compute_table_cache()
             if hasattr(self, '_cmap'):
-                del self._cmap[:]
+                self._cmap.clear()
                 self._cmap.extend(upper._cmap)
             else:
                 self._cmap = upper._cmap
@@ -1634,6 +2045,13 @@ class odf_column(odf_element):
 
 
 class odf_table(odf_element):
+    # Number of rows parsed at once by set_values
+    bulk_rows = 1024
+    # Number of rows written at once by to_csv
+    csv_rows = 1024
+    # Number of values kept decoded by to_csv
+    csv_cache_size = 4096
+
     #
     # Private API
     #
@@ -1809,8 +2227,8 @@ class odf_table(odf_element):
 
     def __get_formatted_text_normal(self, context):
         result = []
-        for row in self.traverse():
-            for cell in row.traverse():
+        for row in self.traverse(clone=False):
+            for cell in row.traverse(clone=False):
                 value = get_value(cell, try_get_text=False)
                 # None ?
                 if value is None:
@@ -1837,9 +2255,9 @@ class odf_table(odf_element):
         rows = []
         cols_nb = 0
         cols_size = {}
-        for odf_row in table.traverse():
+        for odf_row in table.traverse(clone=False):
             row = []
-            for i, cell in enumerate(odf_row.traverse()):
+            for i, cell in enumerate(odf_row.traverse(clone=False)):
                 value = get_value(cell, try_get_text=False)
                 # None ?
                 if value is None:
@@ -2134,7 +2552,7 @@ class odf_table(odf_element):
         else:
             x = y = z = t = None
         data = []
-        for row in self.traverse(start = y, end = t):
+        for row in self.traverse(start = y, end = t, clone=False):
             if z is None:
                 width = self.get_width()
             else:
@@ -2184,7 +2602,7 @@ class odf_table(odf_element):
             x, y, z, t = self._translate_table_coordinates(coord)
         else:
             x = y = z = t = None
-        for row in self.traverse(start = y, end = t):
+        for row in self.traverse(start = y, end = t, clone=False):
             if z is None:
                 width = self.get_width()
             else:
@@ -2203,6 +2621,164 @@ class odf_table(odf_element):
             yield values
 
 
+    def to_columns(self, coord=None):
+        """Get the values of the table column by column, in compact arrays,
+        read in one pass over the rows and cells, repetitions expanded by
+        copying the arrays.
+
+        Filter by coordinates will parse the area defined by the coordinates.
+
+        Each column is a tuple (type, values, nulls), with "type" the ODF
+        type of its values, and "nulls" an array('B') of bits, the bit
+        y & 7 of the byte y >> 3 set for an empty cell at y. The values
+        depend on the type:
+
+            'float' -- array('d') of float, for percentages and currencies
+                       too
+
+            'date' -- array('l') of ordinals (datetime.toordinal())
+
+            'boolean' -- array('b') of 0 and 1
+
+            'string' -- list of unicode, the same object for equal strings
+
+            'time', 'mixed' -- list of Python values like get_value, but
+                               float for numbers
+
+            None -- list of None, for an empty column
+
+        Empty cells are 0 in arrays, None in lists.
+
+        Arguments:
+
+            coord -- str or tuple of int : coordinates of area
+
+        Return: list of tuples
+        """
+        if coord:
+            x, y, z, t = self._translate_table_coordinates(coord)
+        else:
+            x = y = z = t = None
+        width = self.get_width()
+        height = self.get_height()
+        if x is None:
+            x = 0
+        if y is None:
+            y = 0
+        if z is None or z >= width:
+            z = width - 1
+        if t is None or t >= height:
+            t = height - 1
+        if x > z or y > t:
+            return []
+        table = ODF_NAMESPACES['table']
+        office = ODF_NAMESPACES['office']
+        cell_tags = ('{%s}table-cell' % table, '{%s}covered-table-cell' % table)
+        rows_repeated_attr = '{%s}number-rows-repeated' % table
+        columns_repeated_attr = '{%s}number-columns-repeated' % table
+        value_type_attr = '{%s}value-type' % office
+        value_attr = '{%s}value' % office
+        date_attr = '{%s}date-value' % office
+        boolean_attr = '{%s}boolean-value' % office
+        # Runs of (type, value, count) by column
+        columns = [[] for i in xrange(z - x + 1)]
+        strings = {}
+        row_y = 0
+        for row in self._get_native_elements(_xpath_row):
+            repeated = int(row.get(rows_repeated_attr, 1))
+            count = min(row_y + repeated - 1, t) - max(row_y, y) + 1
+            row_y += repeated
+            if count < 1:
+                if row_y > t:
+                    break
+                continue
+            cell_x = 0
+            last = -1
+            for cell in row.iterchildren(*cell_tags):
+                repeated = int(cell.get(columns_repeated_attr, 1))
+                start = max(cell_x, x)
+                cell_x += repeated
+                stop = min(cell_x - 1, z)
+                if start > stop:
+                    if cell_x > z:
+                        break
+                    continue
+                value_type = cell.get(value_type_attr)
+                if value_type is None:
+                    value = None
+                elif value_type in ('float', 'percentage', 'currency'):
+                    value_type = 'float'
+                    value = float(cell.get(value_attr))
+                elif value_type == 'date':
+                    value = cell.get(date_attr)
+                    if 'T' in value:
+                        value_type = 'mixed'
+                        value = DateTime.decode(value)
+                    else:
+                        value = datetime(int(value[:4]), int(value[5:7]),
+                                         int(value[8:10]))
+                elif value_type == 'boolean':
+                    value = cell.get(boolean_attr) == 'true'
+                else:
+                    value = get_value(odf_element(cell))
+                    if value_type == 'string':
+                        if value is None:
+                            value = u''
+                        value = strings.setdefault(value, value)
+                run = (value_type, value, count)
+                for i in xrange(start - x, stop - x + 1):
+                    columns[i].append(run)
+                last = stop - x
+            # Missing cells at the end of the row
+            run = (None, None, count)
+            for i in xrange(last + 1, len(columns)):
+                columns[i].append(run)
+        # Missing rows at the end of the table
+        count = t - max(row_y, y) + 1
+        if count > 0:
+            run = (None, None, count)
+            for runs in columns:
+                runs.append(run)
+        result = []
+        for runs in columns:
+            types = set(value_type for value_type, value, count in runs)
+            types.discard(None)
+            if len(types) == 1:
+                column_type = types.pop()
+            elif types:
+                column_type = 'mixed'
+            else:
+                column_type = None
+            if column_type == 'float':
+                values = array('d')
+                default = 0.0
+            elif column_type == 'date':
+                values = array('l')
+                default = 0
+            elif column_type == 'boolean':
+                values = array('b')
+                default = 0
+            else:
+                values = []
+                default = None
+            nulls = array('B', '\0' * ((t - y + 8) // 8))
+            position = 0
+            for value_type, value, count in runs:
+                if value_type is None:
+                    for i in xrange(position, position + count):
+                        nulls[i >> 3] |= 1 << (i & 7)
+                    value = default
+                elif column_type == 'date':
+                    value = value.toordinal()
+                position += count
+                if type(values) is list:
+                    values.extend([value] * count)
+                else:
+                    values.extend(array(values.typecode, [value]) * count)
+            result.append((column_type, values, nulls))
+        return result
+
+
     def set_values(self, values, coord=None, style=None, cell_type=None,
                    currency=None):
         """set the value of cells in the table, from the 'coord' position
@@ -2237,23 +2813,138 @@ class odf_table(odf_element):
             x, y = self._translate_cell_coordinates(coord)
         else:
             x = y = 0
+        if x is None:
+            x = 0
         if y is None:
             y = 0
-        y -= 1
+        values = iter(values)
+        height = self.get_height()
+        if y < height and not self.__is_empty_from(y):
+            for row_values in islice(values, height - y):
+                if row_values:
+                    row = self.get_row(y, clone=True)
+                    row.set_repeated(None)
+                    row.set_values(row_values, start=x, cell_type=cell_type,
+                                   currency=currency, style=style)
+                    self.set_row(y, row, clone=False)
+                    self.__update_width(row)
+                y += 1
+            if y < height:
+                return
+        # The rows below are empty or new
+        self.__append_values(values, x, y, style, cell_type, currency)
+
+    #set_table_values = obsolete('set_table_values', set_values)
+
+
+    def __is_empty_from(self, y):
+        """Tell whether the rows from "y" to the end of the table are empty,
+        without attributes or cells with a style or a value.
+        """
+        for idx in xrange(_find_odf_idx(self._tmap, y), len(self._tmap)):
+            row = self._get_indexed_element(_xpath_row, self._tmap, idx)
+            attributes = row.get_attributes()
+            attributes.pop('table:number-rows-repeated', None)
+            if attributes or not row.is_empty():
+                return False
+        return True
+
+
+    def __append_values(self, values, x, y, style, cell_type, currency):
+        """Set the rows of values from "y", the rows from there being empty,
+        building them directly as XML with identical adjacent cells and rows
+        repeated.
+        """
+        height = self.get_height()
+        # The empty rows from "y" are put back after the new ones
+        tail = []
+        if y < height:
+            odf_idx = _find_odf_idx(self._tmap, y)
+            tail = [self._get_indexed_element(_xpath_row, self._tmap, idx)
+                    for idx in xrange(odf_idx, len(self._tmap))]
+            if odf_idx > 0:
+                start = self._tmap[odf_idx - 1] + 1
+            else:
+                start = 0
+            split = None
+            if start < y:
+                # The run of rows is split at "y", its first part stays
+                split = tail.pop(0)
+                rest = split.clone()
+                rest._set_repeated(self._tmap[odf_idx] - y + 1)
+            for row in tail:
+                self.delete(row)
+            if split is not None:
+                split.set_repeated(y - start)
+                tail.insert(0, rest)
+            empty_rows = 0
+        else:
+            empty_rows = y - height
+        encoder = _row_encoder()
+        set_row_repeated = encoder.set_row_repeated
+        empty_row = '<table:table-row><table:table-cell/></table:table-row>'
+        data = []
+        previous = None
+        repeated = 0
+        count = 0
+        width = 0
         for row_values in values:
-            y += 1
             if not row_values:
+                empty_rows += 1
                 continue
-            row = self.get_row(y, clone=True)
-            repeated =  row.get_repeated or 1
-            if repeated >= 2:
-                row.set_repeated(None)
-            row.set_values(row_values, start=x, cell_type=cell_type,
-                           currency=currency, style=style)
-            self.set_row(y, row, clone=False)
-            self.__update_width(row)
-
-    #set_table_values = obsolete('set_table_values', set_values)
+            row, row_width = encoder.get_row(row_values, cell_style=style,
+                    cell_type=cell_type, currency=currency, start=x)
+            width = max(width, row_width)
+            if empty_rows:
+                if previous == empty_row:
+                    repeated += empty_rows
+                else:
+                    if previous is not None:
+                        data.append(set_row_repeated(previous, repeated))
+                        count += repeated
+                    previous = empty_row
+                    repeated = empty_rows
+                empty_rows = 0
+            if row == previous:
+                repeated += 1
+                continue
+            if previous is not None:
+                data.append(set_row_repeated(previous, repeated))
+                count += repeated
+                if len(data) >= self.bulk_rows:
+                    self._move_children(odf_create_element(
+                        '<table:table-rows>%s</table:table-rows>'
+                        % ''.join(data)))
+                    del data[:]
+            previous = row
+            repeated = 1
+        if previous is not None:
+            data.append(set_row_repeated(previous, repeated))
+            count += repeated
+        if data:
+            self._move_children(odf_create_element(
+                '<table:table-rows>%s</table:table-rows>' % ''.join(data)))
+        # Put back what remains of the empty rows below
+        for row in tail:
+            repeated = row.get_repeated() or 1
+            if count >= repeated:
+                count -= repeated
+                continue
+            row.set_repeated(repeated - count)
+            count = 0
+            self._append(row)
+        self._compute_table_cache()
+        self._indexes['_tmap'] = {}
+        # Update width if necessary
+        if not width:
+            return
+        if not self._get_columns():
+            self.insert(odf_create_column(repeated=width), position=0)
+            self._compute_table_cache()
+            return
+        diff = width - self.get_width()
+        if diff > 0:
+            self.append_column(odf_create_column(repeated=diff))
 
 
     def rstrip(self, aggressive=False):
@@ -2307,6 +2998,29 @@ class odf_table(odf_element):
     #rstrip_table = obsolete('rstrip_table', rstrip)
 
 
+    def compact(self):
+        """Merge *in-place* the adjacent cells, rows and columns which are
+        identical into repeated ones, e.g. after splitting them by many
+        edits. The size and the values of the table are not changed.
+
+        Return: int, the number of elements removed
+        """
+        removed = 0
+        for row in self._get_rows():
+            removed += row._merge_repeated(_xpath_cell,
+                    'table:number-columns-repeated')
+        # Rows are compared once their cells are merged
+        removed += self._merge_repeated(_xpath_row,
+                'table:number-rows-repeated')
+        removed += self._merge_repeated(_xpath_column,
+                'table:number-columns-repeated')
+        if removed:
+            self._compute_table_cache()
+            self._indexes['_cmap'] = {}
+            self._indexes['_tmap'] = {}
+        return removed
+
+
     def transpose(self, coord=None):
         """Swap *in-place* rows and columns of the table.
 
@@ -2394,7 +3108,7 @@ class odf_table(odf_element):
         return self.get_elements(_xpath_row)
 
 
-    def traverse(self, start=None, end=None):
+    def traverse(self, start=None, end=None, clone=True):
         """Yield as many row elements as expected rows in the table, i.e.
         expand repetitions by returning the same row as many times as
         necessary.
@@ -2405,7 +3119,13 @@ class odf_table(odf_element):
 
                 end -- int
 
+                clone -- bool
+
         Copies are returned, use ``set_row`` to push them back.
+
+        If clone is False, the rows of the table are returned, the same one
+        for each repetition with y updated: read-only, clone them to modify
+        them or keep them.
         """
         idx = -1
         before = -1
@@ -2416,11 +3136,17 @@ class odf_table(odf_element):
                 if idx in self._indexes['_tmap']:
                     row = self._indexes['_tmap'][idx]
                 else:
-                    row = self._get_element_idx2(_xpath_row_idx, idx)
+                    row = self._get_indexed_element(_xpath_row,
+                            self._tmap, idx)
                     self._indexes['_tmap'][idx] = row
                 repeated = juska - before
                 before = juska
                 for i in xrange(repeated or 1):
+                    if not clone:
+                        row.y = y
+                        y += 1
+                        yield row
+                        continue
                     # Return a copy without the now obsolete repetition
                     row = row.clone()
                     row.y = y
@@ -2450,12 +3176,18 @@ class odf_table(odf_element):
                 if idx in self._indexes['_tmap']:
                     row = self._indexes['_tmap'][idx]
                 else:
-                    row = self._get_element_idx2(_xpath_row_idx, idx)
+                    row = self._get_indexed_element(_xpath_row,
+                            self._tmap, idx)
                     self._indexes['_tmap'][idx] = row
                 repeated = juska - before
                 before = juska
                 for i in xrange(repeated or 1):
                     if y <= end:
+                        if not clone:
+                            row.y = y
+                            y += 1
+                            yield row
+                            continue
                         row = row.clone()
                         row.y = y
                         y += 1
@@ -2515,7 +3247,8 @@ class odf_table(odf_element):
             if idx in self._indexes['_tmap']:
                 row = self._indexes['_tmap'][idx]
             else:
-                row = self._get_element_idx2(_xpath_row_idx, idx)
+                row = self._get_indexed_element(_xpath_row,
+                            self._tmap, idx)
                 self._indexes['_tmap'][idx] = row
             return row
         return None
@@ -2573,7 +3306,7 @@ class odf_table(odf_element):
             row_back = self.append_row(row, _repeated=repeated, clone=clone)
         else:
             # Inside the defined table
-            row_back = _set_item_in_vault(y, row, self, _xpath_row_idx, '_tmap', clone=clone)
+            row_back = _set_item_in_vault(y, row, self, _xpath_row, '_tmap', clone=clone)
         #print self.serialize(True)
         # Update width if necessary
         self.__update_width(row_back)
@@ -2602,7 +3335,7 @@ class odf_table(odf_element):
         y = self._translate_y_from_any(y)
         diff = y - self.get_height()
         if diff < 0:
-            row_back = _insert_item_in_vault(y, row, self, _xpath_row_idx, '_tmap')
+            row_back = _insert_item_in_vault(y, row, self, _xpath_row, '_tmap')
         elif diff == 0:
             row_back = self.append_row(row, clone=clone)
         else:
@@ -2626,7 +3359,7 @@ class odf_table(odf_element):
         self._compute_table_cache()
         # Update width if necessary
         width = self.get_width()
-        for row in self.traverse():
+        for row in self.traverse(clone=False):
             if row.get_width() > width:
                 width = row.get_width()
         diff = width - self.get_width()
@@ -2661,7 +3394,9 @@ class odf_table(odf_element):
         self._append(row)
         if _repeated is None:
             _repeated = row.get_repeated() or 1
-        self._tmap = _insert_map_once(self._tmap, len(self._tmap), _repeated)
+        odf_idx = len(self._tmap)
+        self._set_indexed_elements(self._tmap, odf_idx, odf_idx, [row])
+        self._tmap = _insert_map_once(self._tmap, odf_idx, _repeated)
         row.y = self.get_height() - 1
         # Initialize columns
         if not self._get_columns():
@@ -2688,7 +3423,7 @@ class odf_table(odf_element):
         if y >= self.get_height():
             return
         # Inside the defined table
-        _delete_item_in_vault(y, self, _xpath_row_idx, '_tmap')
+        _delete_item_in_vault(y, self, _xpath_row, '_tmap')
 
 
     def get_row_values(self, y, cell_type=None, complete=True,
@@ -2832,7 +3567,7 @@ class odf_table(odf_element):
         else:
             x = y = z = t = None
         cells = []
-        for row in self.traverse(start = y, end = t):
+        for row in self.traverse(start = y, end = t, clone=False):
             row_cells = row.get_cells(coord = (x, z), cell_type=cell_type,
                                             style=style, content=content)
             if flat:
@@ -3195,7 +3930,8 @@ class odf_table(odf_element):
                 if idx in self._indexes['_cmap']:
                     column = self._indexes['_cmap'][idx]
                 else:
-                    column = self._get_element_idx2(_xpath_column_idx, idx)
+                    column = self._get_indexed_element(_xpath_column,
+                            self._cmap, idx)
                     self._indexes['_cmap'][idx] = column
                 repeated = juska - before
                 before = juska
@@ -3229,7 +3965,8 @@ class odf_table(odf_element):
                 if idx in self._indexes['_cmap']:
                     column = self._indexes['_cmap'][idx]
                 else:
-                    column = self._get_element_idx2(_xpath_column_idx, idx)
+                    column = self._get_indexed_element(_xpath_column,
+                            self._cmap, idx)
                     self._indexes['_cmap'][idx] = column
                 repeated = juska - before
                 before = juska
@@ -3278,7 +4015,8 @@ class odf_table(odf_element):
         # Inside the defined table
         odf_idx = _find_odf_idx(self._cmap, x)
         if odf_idx is not None:
-            column = self._get_element_idx2(_xpath_column_idx, odf_idx)
+            column = self._get_indexed_element(_xpath_column,
+                    self._cmap, odf_idx)
             # fixme : no clone here => change doc and unit tests
             return column.clone()
             #return row
@@ -3336,7 +4074,7 @@ class odf_table(odf_element):
             column_back = self.append_column(column, _repeated = repeated)
         else:
             # Inside the defined table
-            column_back = _set_item_in_vault(x, column, self, _xpath_column_idx, '_cmap')
+            column_back = _set_item_in_vault(x, column, self, _xpath_column, '_cmap')
         return column_back
 
 
@@ -3360,7 +4098,7 @@ class odf_table(odf_element):
         x = self._translate_x_from_any(x)
         diff = x - self.get_width()
         if diff < 0:
-            column_back = _insert_item_in_vault(x, column, self, _xpath_column_idx, '_cmap')
+            column_back = _insert_item_in_vault(x, column, self, _xpath_column, '_cmap')
         elif diff == 0:
             column_back = self.append_column(column.clone())
         else:
@@ -3399,14 +4137,17 @@ class odf_table(odf_element):
             position = 0
         else:
             odf_idx = len(self._cmap) - 1
-            last_column = self._get_element_idx2(_xpath_column_idx, odf_idx)
+            last_column = self._get_indexed_element(_xpath_column,
+                    self._cmap, odf_idx)
             position = self.index(last_column) + 1
         column.x = self.get_width()
         self.insert(column, position = position)
         # Repetitions are accepted
         if _repeated is None:
             _repeated = column.get_repeated() or 1
-        self._cmap = _insert_map_once(self._cmap, len(self._cmap), _repeated)
+        odf_idx = len(self._cmap)
+        self._set_indexed_elements(self._cmap, odf_idx, odf_idx, [column])
+        self._cmap = _insert_map_once(self._cmap, odf_idx, _repeated)
         # No need to update row widths
         return column
 
@@ -3427,7 +4168,7 @@ class odf_table(odf_element):
         if x >= self.get_width():
             return
         # Inside the defined table
-        _delete_item_in_vault(x, self, _xpath_column_idx, '_cmap')
+        _delete_item_in_vault(x, self, _xpath_column, '_cmap')
         # Update width
         width = self.get_width()
         for row in self._get_rows():
@@ -3467,10 +4208,10 @@ class odf_table(odf_element):
             cell_type = cell_type.lower().strip()
         cells = []
         if not style and not content and not cell_type:
-            for row in self.traverse():
+            for row in self.traverse(clone=False):
                 cells.append(row.get_cell(x, clone=True))
             return cells
-        for row in self.traverse():
+        for row in self.traverse(clone=False):
             cell = row.get_cell(x, clone=True)
         # Filter the cells by cell_type
             if cell_type:
@@ -3856,6 +4597,57 @@ class odf_table(odf_element):
     # Utilities
     #
 
+    def __iter_csv_fields(self, encoding):
+        """Yield the values of each row of the table as encoded strings, and
+        the number of times the row is repeated. The cells are read directly,
+        a value decoded once for identical cells.
+        """
+        table = ODF_NAMESPACES['table']
+        office = ODF_NAMESPACES['office']
+        cell_tags = ('{%s}table-cell' % table, '{%s}covered-table-cell' % table)
+        rows_repeated_attr = '{%s}number-rows-repeated' % table
+        columns_repeated_attr = '{%s}number-columns-repeated' % table
+        value_type_attr = '{%s}value-type' % office
+        value_attrs = {
+            'float': '{%s}value' % office,
+            'percentage': '{%s}value' % office,
+            'currency': '{%s}value' % office,
+            'date': '{%s}date-value' % office,
+            'time': '{%s}time-value' % office,
+            'boolean': '{%s}boolean-value' % office,
+            'string': '{%s}string-value' % office}
+        width = self.get_width()
+        fields = {}
+        for row in self._get_native_elements(_xpath_row):
+            repeated = int(row.get(rows_repeated_attr, 1))
+            values = []
+            for cell in row.iterchildren(*cell_tags):
+                cell_repeated = int(cell.get(columns_repeated_attr, 1))
+                value_type = cell.get(value_type_attr)
+                if value_type is None:
+                    values.extend([''] * cell_repeated)
+                    continue
+                key = (value_type, cell.get(value_attrs.get(value_type, '')))
+                field = fields.get(key)
+                if field is None:
+                    value = get_value(odf_element(cell))
+                    if isinstance(value, unicode):
+                        field = value.encode(encoding).strip()
+                    elif value is None:
+                        field = ''
+                    else:
+                        field = str(value)
+                    # Texts not in an attribute are read each time
+                    if key[1] is not None:
+                        if len(fields) == self.csv_cache_size:
+                            fields.clear()
+                        fields[key] = field
+                values.extend([field] * cell_repeated)
+            if len(values) < width:
+                values.extend([''] * (width - len(values)))
+            yield values, repeated
+
+
     def to_csv(self, path_or_file=None, delimiter=',', quotechar='"',
             lineterminator='\n', encoding='utf-8'):
         """
@@ -3863,6 +4655,9 @@ class odf_table(odf_element):
         opened as a local path. Else a open file-like is expected; it will not
         be closed afterwards.
 
+        The cells are read directly from the XML and the lines written
+        through the csv module by chunks.
+
         Arguments:
 
             path_or_file -- str or file-like
@@ -3886,19 +4681,31 @@ class odf_table(odf_element):
         # Open file
         else:
             file = path_or_file
-        quoted = quotechar * 2
-        for values in self.iter_values():
-            line = []
-            for value in values:
-                # Also testing lxml.etree._ElementUnicodeResult
-                if type(value) is unicode:
-                    value = value.encode(encoding)
-                if type(value) is str:
-                    value = value.strip()
-                value = '' if value is None else str(value)
-                value = value.replace(quotechar, quoted)
-                line.append(quotechar + value + quotechar)
-            file.write(delimiter.join(line) + lineterminator)
+        buffer = StringIO()
+        if len(delimiter) == 1 and len(quotechar) == 1:
+            write_rows = writer(buffer, delimiter=delimiter,
+                    quotechar=quotechar, lineterminator=lineterminator,
+                    quoting=QUOTE_ALL).writerows
+        else:
+            # Beyond what the csv module accepts
+            quoted = quotechar * 2
+            def write_rows(rows):
+                for fields in rows:
+                    buffer.write(delimiter.join(
+                        [quotechar + field.replace(quotechar, quoted)
+                         + quotechar for field in fields]) + lineterminator)
+        rows = []
+        for fields, repeated in self.__iter_csv_fields(encoding):
+            for i in xrange(repeated):
+                rows.append(fields)
+                if len(rows) == self.csv_rows:
+                    write_rows(rows)
+                    del rows[:]
+                    file.write(buffer.getvalue())
+                    buffer.seek(0)
+                    buffer.truncate()
+        write_rows(rows)
+        file.write(buffer.getvalue())
         if path_or_file is None:
             return file.getvalue()
         if close_after:
@@ -4133,6 +4940,15 @@ class odf_named_range(odf_element):
 
 
 
+def _export_table_csv(args):
+    """Write the table given serialized as CSV, in a worker process.
+    """
+    data, path, options = args
+    odf_create_element(data).to_csv(path, **options)
+    return path
+
+
+
 def import_from_csv(path_or_file, name, style=None, delimiter=None,
         quotechar=None, lineterminator=None, encoding='utf-8'):
     """Convert the CSV file to an odf_table. If the file is a string, it is
@@ -4159,42 +4975,923 @@ def import_from_csv(path_or_file, name, style=None, delimiter=None,
       encoding -- str
     """
 
-    # Load the data
-    # XXX Load the entire file in memory
-    # Alternative: a file-wrapper returning the sample then the rest
     if type(path_or_file) is str:
         file = open(path_or_file, 'rb')
-        data = file.read().splitlines(True)
-        file.close()
     else:
         # Leave the file we were given open
-        data = path_or_file.read().splitlines(True)
-    # Sniff the dialect
-    sample = ''.join(data[:100])
-    dialect = Sniffer().sniff(sample)
-    # We can overload the result
-    if delimiter is not None:
-        dialect.delimiter = delimiter
-    if quotechar is not None:
-        dialect.quotechar = quotechar
-    if lineterminator is not None:
-        dialect.lineterminator = lineterminator
-    # Make the rows
-    csv = reader(data, dialect)
-    table = odf_create_table(name, style=style)
-    for line in csv:
-        row = odf_create_row()
-        # rstrip line
-        while line and not line[-1].strip():
-            line.pop()
-        for value in line:
-            cell = odf_create_cell(_get_python_value(value, encoding))
-            row.append_cell(cell, clone=False)
-        table.append_row(row, clone=False)
+        file = path_or_file
+    try:
+        # Sniff the dialect on the first lines, read again with the rest
+        sample = []
+        for line in file:
+            sample.append(line)
+            if len(sample) == 100:
+                break
+        dialect = Sniffer().sniff(''.join(sample))
+        # We can overload the result
+        if delimiter is not None:
+            dialect.delimiter = delimiter
+        if quotechar is not None:
+            dialect.quotechar = quotechar
+        if lineterminator is not None:
+            dialect.lineterminator = lineterminator
+        # Make the rows
+        table = odf_create_table(name, style=style)
+        lines = count()
+        values = _iter_csv_values(chain(sample, file), dialect, encoding)
+        # Counting the lines read, set_values leaving out the empty last ones
+        table.set_values(line for line, i in izip(values, lines))
+        missing = lines.next() - table.get_height()
+        if missing > 0:
+            table.append_row(odf_create_row(repeated=missing), clone=False)
+    finally:
+        if file is not path_or_file:
+            file.close()
     return table
 
 
 
+def iter_sheet_values(path_or_file, sheet=None, get_type=False, width=None):
+    """Iterate through the rows of Python values of a sheet of the given
+    spreadsheet document, a path or a file-like object, reading it without
+    loading the whole table.
+
+    The sheet is the first one by default, else given by its position or
+    its name.
+
+    Repeated rows and cells are expanded as they are read. Trailing empty
+    cells of each row, and trailing empty rows of the sheet, are not
+    returned. If "width" is given, each row is cut or completed with empty
+    values to this width.
+
+    Values are decoded as "get_value" does. If get_type is True, returns
+    tuples (value, ODF type of value), or (None, None) for empty cells.
+
+    Arguments:
+
+        path_or_file -- str or file-like
+
+        sheet -- int or unicode
+
+        get_type -- boolean
+
+        width -- int
+
+    Return: iterator of lists
+    """
+    table_tag = '{%s}table' % ODF_NAMESPACES['table']
+    row_tag = '{%s}table-row' % ODF_NAMESPACES['table']
+    cell_tags = ('{%s}table-cell' % ODF_NAMESPACES['table'],
+                 '{%s}covered-table-cell' % ODF_NAMESPACES['table'])
+    spreadsheet_tag = '{%s}spreadsheet' % ODF_NAMESPACES['office']
+    name_attr = '{%s}name' % ODF_NAMESPACES['table']
+    rows_repeated_attr = '{%s}number-rows-repeated' % ODF_NAMESPACES['table']
+    columns_repeated_attr = ('{%s}number-columns-repeated'
+                             % ODF_NAMESPACES['table'])
+    value_type_attr = '{%s}value-type' % ODF_NAMESPACES['office']
+    empty = (None, None) if get_type else None
+    if width is None:
+        empty_row = []
+    else:
+        empty_row = [empty] * width
+    container = odf_get_container(path_or_file, lazy=True)
+    file = container.open_part(ODF_CONTENT)
+    try:
+        position = -1
+        selected = None
+        empty_rows = 0
+        for event, element in iterparse(file, events=('start', 'end'),
+                                        tag=(table_tag, row_tag)):
+            if element.tag == table_tag:
+                if event == 'end':
+                    if element is selected:
+                        # Trailing empty rows are dropped
+                        break
+                elif selected is None:
+                    parent = element.getparent()
+                    if parent is not None and parent.tag == spreadsheet_tag:
+                        position += 1
+                        if sheet is None or sheet == position or (
+                                sheet == element.get(name_attr)):
+                            selected = element
+                continue
+            if event == 'start':
+                continue
+            values = None
+            if selected is not None:
+                # Rows of sub-tables are not ours
+                parent = element.getparent()
+                while parent.tag != table_tag:
+                    parent = parent.getparent()
+                if parent is selected:
+                    repeated = int(element.get(rows_repeated_attr, 1))
+                    values = []
+                    empty_cells = 0
+                    for cell in element.iterchildren(*cell_tags):
+                        cell_repeated = int(cell.get(columns_repeated_attr, 1))
+                        if cell.get(value_type_attr) is None:
+                            # Expanded only if followed by a value
+                            empty_cells += cell_repeated
+                            continue
+                        if width is not None and len(values) >= width:
+                            break
+                        value = get_value(odf_element(cell),
+                                          get_type=get_type)
+                        if empty_cells:
+                            values.extend([empty] * empty_cells)
+                            empty_cells = 0
+                        values.extend([value] * cell_repeated)
+                    if width is not None:
+                        del values[width:]
+                        values.extend([empty] * (width - len(values)))
+            # Done with this row
+            element.clear()
+            parent = element.getparent()
+            while element.getprevious() is not None:
+                del parent[0]
+            if values is None:
+                continue
+            if width is None and not values or values == empty_row:
+                empty_rows += repeated
+                continue
+            for i in xrange(empty_rows):
+                yield list(empty_row)
+            empty_rows = 0
+            for i in xrange(repeated):
+                yield list(values)
+        if selected is None:
+            raise ValueError('sheet "%s" not found' % sheet)
+    finally:
+        file.close()
+
+
+
+class _row_encoder(object):
+    """Serialize rows of Python values as XML, identical adjacent cells
+    written once as repeated. Cells are made by "odf_create_cell", a bounded
+    number of them kept serialized to be written again.
+    """
+
+    def __init__(self, cell_cache_size=1024):
+        self.cell_cache_size = cell_cache_size
+        self.__cells = {}
+        self.__row_tags = {}
+
+
+    def get_cell(self, value, style=None, cell_type=None, currency=None):
+        if (style is None and cell_type is None and currency is None
+                and type(value) in (int, long, float, dec)):
+            # Formatted as "odf_create_cell" does
+            value = str(value)
+            return ('<table:table-cell office:value-type="float" '
+                    'office:value="%s"><text:p>%s</text:p>'
+                    '</table:table-cell>' % (value, value))
+        key = (value.__class__, value, style, cell_type, currency)
+        cells = self.__cells
+        cell = cells.get(key)
+        if cell is None:
+            if len(cells) >= self.cell_cache_size:
+                cells.clear()
+            cell = odf_create_cell(value, style=style, cell_type=cell_type,
+                    currency=currency).serialize()
+            cells[key] = cell
+        return cell
+
+
+    def get_row(self, values, style=None, cell_style=None, cell_type=None,
+                currency=None, start=0):
+        """Return the XML of the row and its width, empty cells first from 0
+        to "start". A row has at least one cell.
+        """
+        cells = []
+        if start > 0:
+            previous = '<table:table-cell/>'
+            repeated = start
+        else:
+            previous = None
+            repeated = 0
+        for value in values:
+            cell = self.get_cell(value, cell_style, cell_type, currency)
+            if cell == previous:
+                repeated += 1
+                continue
+            if previous is not None:
+                cells.append((previous, repeated))
+            previous = cell
+            repeated = 1
+        if previous is None:
+            previous = '<table:table-cell/>'
+            repeated = 1
+        cells.append((previous, repeated))
+        row_tags = self.__row_tags
+        row_tag = row_tags.get(style)
+        if row_tag is None:
+            # Made by the XML library for escaping
+            row_tag = odf_create_row(style=style).serialize()[:-2] + '>'
+            row_tags[style] = row_tag
+        data = [row_tag]
+        width = 0
+        for cell, repeated in cells:
+            if repeated > 1:
+                # After "<table:table-cell"
+                cell = (cell[:17] + ' table:number-columns-repeated="%d"'
+                        % repeated + cell[17:])
+            data.append(cell)
+            width += repeated
+        data.append('</table:table-row>')
+        return ''.join(data), width
+
+
+    @staticmethod
+    def set_row_repeated(row, repeated):
+        if repeated > 1:
+            # After "<table:table-row"
+            row = (row[:16] + ' table:number-rows-repeated="%d"' % repeated
+                   + row[16:])
+        return row
+
+
+
+class odf_spreadsheet_writer(object):
+    """Write a spreadsheet document table after table and row after row,
+    the content part being compressed into the Zip archive as rows are
+    appended. Memory use does not depend on the number of rows.
+
+    Identical adjacent cells, and identical adjacent rows, are written once
+    as repeated.
+
+    The styles, metadata, etc. of "document" can be changed until closing,
+    but the automatic styles of the content only until the first table is
+    added.
+
+    Arguments:
+
+        target -- str or file-like, must be seekable
+
+        template -- str or file-like, a spreadsheet template
+
+        level -- int, zlib level of the content part
+    """
+    # Bound to the number of serialized cells kept to be written again
+    cell_cache_size = 1024
+
+    def __init__(self, target, template='spreadsheet', level=None):
+        self.document = odf_new_document(template)
+        self.level = level
+        self.__target = target
+        self.__zipfile = None
+        self.__zinfo = None
+        self.__member = None
+        self.__footer = None
+        self.__in_table = False
+        # Last row appended, written once a different one comes
+        self.__row = None
+        self.__row_repeated = 0
+        self.__encoder = _row_encoder(self.cell_cache_size)
+
+
+    def __start(self):
+        content = self.document.get_part(ODF_CONTENT)
+        body = content.get_body()
+        body.clear()
+        header, footer = content.serialize().split(
+                '<office:spreadsheet/>', 1)
+        self.__zipfile = ZipFile(self.__target, 'w')
+        filezip = self.__zipfile
+        filezip.writestr('mimetype',
+                self.document.container.get_part('mimetype'))
+        zinfo = ZipInfo(ODF_CONTENT, localtime(time())[:6])
+        zinfo.external_attr = 0600 << 16
+        if self.level == 0:
+            zinfo.compress_type = ZIP_STORED
+        else:
+            zinfo.compress_type = ZIP_DEFLATED
+        self.__zinfo = zinfo
+        level = self.level
+        if level is None:
+            level = Z_DEFAULT_COMPRESSION
+        self.__member = _open_zip_member(filezip, zinfo, level)
+        self.__member.write(header + '<office:spreadsheet>')
+        self.__footer = '</office:spreadsheet>' + footer
+
+
+    def __write_row(self):
+        row = self.__row
+        if row is None:
+            return
+        self.__member.write(_row_encoder.set_row_repeated(row,
+            self.__row_repeated))
+        self.__row = None
+        self.__row_repeated = 0
+
+
+    def __end_table(self):
+        if self.__in_table:
+            self.__write_row()
+            self.__member.write('</table:table>')
+            self.__in_table = False
+
+
+    def add_table(self, name, width=None, style=None, column_style=None):
+        """Start a new table, ending the previous one. Rows appended after
+        go to this table.
+
+        Arguments:
+
+            name -- unicode
+
+            width -- int, number of columns declared
+
+            style -- str
+
+            column_style -- str
+        """
+        if self.__member is None:
+            if self.__zipfile is not None:
+                raise ValueError, "writer is closed"
+            self.__start()
+        self.__end_table()
+        table = odf_create_table(name, style=style)
+        if width is not None and width > 1:
+            repeated = width
+        else:
+            repeated = None
+        table.append(odf_create_column(repeated=repeated, style=column_style))
+        table = table.serialize()
+        self.__member.write(table[:-len('</table:table>')])
+        self.__in_table = True
+
+
+    def append_row(self, values, style=None, cell_style=None):
+        """Append a row of the given Python values to the current table.
+        None is an empty cell.
+
+        Arguments:
+
+            values -- iterable of Python types
+
+            style -- str
+
+            cell_style -- str
+        """
+        if not self.__in_table:
+            raise ValueError, "no table to append the row to"
+        row, width = self.__encoder.get_row(values, style=style,
+                cell_style=cell_style)
+        if row == self.__row:
+            self.__row_repeated += 1
+            return
+        self.__write_row()
+        self.__row = row
+        self.__row_repeated = 1
+
+
+    def close(self):
+        """End the content and write the other parts of the document.
+        """
+        if self.__member is None:
+            if self.__zipfile is not None:
+                return
+            self.__start()
+        self.__end_table()
+        self.__member.write(self.__footer)
+        _close_zip_member(self.__zipfile, self.__zinfo, self.__member)
+        self.__member = None
+        # The content part we wrote is kept
+        self.document.save(self.__zipfile)
+
+
+
+class _row_scanner(object):
+    """Find the offsets of the rows of the tables in the content part fed,
+    without parsing it.
+    """
+
+    def __init__(self, step):
+        self.step = step
+        self.buffer = ''
+        # Offset of the buffer in the data fed
+        self.base = 0
+        self.root = None
+        self.tags = None
+        # Name, first y of the rows, their offset, height
+        self.tables = []
+        self.depth = 0
+        self.groups = 0
+
+
+    def __start(self):
+        buffer = self.buffer
+        root = _xml_root.search(buffer)
+        if root is None:
+            return 0
+        end = _xml_start_tag_end.match(buffer, root.end())
+        if end is None:
+            return 0
+        self.root = root_start = buffer[root.start():end.end()]
+        prefixes = dict((uri, prefix) for prefix, uri
+                        in _xml_xmlns_decl.findall(root_start))
+        self.prefix = prefixes.get(ODF_NAMESPACES['table'], 'table')
+        prefix = escape(self.prefix)
+        self.tags = compile(r'<(/?)%s:(table|table-row|table-header-rows|'
+                            r'table-row-group|table-rows)(?=[\s/>])([^>]*)>'
+                            % prefix)
+        self.name = compile(r'\s%s:name="([^"]*)"' % prefix)
+        self.repeated = compile(r'\s%s:number-rows-repeated="(\d+)"' % prefix)
+        return end.end()
+
+
+    def feed(self, data):
+        self.buffer += data
+        buffer = self.buffer
+        position = 0
+        if self.root is None:
+            position = self.__start()
+            if self.root is None:
+                return
+        # The last tag may be incomplete
+        end = buffer.rfind('<')
+        if end < position:
+            end = position
+        base = self.base
+        tables = self.tables
+        step = self.step
+        for match in self.tags.finditer(buffer, position, end):
+            closing, name, attributes = match.groups()
+            if name == 'table':
+                if closing:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        tables[-1][3] = self.y
+                    continue
+                if self.depth == 0:
+                    table_name = self.name.search(attributes)
+                    if table_name is not None:
+                        table_name = unescape(table_name.group(1),
+                                              {'&quot;': '"'}).decode('utf-8')
+                    # Rows are read from the start of the table at least
+                    tables.append([table_name, array('l', [0]),
+                                   array('l', [base + match.end()]), 0])
+                    self.y = 0
+                    self.groups = 0
+                if not attributes.endswith('/'):
+                    self.depth += 1
+                continue
+            if self.depth != 1 or attributes.endswith('/'):
+                continue
+            if name == 'table-row':
+                if closing:
+                    continue
+                repeated = self.repeated.search(attributes)
+                if self.groups == 0:
+                    y_list, offsets = tables[-1][1], tables[-1][2]
+                    if self.y - y_list[-1] >= step:
+                        y_list.append(self.y)
+                        offsets.append(base + match.start())
+                if repeated is None:
+                    self.y += 1
+                else:
+                    self.y += int(repeated.group(1))
+            elif closing:
+                self.groups -= 1
+            else:
+                self.groups += 1
+        self.buffer = buffer[end:]
+        self.base = base + end
+
+
+
+def _make_stored_block(data):
+    """Return a deflate stored block of the given data, not the final one.
+    """
+    size = len(data)
+    return '\x00' + pack('<HH', size, size ^ 0xffff) + data
+
+
+
+class odf_row_index(object):
+    """Index of the rows of the tables of the spreadsheet document at the
+    given path, to read some rows without parsing the whole content.
+
+    The index is built in one pass over the content part, and kept in a
+    file aside, "index_path", by default the path of the document with
+    ".index" appended. It is built again when the content part changed, as
+    told by its CRC.
+
+    One row every "step" rows is indexed by its offset in the content part.
+    Inflating the content part is also restarted near the row, when the
+    Zip member was compressed with flush points every "interval" bytes or
+    more, as done when saved by lpOD. Else the part is inflated from the
+    start, but not parsed.
+
+    Arguments:
+
+        path -- str
+
+        index_path -- str
+
+        step -- int
+
+        interval -- int
+    """
+    magic = 'lpOD row index\n'
+    version = 2
+
+    def __init__(self, path, index_path=None, step=64,
+            interval=SYNC_FLUSH_SIZE):
+        self.path = path
+        if index_path is None:
+            index_path = path + '.index'
+        self.index_path = index_path
+        self.step = step
+        self.interval = interval
+        zipfile = ZipFile(path)
+        try:
+            info = zipfile.getinfo(ODF_CONTENT)
+        finally:
+            zipfile.close()
+        self.key = [info.CRC, info.file_size, info.compress_size]
+        try:
+            file = open(index_path, 'rb')
+        except IOError:
+            index = None
+        else:
+            try:
+                try:
+                    index = self.__load(file)
+                except (ValueError, EOFError):
+                    index = None
+            finally:
+                file.close()
+        if index is None:
+            index = self.__build()
+            file = open(index_path, 'wb')
+            try:
+                self.__dump(index, file)
+            finally:
+                file.close()
+        self.root = index['root']
+        self.prefix = index['prefix']
+        self.tables = index['tables']
+        self.checkpoints = index['checkpoints']
+
+
+    def __load(self, file):
+        """Read the index from the file, as written by "__dump". Only data
+        is read, a JSON header of the sizes of what follows, the offsets as
+        arrays and the strings as they are.
+
+        Raise ValueError or EOFError when the file is not in this format,
+        or was made for another version of the content part.
+        """
+        if file.readline() != self.magic:
+            raise ValueError("not a row index")
+        header = loads(file.readline())
+        if (not isinstance(header, dict)
+                or header.get('version') != self.version
+                or header.get('key') != self.key
+                or header.get('itemsize') != array('l').itemsize):
+            raise ValueError("outdated row index")
+        def read(size):
+            if type(size) is not int or size < 0:
+                raise ValueError("bad row index")
+            data = file.read(size)
+            if len(data) != size:
+                raise EOFError("truncated row index")
+            return data
+        def read_array(size):
+            if type(size) is not int or size < 0:
+                raise ValueError("bad row index")
+            offsets = array('l')
+            offsets.fromfile(file, size)
+            return offsets
+        try:
+            root = read(header['root'])
+            prefix = read(header['prefix'])
+            tables = []
+            for name, size, height in header['tables']:
+                if name is not None and not isinstance(name, unicode):
+                    raise ValueError("bad row index")
+                if type(height) is not int:
+                    raise ValueError("bad row index")
+                tables.append((name, read_array(size), read_array(size),
+                               height))
+            checkpoints = []
+            for size, position, window_size in header['checkpoints']:
+                if type(size) is not int or type(position) is not int:
+                    raise ValueError("bad row index")
+                checkpoints.append((size, position, read(window_size)))
+        except (KeyError, TypeError):
+            raise ValueError("bad row index")
+        if file.read(1):
+            raise ValueError("bad row index")
+        return {'root': root,
+                'prefix': prefix,
+                'tables': tables,
+                'checkpoints': checkpoints}
+
+
+    def __dump(self, index, file):
+        header = {'version': self.version,
+                  'key': self.key,
+                  'itemsize': array('l').itemsize,
+                  'root': len(index['root']),
+                  'prefix': len(index['prefix']),
+                  'tables': [(name, len(y_list), height)
+                             for name, y_list, offsets, height
+                             in index['tables']],
+                  'checkpoints': [(size, position, len(window))
+                                  for size, position, window
+                                  in index['checkpoints']]}
+        file.write(self.magic)
+        file.write(dumps(header))
+        file.write('\n')
+        file.write(index['root'])
+        file.write(index['prefix'])
+        for name, y_list, offsets, height in index['tables']:
+            y_list.tofile(file)
+            offsets.tofile(file)
+        for size, position, window in index['checkpoints']:
+            file.write(window)
+
+
+    def __open(self):
+        """Return the file of the document, the information on the content
+        part and the offset of its data.
+        """
+        zipfile = ZipFile(self.path)
+        try:
+            info = zipfile.getinfo(ODF_CONTENT)
+        finally:
+            zipfile.close()
+        file = open(self.path, 'rb')
+        return file, info, _get_zip_member_offset(file, info)
+
+
+    def __read(self, file, start, size, chunk_size=COPY_CHUNK_SIZE):
+        file.seek(start)
+        while size > 0:
+            data = file.read(min(size, chunk_size))
+            if not data:
+                raise BadZipfile("truncated member '%s'" % ODF_CONTENT)
+            size -= len(data)
+            yield data
+
+
+    def __build(self):
+        scanner = _row_scanner(self.step)
+        checkpoints = []
+        file, info, data_offset = self.__open()
+        try:
+            compressed = self.__read(file, data_offset, info.compress_size)
+            if info.compress_type == ZIP_STORED:
+                for data in compressed:
+                    scanner.feed(data)
+            else:
+                self.__build_deflated(compressed, scanner, checkpoints)
+                checkpoints = [checkpoint for checkpoint in checkpoints
+                               if self.__check(file, data_offset, info,
+                                               checkpoint)]
+        finally:
+            file.close()
+        return {'root': scanner.root,
+                'prefix': scanner.prefix,
+                'tables': [tuple(table) for table in scanner.tables],
+                'checkpoints': [(size, position, compress(window))
+                                for size, position, window, sample
+                                in checkpoints]}
+
+
+    def __build_deflated(self, compressed, scanner, checkpoints):
+        """Inflate the data for the scanner, and note the flush points where
+        inflating can be restarted with the window of data before.
+        """
+        decompressor = decompressobj(-15)
+        state = {'size': 0, 'window': ''}
+        # Waiting for the data following them to be checked
+        pending = []
+        sample_size = 1024
+
+        def inflate(data):
+            data = decompressor.decompress(data)
+            if not data:
+                return
+            scanner.feed(data)
+            state['size'] += len(data)
+            window = state['window'] + data[-DEFLATE_WINDOW_SIZE:]
+            state['window'] = window[-DEFLATE_WINDOW_SIZE:]
+            for checkpoint in pending[:]:
+                sample = checkpoint[3]
+                sample.append(data[:sample_size - len(''.join(sample))])
+                if len(''.join(sample)) >= sample_size:
+                    pending.remove(checkpoint)
+
+        position = 0
+        tail = ''
+        last = 0
+        for data in compressed:
+            start = 0
+            # The empty stored block of a flush, maybe over two chunks
+            search = tail + data
+            index = search.find('\x00\x00\xff\xff')
+            while index != -1:
+                end = index + 4 - len(tail)
+                if end > start:
+                    inflate(data[start:end])
+                    start = end
+                    size = state['size']
+                    if size - last >= self.interval:
+                        checkpoint = (size, position + end, state['window'],
+                                      [])
+                        checkpoints.append(checkpoint)
+                        pending.append(checkpoint)
+                        last = size
+                index = search.find('\x00\x00\xff\xff', index + 1)
+            inflate(data[start:])
+            position += len(data)
+            tail = data[-3:]
+        scanner.feed(decompressor.flush())
+
+
+    def __check(self, file, data_offset, info, checkpoint):
+        """Is the checkpoint a real flush point, not some bytes looking like
+        it?
+        """
+        size, position, window, sample = checkpoint
+        sample = ''.join(sample)
+        if not sample:
+            return False
+        data = self.__read(file, data_offset + position,
+                           min(info.compress_size - position, 64 * 1024))
+        decompressor = decompressobj(-15)
+        try:
+            decompressor.decompress(_make_stored_block(window))
+            data = decompressor.decompress(''.join(data))
+        except zlib_error:
+            return False
+        return data[:len(sample)] == sample[:len(data)] and len(data) > 0
+
+
+    def __iter_content(self, offset):
+        """Yield the data of the content part from the given offset, in
+        small chunks as only a few rows are read in general.
+        """
+        chunk_size = 16 * 1024
+        file, info, data_offset = self.__open()
+        try:
+            if info.compress_type == ZIP_STORED:
+                for data in self.__read(file, data_offset + offset,
+                                        info.compress_size - offset,
+                                        chunk_size):
+                    yield data
+                return
+            decompressor = decompressobj(-15)
+            sizes = [checkpoint[0] for checkpoint in self.checkpoints]
+            index = bisect_right(sizes, offset) - 1
+            if index >= 0:
+                size, position, window = self.checkpoints[index]
+                decompressor.decompress(_make_stored_block(
+                    decompress(window)))
+            else:
+                size = position = 0
+            skip = offset - size
+            for data in self.__read(file, data_offset + position,
+                                    info.compress_size - position,
+                                    chunk_size):
+                data = decompressor.decompress(data)
+                if skip:
+                    if len(data) <= skip:
+                        skip -= len(data)
+                        continue
+                    data = data[skip:]
+                    skip = 0
+                for start in xrange(0, len(data), chunk_size):
+                    yield data[start:start + chunk_size]
+        finally:
+            file.close()
+
+
+    def __get_table(self, sheet):
+        tables = self.tables
+        if sheet is None:
+            sheet = 0
+        if isinstance(sheet, int):
+            if -len(tables) <= sheet < len(tables):
+                return tables[sheet]
+        else:
+            for table in tables:
+                if table[0] == sheet:
+                    return table
+        raise ValueError('sheet "%s" not found' % sheet)
+
+
+    def get_sheet_names(self):
+        """Return the names of the tables, in order.
+
+        Return: list of unicode
+        """
+        return [table[0] for table in self.tables]
+
+
+    def get_height(self, sheet=None):
+        """Return the number of rows of the table, by default the first
+        one, else given by its position or its name.
+
+        Arguments:
+
+            sheet -- int or unicode
+
+        Return: int
+        """
+        return self.__get_table(sheet)[3]
+
+
+    def get_row(self, y, sheet=None):
+        """Return the row at the given position of the table, by default the
+        first one, else given by its position or its name. Only the rows
+        from the nearest one indexed are parsed.
+
+        Arguments:
+
+            y -- int
+
+            sheet -- int or unicode
+
+        Return: odf_row or None if not found
+        """
+        name, y_list, offsets, height = self.__get_table(sheet)
+        if not 0 <= y < height:
+            return None
+        index = bisect_right(y_list, y) - 1
+        row_y = y_list[index]
+        table_tag = '{%s}table' % ODF_NAMESPACES['table']
+        row_tag = '{%s}table-row' % ODF_NAMESPACES['table']
+        rows_repeated = '{%s}number-rows-repeated' % ODF_NAMESPACES['table']
+        parser = XMLPullParser(events=('start', 'end'),
+                               tag=(table_tag, row_tag))
+        # Rows are parsed within the root and a table of their own
+        parser.feed(self.root)
+        parser.feed('<%s:table>' % self.prefix)
+        table = None
+        for data in self.__iter_content(offsets[index]):
+            # The data goes on after our table, to the end of the root
+            try:
+                parser.feed(data)
+            except XMLSyntaxError:
+                data = None
+            for event, element in parser.read_events():
+                if element.tag == table_tag:
+                    if event == 'start':
+                        if table is None:
+                            table = element
+                    elif element is table:
+                        return None
+                    continue
+                if event == 'start':
+                    continue
+                parent = element.getparent()
+                while parent.tag != table_tag:
+                    parent = parent.getparent()
+                if parent is not table:
+                    continue
+                repeated = int(element.get(rows_repeated, 1))
+                if row_y <= y < row_y + repeated:
+                    row = _make_odf_element(element).clone()
+                    row.set_repeated(None)
+                    row.y = y
+                    return row
+                row_y += repeated
+                element.clear()
+            if data is None:
+                break
+        return None
+
+
+    def get_value(self, coord, sheet=None, get_type=False):
+        """Return the Python value of the cell at the given coordinates of
+        the table, by default the first one, else given by its position or
+        its name.
+
+        Arguments:
+
+            coord -- (int, int) or str
+
+            sheet -- int or unicode
+
+            get_type -- boolean
+
+        Return: Python type
+        """
+        x, y = _convert_coordinates(coord)
+        row = self.get_row(y, sheet=sheet)
+        if row is None:
+            if get_type:
+                return (None, None)
+            return None
+        return row.get_value(x, get_type=get_type)
+
+
+
 # Register
 register_element_class('table:table-cell', odf_cell)
 register_element_class('table:covered-table-cell', odf_cell)
@@ -30,17 +30,22 @@ from copy import deepcopy
 from cStringIO import StringIO
 
 # Import from lxml
-from lxml.etree import parse, tostring
+from lxml.etree import iterparse, parse, tostring
 
 # Import from lpod
-from element import _make_odf_element
+from element import _make_odf_element, _track_modifications, _decode_qname
 #from utils import obsolete
 
 
 class odf_xmlpart(object):
     """Representation of an XML part.
     Abstraction of the XML library behind.
+
+    "_modified" tells the tree was modified since it was loaded, or saved.
     """
+    _modified = False
+
+
     def __init__(self, part_name, container):
         self.part_name = part_name
         self.container = container
@@ -52,16 +57,26 @@ class odf_xmlpart(object):
 
     def __get_tree(self):
         if self.__tree is None:
-            container = self.container
-            part = container.get_part(self.part_name)
-            self.__tree = parse(StringIO(part))
+            self.__tree = self._parse()
+            _track_modifications(self.__tree.getroot(), self)
         return self.__tree
 
 
+    def _parse(self):
+        """Return the tree of the part parsed from the container.
+        """
+        part = self.container.get_part(self.part_name)
+        return parse(StringIO(part))
+
+
     #
     # Public API
     #
 
+    def _is_loaded(self):
+        return self.__tree is not None
+
+
     def get_root(self):
         if self.__root is None:
             tree = self.__get_tree()
@@ -69,6 +84,59 @@ class odf_xmlpart(object):
         return self.__root
 
 
+    def _iterparse(self, is_match):
+        """Yield the elements for which "is_match" is true, given the lxml
+        element just started, parsed from the container without building the
+        whole tree.
+
+        An element is cleared once the next one is read. The elements outside
+        of a match are cleared as soon as they are read.
+        """
+        file = self.container.open_part(self.part_name)
+        try:
+            matched = []
+            for event, element in iterparse(file, events=('start', 'end')):
+                if event == 'start':
+                    if is_match(element):
+                        matched.append(element)
+                    continue
+                if matched and matched[-1] is element:
+                    matched.pop()
+                    yield _make_odf_element(element)
+                if not matched:
+                    element.clear()
+                    parent = element.getparent()
+                    if parent is not None:
+                        while element.getprevious() is not None:
+                            del parent[0]
+        finally:
+            file.close()
+
+
+    def iter_elements(self, tags):
+        """Yield the elements of the given tag name(s), e.g. "text:p". The
+        part is read without building the whole tree when not already
+        loaded, so the elements are only valid until the next one is
+        yielded: read-only, don't keep them, clone them. Nested elements may
+        come before the element containing them.
+
+        Arguments:
+
+            tags -- str or tuple of str
+
+        Return: iterator of odf_element
+        """
+        if isinstance(tags, basestring):
+            tags = (tags,)
+        tags = frozenset('{%s}%s' % _decode_qname(tag) for tag in tags)
+        if self.__tree is not None:
+            for element in self.__tree.getroot().iter(*tags):
+                yield _make_odf_element(element)
+            return
+        for element in self._iterparse(lambda element: element.tag in tags):
+            yield element
+
+
     def get_elements(self, xpath_query):
         root = self.get_root()
         return root.xpath(xpath_query)
@@ -95,20 +163,44 @@ class odf_xmlpart(object):
         return root.xpath(xpath_query)
 
 
-    def clone(self):
+    def clone(self, container=None):
+        """Make a copy of this part, in a clone of its container or in the
+        given one. The part is parsed again from the container bytes, shared
+        with the clone, unless it was already loaded.
+        """
         clone = object.__new__(self.__class__)
         for name in self.__dict__:
             if name == 'container':
-                setattr(clone, name, self.container.clone())
-            elif name in ('_odf_xmlpart__tree',):
+                if container is None:
+                    container = self.container.clone()
+                setattr(clone, name, container)
+            elif name == '_odf_xmlpart__tree':
+                tree = self.__tree
+                if tree is not None:
+                    tree = deepcopy(tree)
+                setattr(clone, name, tree)
+            elif name == '_odf_xmlpart__root':
+                # Made again from the tree
                 setattr(clone, name, None)
             else:
                 value = getattr(self, name)
                 value = deepcopy(value)
                 setattr(clone, name, value)
+        if clone.__tree is not None:
+            _track_modifications(clone.__tree.getroot(), clone)
         return clone
 
 
+    def write(self, file, pretty=False, xml_declaration=True):
+        """Write the XML part to the given file-like object, as serialized
+        by the XML library, without building the whole string.
+        """
+        tree = self.__get_tree()
+        if xml_declaration:
+            file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        tree.write(file, encoding='UTF-8', pretty_print=pretty)
+
+
     def serialize(self, pretty=False):
         tree = self.__get_tree()
         # Lxml declaration is too exotic to me
@@ -35,10 +35,19 @@ from os import mkdir
 from shutil import rmtree
 from unittest import TestCase, main
 from urllib import urlopen
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+from zlib import compress
+
+# Import from lxml
+from lxml.etree import fromstring, XMLSyntaxError
 
 # Import from lpod
+import lpod.container
 from lpod.const import ODF_EXTENSIONS, ODF_CONTENT, ODF_META
+from lpod.const import ODF_SETTINGS, ODF_STYLES, ODF_MANIFEST
 from lpod.container import odf_get_container, odf_new_container
+from lpod.container import odf_clear_template_cache
+from lpod.element import ODF_NAMESPACES
 
 
 class NewContainerFromTemplateTestCase(TestCase):
@@ -76,6 +85,51 @@ class NewContainerFromTemplateTestCase(TestCase):
 
 
 
+class TemplateCacheTestCase(TestCase):
+
+    def setUp(self):
+        mkdir('trash')
+        data = open('../lpod/templates/text.ott', 'rb').read()
+        open('trash/template.ott', 'wb').write(data)
+
+
+    def tearDown(self):
+        odf_clear_template_cache()
+        rmtree('trash')
+
+
+    def test_cached(self):
+        container = odf_new_container('trash/template.ott')
+        content = container.get_part(ODF_CONTENT)
+        other = odf_new_container('trash/template.ott')
+        self.assert_(other.get_part(ODF_CONTENT) is content)
+        other.set_part(ODF_CONTENT, 'modified')
+        self.assertEqual(container.get_part(ODF_CONTENT), content)
+        container = odf_new_container('trash/template.ott')
+        self.assert_(container.get_part(ODF_CONTENT) is content)
+
+
+    def test_modified(self):
+        content = odf_new_container('trash/template.ott').get_part(ODF_CONTENT)
+        data = open('../lpod/templates/spreadsheet.ots', 'rb').read()
+        open('trash/template.ott', 'wb').write(data)
+        stat = os.stat('trash/template.ott')
+        os.utime('trash/template.ott', (stat.st_atime, stat.st_mtime + 10))
+        container = odf_new_container('trash/template.ott')
+        self.assertEqual(container.get_part('mimetype'),
+                ODF_EXTENSIONS['ods'])
+        self.assertNotEqual(container.get_part(ODF_CONTENT), content)
+
+
+    def test_clear(self):
+        content = odf_new_container('trash/template.ott').get_part(ODF_CONTENT)
+        odf_clear_template_cache('trash/template.ott')
+        container = odf_new_container('trash/template.ott')
+        self.assertEqual(container.get_part(ODF_CONTENT), content)
+        self.assert_(container.get_part(ODF_CONTENT) is not content)
+
+
+
 class NewContainerFromTypeTestCase(TestCase):
 
     def test_bad_type(self):
@@ -123,6 +177,42 @@ class GetContainerTestCase(TestCase):
         self.assertEqual(mimetype, ODF_EXTENSIONS['odt'])
 
 
+    def test_lazy(self):
+        path = 'samples/example.odt'
+        container = odf_get_container(path, lazy=True)
+        mimetype = container.get_part('mimetype')
+        self.assertEqual(mimetype, ODF_EXTENSIONS['odt'])
+        content = container.get_part(ODF_CONTENT)
+        self.assert_('<office:document-content' in content)
+
+
+    def test_lazy_file(self):
+        file = open('samples/example.odt', 'rb')
+        container = odf_get_container(file, lazy=True)
+        file.close()
+        content = container.get_part(ODF_CONTENT)
+        self.assert_('<office:document-content' in content)
+
+
+    def test_lazy_stringio(self):
+        data = open('samples/example.odt', 'rb').read()
+        container = odf_get_container(StringIO(data), lazy=True)
+        mimetype = container.get_part('mimetype')
+        self.assertEqual(mimetype, ODF_EXTENSIONS['odt'])
+
+
+    def test_lazy_odf_xml(self):
+        container = odf_get_container('samples/example.xml', lazy=True)
+        mimetype = container.get_part('mimetype')
+        self.assertEqual(mimetype, ODF_EXTENSIONS['odt'])
+
+
+    def test_fodt(self):
+        container = odf_get_container('samples/example.fodt')
+        mimetype = container.get_part('mimetype')
+        self.assertEqual(mimetype, ODF_EXTENSIONS['odt'])
+
+
 
 class ContainerTestCase(TestCase):
 
@@ -133,6 +223,15 @@ class ContainerTestCase(TestCase):
         self.assertNotEqual(clone._odf_container__data, None)
 
 
+    def test_clone_shared_parts(self):
+        container = odf_get_container('samples/example.odt')
+        content = container.get_part(ODF_CONTENT)
+        clone = container.clone()
+        self.assert_(clone.get_part(ODF_CONTENT) is content)
+        clone.set_part(ODF_CONTENT, 'modified')
+        self.assertEqual(container.get_part(ODF_CONTENT), content)
+
+
     def test_get_part_xml(self):
         container = odf_get_container('samples/example.odt')
         content = container.get_part(ODF_CONTENT)
@@ -153,7 +252,70 @@ class ContainerTestCase(TestCase):
     def test_odf_xml_part_xml(self):
         container = odf_get_container('samples/example.xml')
         meta = container.get_part('meta')
-        self.assert_(meta.startswith('<office:document-meta>'))
+        self.assert_(meta.startswith('<office:document-meta'))
+        self.assertEqual(container.get_part(ODF_META), meta)
+
+
+    def test_odf_xml_get_parts(self):
+        container = odf_get_container('samples/example.xml')
+        self.assertEqual(container.get_parts(), ['mimetype', ODF_CONTENT,
+            ODF_META, 'settings.xml', 'styles.xml'])
+
+
+    def test_fodt_get_parts(self):
+        container = odf_get_container('samples/example.fodt')
+        self.assertEqual(container.get_parts(), ['mimetype', ODF_CONTENT,
+            ODF_META, 'settings.xml', 'styles.xml'])
+
+
+    def test_fodt_content(self):
+        container = odf_get_container('samples/example.fodt')
+        content = container.get_part(ODF_CONTENT)
+        self.assert_(content.startswith('<office:document-content'))
+        self.assert_('office:version="1.2"' in content)
+        self.assert_('<office:font-face-decls>' in content)
+        self.assert_('This is a flat example.' in content)
+        # Automatic styles of the body only
+        self.assert_('style:name="P1"' in content)
+        self.assert_('style:name="MP1"' not in content)
+        self.assert_('<style:page-layout ' not in content)
+        self.assert_('<office:master-styles>' not in content)
+
+
+    def test_fodt_styles(self):
+        container = odf_get_container('samples/example.fodt')
+        styles = container.get_part(ODF_STYLES)
+        self.assert_(styles.startswith('<office:document-styles'))
+        self.assert_('<office:font-face-decls>' in styles)
+        self.assert_('style:name="Text_20_body"' in styles)
+        # Automatic styles of the master pages only
+        self.assert_('style:name="MP1"' in styles)
+        self.assert_('<style:page-layout ' in styles)
+        self.assert_('style:name="P1"' not in styles)
+        self.assert_('<office:body>' not in styles)
+
+
+    def test_fodt_meta(self):
+        container = odf_get_container('samples/example.fodt')
+        meta = container.get_part(ODF_META)
+        self.assert_(meta.startswith('<office:document-meta'))
+        self.assert_('<dc:title>Flat example</dc:title>' in meta)
+
+
+    def test_open_part(self):
+        container = odf_get_container('samples/example.odt', lazy=True)
+        file = container.open_part(ODF_CONTENT)
+        data = file.read(10)
+        # Another part read meanwhile
+        container.get_part(ODF_META)
+        data += file.read()
+        self.assertEqual(data, container.get_part(ODF_CONTENT))
+
+
+    def test_open_part_xml(self):
+        container = odf_get_container('samples/example.xml')
+        file = container.open_part(ODF_CONTENT)
+        self.assertEqual(file.read(), container.get_part(ODF_CONTENT))
 
 
     def test_set_part(self):
@@ -164,6 +326,19 @@ class ContainerTestCase(TestCase):
         self.assertEqual(container.get_part(path), data)
 
 
+    def test_set_part_writer(self):
+        container = odf_get_container('samples/example.odt')
+        data = container.get_part(ODF_CONTENT)
+        def writer(file, xml_declaration=True):
+            file.write(data)
+        container.set_part_writer(ODF_CONTENT, writer)
+        self.assertEqual(container.get_part(ODF_CONTENT), data)
+        clone = container.clone()
+        data = 'modified'
+        self.assertEqual(container.get_part(ODF_CONTENT), 'modified')
+        self.assertNotEqual(clone.get_part(ODF_CONTENT), 'modified')
+
+
     def test_del_part(self):
         container = odf_get_container('samples/example.odt')
         # Not a realistic test
@@ -195,6 +370,192 @@ class ContainerSaveTestCase(TestCase):
         self.assertEqual(mimetype, ODF_EXTENSIONS['odt'])
 
 
+    def test_save_lazy(self):
+        container = odf_get_container('samples/example.odt', lazy=True)
+        container.save('trash/example.odt')
+        new_container = odf_get_container('trash/example.odt')
+        self.assertEqual(new_container.get_part(ODF_CONTENT),
+                container.get_part(ODF_CONTENT))
+
+
+    def test_save_lazy_same_path(self):
+        data = open('samples/example.odt', 'rb').read()
+        open('trash/example.odt', 'wb').write(data)
+        container = odf_get_container('trash/example.odt', lazy=True)
+        container.save()
+        container.save()
+        new_container = odf_get_container('trash/example.odt')
+        self.assertEqual(new_container.get_part(ODF_CONTENT),
+                odf_get_container('samples/example.odt').get_part(ODF_CONTENT))
+        self.assertEqual(sorted(container.get_parts()),
+                sorted(new_container.get_parts()))
+
+
+    def test_save_lazy_same_path_clone(self):
+        data = open('samples/example.odt', 'rb').read()
+        open('trash/example.odt', 'wb').write(data)
+        container = odf_get_container('trash/example.odt', lazy=True)
+        clone = container.clone()
+        container.set_part(ODF_META, 'modified')
+        container.save()
+        self.assertEqual(clone.get_part(ODF_META),
+                odf_get_container('samples/example.odt').get_part(ODF_META))
+        new_container = odf_get_container('trash/example.odt')
+        self.assertEqual(new_container.get_part(ODF_META), 'modified')
+
+
+    def test_save_raw_copy(self):
+        container = odf_get_container('samples/example.odt')
+        container.set_part(ODF_META, container.get_part(ODF_META))
+        container.save('trash/example.odt')
+        source = ZipFile('samples/example.odt')
+        target = ZipFile('trash/example.odt')
+        for path in (ODF_CONTENT, 'Thumbnails/thumbnail.png'):
+            info, new_info = source.getinfo(path), target.getinfo(path)
+            self.assertEqual(new_info.CRC, info.CRC)
+            self.assertEqual(new_info.compress_size, info.compress_size)
+            self.assertEqual(target.read(path), source.read(path))
+        self.assertEqual(target.testzip(), None)
+        self.assertEqual(target.namelist()[0], 'mimetype')
+        self.assertEqual(target.namelist()[-1], 'META-INF/manifest.xml')
+
+
+    def test_save_raw_copy_deleted(self):
+        container = odf_get_container('samples/example.odt', lazy=True)
+        container.del_part('Thumbnails/thumbnail.png')
+        container.save('trash/example.odt')
+        target = ZipFile('trash/example.odt')
+        self.assert_('Thumbnails/thumbnail.png' not in target.namelist())
+        self.assertEqual(target.testzip(), None)
+
+
+    def test_save_workers(self):
+        container = odf_get_container('samples/example.odt')
+        for path in container.get_parts():
+            container.set_part(path, container.get_part(path))
+        submitted = []
+        deflate_async = lpod.container._deflate_async
+        def counting_deflate_async(pool, data, *args, **kw):
+            submitted.append(data)
+            return deflate_async(pool, data, *args, **kw)
+        lpod.container._deflate_async = counting_deflate_async
+        try:
+            container.save('trash/example.odt', workers=4)
+        finally:
+            lpod.container._deflate_async = deflate_async
+        # Compressed by the pool
+        self.assert_(container.get_part(ODF_CONTENT) in submitted)
+        target = ZipFile('trash/example.odt')
+        self.assertEqual(target.testzip(), None)
+        self.assertEqual(target.namelist()[0], 'mimetype')
+        self.assertEqual(target.namelist()[-1], 'META-INF/manifest.xml')
+        self.assertEqual(target.read(ODF_CONTENT),
+                container.get_part(ODF_CONTENT))
+
+
+    def test_save_block_size(self):
+        container = odf_get_container('samples/example.odt')
+        content = container.get_part(ODF_CONTENT)
+        container.set_part(ODF_CONTENT, content)
+        container.save('trash/example.odt', workers=4, block_size=1000)
+        target = ZipFile('trash/example.odt')
+        self.assertEqual(target.testzip(), None)
+        self.assertEqual(target.read(ODF_CONTENT), content)
+        # Blocks refer to the data before them
+        self.assert_(target.getinfo(ODF_CONTENT).compress_size
+                < len(compress(content)) * 1.25)
+
+
+    def test_save_block_size_writer(self):
+        container = odf_get_container('samples/example.odt')
+        content = container.get_part(ODF_CONTENT)
+        container.set_part_writer(ODF_CONTENT,
+                lambda file: file.write(content))
+        container.save('trash/example.odt', workers=4, block_size=1000)
+        target = ZipFile('trash/example.odt')
+        self.assertEqual(target.testzip(), None)
+        self.assertEqual(target.read(ODF_CONTENT), content)
+        # Blocks refer to the data before them
+        self.assert_(target.getinfo(ODF_CONTENT).compress_size
+                < len(compress(content)) * 1.25)
+
+
+    def test_save_compression(self):
+        container = odf_get_container('samples/example.odt')
+        data = open('samples/image.png', 'rb').read()
+        container.set_part('Pictures/image.png', data)
+        container.set_part(ODF_META, container.get_part(ODF_META))
+        container.set_part(ODF_CONTENT, container.get_part(ODF_CONTENT))
+        container.save('trash/example.odt', compression={ODF_CONTENT: 0},
+                level=9)
+        target = ZipFile('trash/example.odt')
+        self.assertEqual(target.testzip(), None)
+        info = target.getinfo('Pictures/image.png')
+        self.assertEqual(info.compress_type, ZIP_STORED)
+        self.assertEqual(target.read('Pictures/image.png'), data)
+        info = target.getinfo(ODF_CONTENT)
+        self.assertEqual(info.compress_type, ZIP_STORED)
+        info = target.getinfo(ODF_META)
+        self.assertEqual(info.compress_type, ZIP_DEFLATED)
+
+
+    def test_save_compression_no_manifest(self):
+        container = odf_get_container('samples/example.odt')
+        container.del_part(ODF_MANIFEST)
+        container.save('trash/example.odt')
+        target = ZipFile('trash/example.odt')
+        self.assertEqual(target.testzip(), None)
+        self.assert_(ODF_MANIFEST not in target.namelist())
+
+
+    def test_save_compression_bad_manifest(self):
+        container = odf_get_container('samples/example.odt')
+        container.set_part(ODF_MANIFEST, '<manifest:manifest')
+        self.assertRaises(XMLSyntaxError, container.save,
+                'trash/example.odt')
+
+
+    def test_save_compression_workers(self):
+        container = odf_get_container('samples/example.odt')
+        data = open('samples/image.png', 'rb').read()
+        container.set_part('Pictures/image.png', data)
+        container.save('trash/example.odt', workers=2, level=0)
+        target = ZipFile('trash/example.odt')
+        self.assertEqual(target.testzip(), None)
+        info = target.getinfo('Pictures/image.png')
+        self.assertEqual(info.compress_type, ZIP_STORED)
+
+
+    def test_save_part_writer(self):
+        container = odf_get_container('samples/example.odt')
+        data = container.get_part(ODF_CONTENT)
+        def writer(file, xml_declaration=True):
+            for i in xrange(0, len(data), 100):
+                file.write(data[i:i + 100])
+        container.set_part_writer(ODF_CONTENT, writer)
+        container.set_part_writer('Pictures/image.png', writer)
+        container.save('trash/example.odt')
+        target = ZipFile('trash/example.odt')
+        self.assertEqual(target.testzip(), None)
+        self.assertEqual(target.read(ODF_CONTENT), data)
+        info = target.getinfo('Pictures/image.png')
+        self.assertEqual(info.compress_type, ZIP_STORED)
+        self.assertEqual(target.read('Pictures/image.png'), data)
+
+
+    def test_save_part_writer_workers(self):
+        container = odf_get_container('samples/example.odt')
+        data = container.get_part(ODF_CONTENT)
+        def writer(file, xml_declaration=True):
+            file.write(data)
+        container.set_part_writer(ODF_CONTENT, writer)
+        container.set_part(ODF_META, container.get_part(ODF_META))
+        container.save('trash/example.odt', workers=2)
+        target = ZipFile('trash/example.odt')
+        self.assertEqual(target.testzip(), None)
+        self.assertEqual(target.read(ODF_CONTENT), data)
+
+
     def test_save_folder(self):
         container = odf_get_container('samples/example.odt')
         container.save('trash/example.odt', packaging='folder')
@@ -241,13 +602,72 @@ class ContainerSaveTestCase(TestCase):
 
 
 
-    # XXX We must implement the flat xml part
-    def xtest_save_flat(self):
-        """TODO: 2 cases
-           1. from "zip" to "flat"
-           2. from "flat" to "flat"
-        """
-        raise NotImplementedError
+    def test_save_flat(self):
+        container = odf_get_container('samples/example.xml')
+        container.save('trash/example.xml')
+        new_container = odf_get_container('trash/example.xml')
+        self.assertEqual(new_container.get_part('mimetype'),
+                ODF_EXTENSIONS['odt'])
+        content = new_container.get_part(ODF_CONTENT)
+        self.assert_(content.startswith('<office:document-content'))
+        self.assert_('This is an example.' in content)
+        # The standard layout
+        data = open('trash/example.xml').read()
+        self.assert_('<office:document-content' not in data)
+        self.assert_('<office:body>' in data)
+
+
+    def test_save_fodt(self):
+        container = odf_get_container('samples/example.fodt')
+        container.save('trash/example.fodt')
+        document = fromstring(open('trash/example.fodt').read())
+        office = ODF_NAMESPACES['office']
+        self.assertEqual(document.tag, '{%s}document' % office)
+        self.assertEqual(document.get('{%s}mimetype' % office),
+                ODF_EXTENSIONS['odt'])
+        self.assertEqual(document.get('{%s}version' % office), '1.2')
+        self.assertEqual([child.tag.split('}')[1] for child in document],
+                ['meta', 'settings', 'font-face-decls', 'styles',
+                 'automatic-styles', 'master-styles', 'body'])
+        # Merged automatic styles and font faces
+        style = '{%s}name' % ODF_NAMESPACES['style']
+        self.assertEqual([child.get(style) for child in document[4]],
+                ['P1', 'MP1', 'pm1'])
+        self.assertEqual(len(document[2]), 2)
+        new_container = odf_get_container('trash/example.fodt')
+        for path in (ODF_CONTENT, ODF_META, ODF_SETTINGS, ODF_STYLES):
+            self.assertEqual(fromstring(new_container.get_part(path)).tag,
+                    fromstring(container.get_part(path)).tag)
+
+
+    def test_save_zip_to_flat(self):
+        container = odf_get_container('samples/example.odt')
+        container.save('trash/example.xml', packaging='flat')
+        new_container = odf_get_container('trash/example.xml')
+        self.assertEqual(new_container.get_part('mimetype'),
+                ODF_EXTENSIONS['odt'])
+        content = new_container.get_part(ODF_CONTENT)
+        self.assert_(content.startswith('<office:document-content'))
+        self.assert_('This is the first paragraph.' in content)
+
+
+    def test_save_zipfile(self):
+        container = odf_get_container('samples/example.odt')
+        file = StringIO()
+        filezip = ZipFile(file, 'w')
+        filezip.writestr('mimetype', ODF_EXTENSIONS['odt'])
+        filezip.writestr(ODF_CONTENT, '<office:document-content/>')
+        container.save(filezip)
+        names = ZipFile(file).namelist()
+        self.assertEqual(names.count(ODF_CONTENT), 1)
+        self.assertEqual(names.count('mimetype'), 1)
+        self.assertEqual(names[-1], 'META-INF/manifest.xml')
+        file.seek(0)
+        new_container = odf_get_container(file)
+        self.assertEqual(new_container.get_part(ODF_CONTENT),
+                '<office:document-content/>')
+        self.assertEqual(new_container.get_part(ODF_META),
+                container.get_part(ODF_META))
 
 
 
@@ -27,6 +27,7 @@
 #
 
 # Import from the Standard Library
+from cStringIO import StringIO
 from unittest import TestCase, main
 
 # Import from lpod
@@ -68,5 +69,108 @@ class ContentTestCase(TestCase):
 
 
 
+    def test_iter_body(self):
+        tags = [element.get_tag() for element in self.content.iter_body()]
+        body = self.content.get_body()
+        self.assertEqual(tags, [child.get_tag()
+                                for child in body.get_children()])
+
+
+    def test_iter_body_stream(self):
+        document = odf_get_document('samples/base_text.odt', lazy=True)
+        content = document.get_part(ODF_CONTENT)
+        expected = [child.get_tag()
+                    for child in self.content.get_body().get_children()]
+        tags = [element.get_tag() for element in content.iter_body()]
+        self.assertEqual(tags, expected)
+        # Not loaded
+        self.assertEqual(content._is_loaded(), False)
+
+
+    def test_iter_body_tags(self):
+        document = odf_get_document('samples/base_text.odt', lazy=True)
+        content = document.get_part(ODF_CONTENT)
+        expected = [paragraph.get_text(recursive=True)
+                    for paragraph in self.content.get_body().get_paragraphs()]
+        texts = [paragraph.get_text(recursive=True)
+                 for paragraph in content.iter_body('text:p')]
+        self.assertEqual(sorted(texts), sorted(expected))
+
+
+    def test_iter_body_cleared(self):
+        document = odf_get_document('samples/base_text.odt', lazy=True)
+        content = document.get_part(ODF_CONTENT)
+        paragraphs = content.iter_body('text:p')
+        first = paragraphs.next()
+        self.assertNotEqual(first.get_children() + [first.get_text()], [None])
+        paragraphs.next()
+        self.assertEqual(first.get_children() + [first.get_text()], [None])
+
+
+
+class LazyTablesTestCase(TestCase):
+
+    def setUp(self):
+        self.document = odf_get_document('samples/simple_table.ods',
+                lazy_tables=True)
+        self.body = self.document.get_body()
+
+
+    def get_row_counts(self):
+        return [len(table.get_elements('table:table-row'))
+                for table in self.body.get_elements('table:table')]
+
+
+    def test_unloaded(self):
+        self.assertEqual(self.get_row_counts(), [0, 0, 0])
+
+
+    def test_get_table_name(self):
+        table = self.body.get_table(name=u"Example3")
+        self.assertEqual(table.get_value('A1'), u"A float")
+        self.assertEqual(self.get_row_counts(), [0, 0, 2])
+
+
+    def test_get_table_position(self):
+        table = self.body.get_table(position=1)
+        self.assertEqual(table.get_name(), u"Example2")
+        self.assertEqual(self.get_row_counts(), [4, 1, 0])
+
+
+    def test_get_tables(self):
+        self.assertEqual(len(self.body.get_tables()), 3)
+        self.assertEqual(self.get_row_counts(), [4, 1, 2])
+
+
+    def test_serialize(self):
+        expected = odf_get_document('samples/simple_table.ods')
+        expected = expected.get_part(ODF_CONTENT).serialize()
+        content = self.document.get_part(ODF_CONTENT)
+        self.assertEqual(content.serialize(), expected)
+        self.body.get_table(name=u"Example2")
+        self.assertEqual(content.serialize(), expected)
+
+
+    def test_save(self):
+        table = self.body.get_table(name=u"Example3")
+        table.set_value('A1', u"Changed")
+        file = StringIO()
+        self.document.save(file)
+        file.seek(0)
+        document = odf_get_document(file)
+        tables = document.get_body().get_tables()
+        self.assertEqual(tables[2].get_value('A1'), u"Changed")
+        self.assertEqual(tables[0].get_value('G4'), 7)
+        self.assertEqual(tables[1].get_values(), [[None]])
+
+
+    def test_clone(self):
+        document = self.document.clone()
+        body = document.get_part(ODF_CONTENT).get_body()
+        tables = body.get_elements('table:table')
+        self.assertEqual(len(tables[0].get_elements('table:table-row')), 4)
+
+
+
 if __name__ == '__main__':
     main()
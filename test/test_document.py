@@ -31,16 +31,24 @@
 # Import from the Standard Library
 from cStringIO import StringIO
 from ftplib import FTP
+from os import mkdir
+from shutil import rmtree
 from unittest import TestCase, main
 from urllib2 import urlopen
+from zipfile import ZipFile
+from zlib import compress
 
 # Import from lpod
+import lpod.container
+import lpod.document
 from lpod.const import ODF_EXTENSIONS, ODF_CONTENT, ODF_MANIFEST, ODF_META
 from lpod.const import ODF_STYLES
 from lpod.content import odf_content
 from lpod.document import odf_new_document, odf_get_document
+from lpod.document import odf_clear_template_cache
 from lpod.manifest import odf_manifest
 from lpod.meta import odf_meta
+from lpod.paragraph import odf_create_paragraph
 from lpod.styles import odf_styles
 
 
@@ -80,6 +88,25 @@ class NewDocumentFromTemplateTestCase(TestCase):
         self.assertFalse('template' in media_type)
 
 
+    def test_cached(self):
+        document = odf_new_document('text')
+        document.get_body().append(odf_create_paragraph(u"Hello"))
+        other = odf_new_document('text')
+        self.assertEqual(other.get_body().get_paragraphs(), [])
+        self.assert_(other.get_part(ODF_CONTENT).container is other.container)
+
+
+    def test_clear_cache(self):
+        odf_clear_template_cache()
+        odf_new_document('text')
+        odf_new_document('spreadsheet')
+        self.assertEqual(len(lpod.document._template_documents), 2)
+        odf_clear_template_cache('text')
+        self.assertEqual(len(lpod.document._template_documents), 1)
+        odf_clear_template_cache()
+        self.assertEqual(lpod.document._template_documents, {})
+
+
 
 class NewdocumentFromTypeTestCase(TestCase):
 
@@ -119,6 +146,27 @@ class GetDocumentTestCase(TestCase):
         path = 'samples/example.xml'
         self.assert_(odf_get_document(path))
 
+
+    def test_odf_xml_body(self):
+        document = odf_get_document('samples/example.xml')
+        paragraph = document.get_body().get_paragraph()
+        self.assertEqual(paragraph.get_text(), u"This is an example.")
+
+
+    def test_fodt_body(self):
+        document = odf_get_document('samples/example.fodt')
+        paragraphs = document.get_body().get_paragraphs()
+        self.assertEqual([paragraph.get_text() for paragraph in paragraphs],
+                [u"This is a flat example.", u"It has a second paragraph."])
+        style = document.get_style('paragraph', u"Text_20_body")
+        self.assertEqual(style.get_display_name(), u"Text body")
+
+
+    def test_lazy(self):
+        path = 'samples/example.odt'
+        document = odf_get_document(path, lazy=True)
+        self.assert_(document.get_body().get_paragraphs())
+
 #fixme : reactivitate ftp
 
 
@@ -168,6 +216,16 @@ class DocumentTestCase(TestCase):
         self.assertEqual(parts.keys(), ['content.xml'])
         container = clone.container
         self.assertEqual(container.path, None)
+        self.assert_(parts['content.xml'].container is container)
+
+
+    def test_clone_modified(self):
+        document = self.document.clone()
+        body = document.get_body()
+        count = len(body.get_paragraphs())
+        clone = document.clone()
+        body.get_paragraph().delete()
+        self.assertEqual(len(clone.get_body().get_paragraphs()), count)
 
 
     def test_save_nogenerator(self):
@@ -191,6 +249,113 @@ class DocumentTestCase(TestCase):
         self.assertEqual(generator, u"toto")
 
 
+    def test_save_unmodified(self):
+        document = odf_get_document('samples/example.odt')
+        document.get_styles()
+        document.get_body().get_paragraph().set_text(u"Modified")
+        temp = StringIO()
+        document.save(temp)
+        source = ZipFile('samples/example.odt')
+        target = ZipFile(temp)
+        # Read but not modified
+        info, new_info = source.getinfo(ODF_STYLES), target.getinfo(ODF_STYLES)
+        self.assertEqual(new_info.CRC, info.CRC)
+        self.assertEqual(new_info.compress_size, info.compress_size)
+        self.assertNotEqual(target.getinfo(ODF_CONTENT).CRC,
+                source.getinfo(ODF_CONTENT).CRC)
+
+
+    def test_save_stream(self):
+        document = odf_get_document('samples/example.odt')
+        content = document.get_part(ODF_CONTENT)
+        content.get_body().get_paragraph().set_text(u"Modified")
+        for packaging in ('zip', 'flat'):
+            temp = StringIO()
+            document.save(temp, packaging=packaging)
+            temp.seek(0)
+            new = odf_get_document(temp)
+            if packaging == 'zip':
+                self.assertEqual(new.get_part(ODF_CONTENT).serialize(),
+                        content.serialize())
+            paragraph = new.get_body().get_paragraph()
+            self.assertEqual(paragraph.get_text(), u"Modified")
+
+
+    def test_save_workers(self):
+        document = self.document.clone()
+        content = document.get_part(ODF_CONTENT)
+        content.get_body().get_paragraph().set_text(u"Modified")
+        submitted = []
+        deflate_async = lpod.container._deflate_async
+        def counting_deflate_async(pool, data, *args, **kw):
+            submitted.append(data)
+            return deflate_async(pool, data, *args, **kw)
+        lpod.container._deflate_async = counting_deflate_async
+        try:
+            temp = StringIO()
+            document.save(temp, workers=2)
+        finally:
+            lpod.container._deflate_async = deflate_async
+        # The modified content was compressed by the pool
+        self.assert_(content.serialize() in submitted)
+        temp.seek(0)
+        new = odf_get_document(temp)
+        self.assertEqual(new.get_part(ODF_CONTENT).serialize(),
+                document.get_part(ODF_CONTENT).serialize())
+
+
+    def test_save_block_size(self):
+        document = odf_get_document('samples/example.odt')
+        content = document.get_part(ODF_CONTENT)
+        content.get_body().get_paragraph().set_text(u"Modified")
+        starts = []
+        deflate = lpod.container._deflate
+        def counting_deflate(data, start=0, end=None, *args):
+            starts.append(start)
+            return deflate(data, start, end, *args)
+        lpod.container._deflate = counting_deflate
+        try:
+            temp = StringIO()
+            document.save(temp, workers=2, block_size=1000)
+        finally:
+            lpod.container._deflate = deflate
+        # The modified content was split in blocks
+        self.assert_(len([start for start in starts if start > 0]) > 0)
+        temp.seek(0)
+        new = odf_get_document(temp)
+        self.assertEqual(new.get_part(ODF_CONTENT).serialize(),
+                content.serialize())
+
+
+    def test_save_block_size_compressed(self):
+        document = odf_get_document('samples/example.odt')
+        content = document.get_part(ODF_CONTENT)
+        content.get_body().get_paragraph().set_text(u"Modified")
+        temp = StringIO()
+        document.save(temp, workers=4, block_size=1000)
+        target = ZipFile(temp)
+        self.assertEqual(target.testzip(), None)
+        data = target.read(ODF_CONTENT)
+        self.assertEqual(data, content.serialize())
+        # Blocks refer to the data before them
+        self.assert_(target.getinfo(ODF_CONTENT).compress_size
+                < len(compress(data)) * 1.25)
+
+
+    def test_save_compact(self):
+        document = odf_get_document('samples/simple_table.ods')
+        table = document.get_body().get_table(0)
+        values = table.get_values()
+        table.set_value((1, 1), 1)
+        temp = StringIO()
+        document.save(temp, compact=True)
+        temp.seek(0)
+        new = odf_get_document(temp)
+        table = new.get_body().get_table(0)
+        self.assertEqual(table.get_values(), values)
+        self.assertEqual(table.compact(), 0)
+
+
 
 class TestStyle(TestCase):
 
@@ -263,5 +428,47 @@ class TestStyle(TestCase):
 
 
 
+class ExportCSVTestCase(TestCase):
+
+    def setUp(self):
+        mkdir('trash')
+        self.document = odf_get_document('samples/simple_table.ods')
+
+
+    def tearDown(self):
+        rmtree('trash')
+
+
+    def test_export_csv(self):
+        paths = self.document.export_csv('trash')
+        tables = self.document.get_body().get_tables()
+        self.assertEqual(paths, ['trash/%s.csv' % table.get_name()
+                                 for table in tables])
+        for path, table in zip(paths, tables):
+            self.assertEqual(open(path, 'rb').read(), table.to_csv())
+
+
+    def test_export_csv_processes(self):
+        paths = self.document.export_csv('trash', delimiter=';', processes=2)
+        tables = self.document.get_body().get_tables()
+        self.assertEqual(len(paths), len(tables))
+        for path, table in zip(paths, tables):
+            self.assertEqual(open(path, 'rb').read(),
+                    table.to_csv(delimiter=';'))
+
+
+    def test_export_csv_same_name(self):
+        body = self.document.get_body()
+        for table, name in zip(body.get_tables(), [u"a/b", u"a_b", u"a_b_2"]):
+            # Not checked as by set_name, like read from a document
+            table.set_attribute('table:name', name)
+        paths = self.document.export_csv('trash')
+        self.assertEqual(paths, ['trash/a_b.csv', 'trash/a_b_2.csv',
+                                 'trash/a_b_2_2.csv'])
+        for path, table in zip(paths, body.get_tables()):
+            self.assertEqual(open(path, 'rb').read(), table.to_csv())
+
+
+
 if __name__ == '__main__':
     main()
@@ -28,24 +28,124 @@
 #
 
 # Import from the Standard Library
+from bisect import bisect_right
 from datetime import date, datetime, timedelta
 from decimal import Decimal as dec
 from cStringIO import StringIO
+from os import mkdir
+from os.path import exists
+from shutil import rmtree
 from unittest import TestCase, main
 
 # Import from lpod
+from lpod.const import ODF_CONTENT
+from lpod.container import odf_get_container
 from lpod.document import odf_get_document
 from lpod.table import _alpha_to_digit, _digit_to_alpha
 from lpod.table import _convert_coordinates, odf_cell, odf_row
 from lpod.table import odf_create_cell, odf_create_row, odf_create_column
 from lpod.table import odf_create_table, import_from_csv, odf_column
 from lpod.table import odf_create_named_range, import_from_csv, odf_column
+from lpod.table import iter_sheet_values, odf_spreadsheet_writer
+from lpod.table import odf_row_index, _repeat_map
 
 
 csv_data = '"A float","3.14"\n"A date","1975-05-07"\n'
 
 
 
+class _small_repeat_map(_repeat_map):
+    # Split often
+    block_size = 2
+
+
+
+class TestRepeatMap(TestCase):
+
+    def check(self, map, repeats):
+        ends = []
+        end = -1
+        for repeated in repeats:
+            end += repeated
+            ends.append(end)
+        self.assertEqual(len(map), len(ends))
+        self.assertEqual(list(map), ends)
+        self.assertEqual([map[i] for i in xrange(len(ends))], ends)
+        for position in xrange(-1, end + 2):
+            expected = bisect_right(ends, position - 1)
+            if expected == len(ends):
+                expected = None
+            elif position < 0:
+                expected = 0
+            self.assertEqual(map.find(position), expected)
+
+
+    def test_empty(self):
+        map = _repeat_map()
+        self.check(map, [])
+        self.assertEqual(map.find(-1), None)
+        self.assertRaises(IndexError, map.erase, 0)
+
+
+    def test_init(self):
+        repeats = [1, 3, 1, 2, 5, 1, 1, 4]
+        self.check(_small_repeat_map(repeats), repeats)
+
+
+    def test_insert_split(self):
+        map = _small_repeat_map()
+        repeats = []
+        for i, repeated in enumerate([2, 1, 3, 1, 1, 4, 2, 1, 1, 5]):
+            # At the start, the end and in the middle of the blocks
+            odf_idx = (i * 3) % (len(repeats) + 1)
+            map.insert(odf_idx, repeated)
+            repeats.insert(odf_idx, repeated)
+            self.check(map, repeats)
+        map.append(3)
+        repeats.append(3)
+        self.check(map, repeats)
+
+
+    def test_erase_merge(self):
+        repeats = [1, 2, 3, 1, 1, 2, 4, 1, 3]
+        map = _small_repeat_map(repeats)
+        while repeats:
+            # Blocks emptied are removed
+            odf_idx = len(repeats) // 2
+            self.assertEqual(map.erase(odf_idx), repeats.pop(odf_idx))
+            self.check(map, repeats)
+        map.insert(0, 2)
+        self.check(map, [2])
+
+
+    def test_delitem(self):
+        map = _small_repeat_map([1, 2, 3])
+        del map[1]
+        self.check(map, [1, 3])
+        del map[:]
+        self.check(map, [])
+
+
+    def test_delitem_slice(self):
+        repeats = [1, 2, 3, 1, 1, 2, 4, 1, 3]
+        for key in (slice(1, 3), slice(2, None), slice(None, -4),
+                    slice(1, None, 2), slice(5, 2)):
+            map = _small_repeat_map(repeats)
+            expected = repeats[:]
+            del map[key]
+            del expected[key]
+            self.check(map, expected)
+
+
+    def test_clear(self):
+        map = _small_repeat_map([1, 2, 3, 1, 1])
+        map.clear()
+        self.check(map, [])
+        map.append(2)
+        self.check(map, [2])
+
+
+
 class TestCoordinates(TestCase):
 
     def test_digit_to_alpha_to_digit(self):
@@ -705,6 +805,15 @@ class TestRowCell(TestCase):
         self.assertEqual(len(list(self.row.traverse())), 7)
 
 
+    def test_traverse_no_clone(self):
+        row = odf_create_row()
+        row.append_cell(odf_create_cell(u"x", repeated=3))
+        cells = [(cell, cell.x) for cell in row.traverse(clone=False)]
+        self.assertEqual([x for cell, x in cells], [0, 1, 2])
+        self.assert_(cells[0][0] is cells[2][0])
+        self.assertEqual(cells[0][0].get_repeated(), 3)
+
+
     def test_traverse_coord(self):
         self.assertEqual(len(list(self.row.traverse(2, None))), 5)
         self.assertEqual(len(list(self.row.traverse(2, 4))), 3)
@@ -925,6 +1034,14 @@ class TestRowCell(TestCase):
         self.assertEqual(row.get_width(), 7)
 
 
+    def test_set_cell_in_place(self):
+        row = self.row.clone()
+        row.set_value(3, 3.14)
+        self.assertEqual(len(row.get_elements('table:table-cell')), 7)
+        self.assertEqual(row.get_values(),
+                [1, 1, 1, dec('3.14'), 3, 3, 3])
+
+
     def test_set_cell_far_away(self):
         row = self.row.clone()
         row.set_value(7 + 3, 3.14)
@@ -1270,6 +1387,13 @@ class TestRowCell(TestCase):
         self.assertEqual(row.get_cell(4).get_currency(), 'EUR')
 
 
+    def test_set_values_repeated(self):
+        row = odf_create_row()
+        row.set_values([1, 1, 1, u"a", None, None, 2])
+        self.assertEqual(row.get_values(), [1, 1, 1, u"a", None, None, 2])
+        self.assertEqual(len(row.get_elements('table:table-cell')), 4)
+
+
 
 class TestRowCellGetValues(TestCase):
 
@@ -1977,6 +2101,41 @@ class TestTable(TestCase):
                      u'o', None, None]])
 
 
+    def test_set_table_values_repeated(self):
+        table = odf_create_table(u"Table")
+        values = [[1, 2, 2]] * 3 + [[], [u"a"]]
+        table.set_values(values)
+        self.assertEqual(table.get_size(), (3, 5))
+        self.assertEqual(table.get_values(),
+                [[1, 2, 2], [1, 2, 2], [1, 2, 2], [None, None, None],
+                 [u"a", None, None]])
+        self.assertEqual(len(table.get_elements('table:table-row')), 3)
+
+
+    def test_set_table_values_empty_rows(self):
+        table = odf_create_table(u"Table", width=3, height=10)
+        table.set_values([[1, 2, 3]] * 2, coord=(0, 4))
+        self.assertEqual(table.get_size(), (3, 10))
+        self.assertEqual(table.get_values((0, 3, 2, 6)),
+                [[None, None, None], [1, 2, 3], [1, 2, 3],
+                 [None, None, None]])
+
+
+    def test_set_table_values_repeated_rows(self):
+        for coord, y in (('A2', 1), ('A3', 2)):
+            # At the start and in the middle of a run of repeated rows
+            table = odf_create_table(u"Table", width=2, height=1)
+            table.append_row(odf_create_row(width=2, repeated=4))
+            table.set_values([[1, 2]], coord=coord)
+            self.assertEqual(table.get_size(), (2, 5))
+            expected = [[None, None]] * 5
+            expected[y] = [1, 2]
+            self.assertEqual(table.get_values(), expected)
+            repeated = [row.get_repeated() or 1
+                        for row in table.get_elements('table:table-row')]
+            self.assertEqual(sum(repeated), 5)
+
+
     def test_set_table_values_small_type(self):
         table = self.table.clone()
         values = [[10, None, 30],
@@ -2004,6 +2163,31 @@ class TestTable(TestCase):
         table.rstrip()
         self.assertEqual(table.get_size(), (5, 9))
 
+
+    def test_compact(self):
+        table = odf_create_table(u"Table")
+        table.set_values([[1, 1, 1, 2]] * 3 + [[1, 2, 3, 4]])
+        values = table.get_values()
+        # Split the repeated cells and rows
+        for y in xrange(3):
+            table.set_value((1, y), 1)
+        self.assertEqual(len(table.get_elements('table:table-row')), 4)
+        self.assertEqual(table.compact(), 8)
+        self.assertEqual(table.get_values(), values)
+        self.assertEqual(len(table.get_elements('table:table-row')), 2)
+        self.assertEqual(table.get_elements('table:table-row')[0]
+                .get_repeated(), 3)
+        self.assertEqual(table.compact(), 0)
+
+
+    def test_compact_row(self):
+        row = odf_create_row()
+        row.set_values([1, 1, 2])
+        row.append_cell(odf_create_cell(2))
+        self.assertEqual(row.compact(), 1)
+        self.assertEqual(row.get_values(), [1, 1, 2, 2])
+        self.assertEqual(len(row.get_elements('table:table-cell')), 2)
+
 # simpletable :
     #   1	1	1	2	3	3	3
     #   1	1	1	2	3	3	3
@@ -3008,6 +3192,45 @@ class TestTableGetValues(TestCase):
 
 
 
+    def test_to_columns(self):
+        columns = self.table.to_columns()
+        self.assertEqual(len(columns), 7)
+        column_type, values, nulls = columns[1]
+        self.assertEqual(column_type, 'float')
+        self.assertEqual(values.tolist(), [1.0, 1.0, 1.0, 2.0])
+        self.assertEqual(nulls.tolist(), [0])
+
+
+    def test_to_columns_types(self):
+        table = odf_create_table(u"Table")
+        table.set_values([[u"a", date(2012, 3, 4), True],
+                          [u"a", None, False],
+                          [None, date(2012, 3, 5), 1]])
+        strings, dates, mixed = table.to_columns()
+        self.assertEqual(strings[0], 'string')
+        self.assertEqual(strings[1], [u"a", u"a", None])
+        self.assert_(strings[1][0] is strings[1][1])
+        self.assertEqual(strings[2].tolist(), [4])
+        self.assertEqual(dates[0], 'date')
+        self.assertEqual(dates[1].tolist(),
+                [date(2012, 3, 4).toordinal(), 0, date(2012, 3, 5).toordinal()])
+        self.assertEqual(dates[2].tolist(), [2])
+        self.assertEqual(mixed[0], 'mixed')
+        self.assertEqual(mixed[1], [True, False, 1.0])
+
+
+    def test_to_columns_coord(self):
+        table = self.table.clone()
+        table.set_row(1, odf_create_row(width=2, repeated=2))
+        columns = table.to_columns('B2:C5')
+        self.assertEqual(len(columns), 2)
+        column_type, values, nulls = columns[1]
+        self.assertEqual(column_type, 'float')
+        self.assertEqual(values.tolist(), [0.0, 0.0, 3.0])
+        self.assertEqual(nulls.tolist(), [3])
+
+
+
 class TestTableCache(TestCase):
 
     def setUp(self):
@@ -3136,6 +3359,15 @@ class TestTableRow(TestCase):
         self.assertEqual(len(list(self.table.traverse())), 4)
 
 
+    def test_traverse_rows_no_clone(self):
+        table = self.table.clone()
+        table.get_elements('table:table-row')[1].set_repeated(2)
+        rows = [(row, row.y) for row in table.traverse(clone=False)]
+        self.assertEqual([y for row, y in rows], range(5))
+        self.assert_(rows[1][0] is rows[2][0])
+        self.assertEqual(rows[1][0].get_repeated(), 2)
+
+
     def test_get_row_values(self):
         self.assertEqual(self.table.get_row_values(3), [1, 2, 3, 4, 5, 6, 7])
 
@@ -3207,6 +3439,29 @@ class TestTableRow(TestCase):
         self.assertEqual(table.get_width(), 7)
 
 
+    def test_set_row_repeated_overlap(self):
+        table = self.table.clone()
+        row = table.get_row(3)
+        row.set_repeated(2)
+        table.set_row(1, row)
+        self.assertEqual(table.get_values(),
+                [[1, 1, 1, 2, 3, 3, 3],
+                 [1, 2, 3, 4, 5, 6, 7],
+                 [1, 2, 3, 4, 5, 6, 7],
+                 [1, 2, 3, 4, 5, 6, 7]])
+
+
+    def test_set_row_keep_indexes(self):
+        table = self.table.clone()
+        row = table.get_row(3, clone=False)
+        table.set_row(1, odf_create_row(width=7))
+        self.assert_(table.get_row(3, clone=False) is row)
+        table.insert_row(0, odf_create_row(width=7))
+        self.assert_(table.get_row(4, clone=False) is row)
+        table.delete_row(0)
+        self.assert_(table.get_row(3, clone=False) is row)
+
+
     def test_set_row_smaller(self):
         table = self.table.clone()
         table.set_row(0, odf_create_row(width=table.get_width() - 1))
@@ -3989,8 +4244,252 @@ class TestCSV(TestCase):
         self.assertEqual(self.table.serialize(), expected)
 
 
-    def _test_export_to_csv(self):
-        raise NotImplementedError
+    def test_import_from_csv_types(self):
+        data = ('"id";"price";"name"\n' + '1;2.5;"a"\n' * 150
+                + '2;3;"true"\n' + 'x;;"b"\n')
+        table = import_from_csv(StringIO(data), u"Types")
+        self.assertEqual(table.get_size(), (3, 153))
+        self.assertEqual(table.get_values((0, 150, 2, 152)),
+                [[1, 2.5, u"a"], [2, 3, True], [u"x", u"", u"b"]])
+        self.assertEqual(table.get_value((1, 151), get_type=True),
+                (3, u"float"))
+        self.assertEqual(len(table.get_elements('table:table-row')), 4)
+
+
+    def test_import_from_csv_empty_lines(self):
+        data = '"a";"b"\n\n"c";"d"\n;\n\n\n'
+        table = import_from_csv(StringIO(data), u"Empty")
+        self.assertEqual(table.get_height(), 6)
+        self.assertEqual(table.get_values(),
+                [[u"a", u"b"], [None, None], [u"c", u"d"]] + [[None, None]] * 3)
+
+
+    def test_export_to_csv(self):
+        table = odf_create_table(u"Table")
+        table.set_values([[u' a "b" ', 1.5, None], [True, None, 3]] * 2)
+        expected = ('"a ""b""";"1.5";""\r\n' '"True";"";"3"\r\n') * 2
+        self.assertEqual(table.to_csv(delimiter=';', lineterminator='\r\n'),
+                expected)
+        self.assertEqual(table.to_csv(delimiter='; '),
+                expected.replace(';', '; ').replace('\r\n', '\n'))
+
+
+
+class TestIterSheetValues(TestCase):
+
+    def setUp(self):
+        self.path = 'samples/simple_table.ods'
+
+
+    def test_first_sheet(self):
+        document = odf_get_document(self.path)
+        table = document.get_body().get_table(position=0)
+        expected = table.get_values()
+        self.assertEqual(list(iter_sheet_values(self.path)), expected)
+
+
+    def test_sheet_by_name(self):
+        values = list(iter_sheet_values(self.path, sheet=u"Example3"))
+        self.assertEqual(values, [[u'A float', dec('3.14')],
+                                  [u'A date', datetime(1975, 5, 7)]])
+
+
+    def test_sheet_by_position(self):
+        values = list(iter_sheet_values(self.path, sheet=2))
+        self.assertEqual(values[0], [u'A float', dec('3.14')])
+
+
+    def test_empty_sheet(self):
+        # Trailing empty rows and cells are dropped
+        self.assertEqual(list(iter_sheet_values(self.path, sheet=1)), [])
+
+
+    def test_missing_sheet(self):
+        values = iter_sheet_values(self.path, sheet=u"Nothing")
+        self.assertRaises(ValueError, list, values)
+
+
+    def test_width(self):
+        values = list(iter_sheet_values(self.path, sheet=2, width=3))
+        self.assertEqual(values, [[u'A float', dec('3.14'), None],
+                                  [u'A date', datetime(1975, 5, 7), None]])
+
+
+    def test_get_type(self):
+        values = iter_sheet_values(self.path, sheet=2, get_type=True)
+        self.assertEqual(values.next(), [(u'A float', u'string'),
+                                         (dec('3.14'), u'float')])
+
+
+    def test_inner_empty_rows(self):
+        document = odf_get_document(self.path)
+        table = document.get_body().get_table(position=0)
+        table.set_value((1, 7), 42)
+        file = StringIO()
+        document.save(file)
+        file.seek(0)
+        values = list(iter_sheet_values(file))
+        self.assertEqual(len(values), 8)
+        self.assertEqual(values[4:7], [[], [], []])
+        self.assertEqual(values[7], [None, 42])
+
+
+
+class TestSpreadsheetWriter(TestCase):
+
+    def setUp(self):
+        self.file = file = StringIO()
+        writer = odf_spreadsheet_writer(file)
+        writer.add_table(u"Writer", width=3)
+        writer.append_row([1, 1, 2])
+        writer.append_row([1, 1, 2])
+        writer.append_row([])
+        writer.append_row([None, u"A string", dec('3.14')])
+        writer.add_table(u"Writer 2")
+        for i in range(3):
+            writer.append_row([i])
+        writer.close()
+        file.seek(0)
+
+
+    def test_values(self):
+        document = odf_get_document(self.file)
+        tables = document.get_body().get_tables()
+        self.assertEqual(len(tables), 2)
+        self.assertEqual(tables[0].get_name(), u"Writer")
+        self.assertEqual(tables[0].get_values(),
+                [[1, 1, 2], [1, 1, 2], [None, None, None],
+                 [None, u"A string", dec('3.14')]])
+        self.assertEqual(tables[1].get_values(), [[0], [1], [2]])
+
+
+    def test_repeated(self):
+        document = odf_get_document(self.file)
+        table = document.get_body().get_table(name=u"Writer")
+        rows = table.get_elements('table:table-row')
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0].get_repeated(), 2)
+        cells = rows[0].get_elements('table:table-cell')
+        self.assertEqual(len(cells), 2)
+        self.assertEqual(cells[0].get_repeated(), 2)
+
+
+    def test_parts(self):
+        document = odf_get_document(self.file)
+        self.assertEqual(document.get_type(), 'spreadsheet')
+        self.assertEqual(document.get_part('mimetype'),
+                'application/vnd.oasis.opendocument.spreadsheet')
+        self.assert_(document.get_part('styles.xml') is not None)
+
+
+    def test_closed(self):
+        writer = odf_spreadsheet_writer(StringIO())
+        writer.add_table(u"Writer")
+        writer.close()
+        self.assertRaises(ValueError, writer.add_table, u"Writer 2")
+        self.assertRaises(ValueError, writer.append_row, [1])
+
+
+    def test_no_table(self):
+        writer = odf_spreadsheet_writer(StringIO())
+        self.assertRaises(ValueError, writer.append_row, [1])
+
+
+
+class TestRowIndex(TestCase):
+
+    def setUp(self):
+        mkdir('trash')
+        self.index = odf_row_index('samples/simple_table.ods',
+                index_path='trash/simple_table.index', step=2)
+
+
+    def tearDown(self):
+        rmtree('trash')
+
+
+    def test_index_path(self):
+        self.assert_(exists('trash/simple_table.index'))
+        index = odf_row_index('samples/simple_table.ods',
+                index_path='trash/simple_table.index')
+        self.assertEqual(index.tables, self.index.tables)
+
+
+    def test_index_format(self):
+        data = open('trash/simple_table.index', 'rb').read()
+        self.assert_(data.startswith(odf_row_index.magic))
+        # Truncated
+        file = open('trash/simple_table.index', 'wb')
+        file.write(data[:-1])
+        file.close()
+        index = odf_row_index('samples/simple_table.ods',
+                index_path='trash/simple_table.index', step=2)
+        self.assertEqual(index.tables, self.index.tables)
+        self.assertEqual(open('trash/simple_table.index', 'rb').read(), data)
+
+
+    def test_index_not_loaded(self):
+        # Not even read, pickles could run code
+        file = open('trash/simple_table.index', 'wb')
+        file.write("cos\nsystem\n(S'exit 1'\ntR.")
+        file.close()
+        index = odf_row_index('samples/simple_table.ods',
+                index_path='trash/simple_table.index', step=2)
+        self.assertEqual(index.tables, self.index.tables)
+        data = open('trash/simple_table.index', 'rb').read()
+        self.assert_(data.startswith(odf_row_index.magic))
+
+
+    def test_sheets(self):
+        index = self.index
+        self.assertEqual(index.get_sheet_names(),
+                [u"Example1", u"Example2", u"Example3"])
+        self.assertEqual(index.get_height(), 4)
+        self.assertEqual(index.get_height(u"Example3"), 2)
+
+
+    def test_get_row(self):
+        row = self.index.get_row(2)
+        self.assertEqual(row.y, 2)
+        self.assertEqual(row.get_values(), [1, 1, 1, 2, 3, 3, 3])
+        self.assertEqual(self.index.get_row(4), None)
+
+
+    def test_get_value(self):
+        index = self.index
+        self.assertEqual(index.get_value('G4'), 7)
+        self.assertEqual(index.get_value((1, 1), sheet=u"Example3"),
+                datetime(1975, 5, 7))
+        self.assertEqual(index.get_value('A1', sheet=1, get_type=True),
+                (None, None))
+
+
+    def test_changed(self):
+        document = odf_get_document('samples/simple_table.ods')
+        document.save('trash/changed.ods')
+        index = odf_row_index('trash/changed.ods')
+        self.assertEqual(index.get_value('A1'), 1)
+        table = document.get_body().get_table(position=0)
+        table.set_value('A1', 42)
+        document.save('trash/changed.ods')
+        index = odf_row_index('trash/changed.ods')
+        self.assertEqual(index.get_value('A1'), 42)
+
+
+    def test_checkpoints(self):
+        writer = odf_spreadsheet_writer('trash/big.ods')
+        writer.add_table(u"Big")
+        for y in range(2000):
+            writer.append_row([y, u"Row %d" % y])
+        writer.close()
+        container = odf_get_container('trash/big.ods')
+        container.set_part(ODF_CONTENT, container.get_part(ODF_CONTENT))
+        # Flushed every block
+        container.save('trash/big.ods', workers=2, block_size=4096)
+        index = odf_row_index('trash/big.ods', step=16, interval=4096)
+        self.assert_(len(index.checkpoints) > 1)
+        for y in (0, 999, 1999):
+            self.assertEqual(index.get_value((1, y)), u"Row %d" % y)
 
 
 
@@ -105,6 +105,45 @@ class XmlPartTestCase(TestCase):
         self.assertEqual(clone._odf_xmlpart__tree, None)
 
 
+    def test_clone_loaded(self):
+        container = self.container
+        content = odf_xmlpart(ODF_CONTENT, container)
+        paragraph = content.get_element('//text:p')
+        clone = content.clone()
+        paragraph.delete()
+        self.assertNotEqual(clone.serialize(), content.serialize())
+        paragraphs = clone.get_elements('//text:p')
+        self.assertEqual(len(paragraphs),
+                len(content.get_elements('//text:p')) + 1)
+
+
+    def test_modified(self):
+        content = odf_xmlpart(ODF_CONTENT, self.container)
+        paragraph = content.get_element('//text:p')
+        paragraph.get_text()
+        self.assertEqual(content._modified, False)
+        paragraph.set_text(u"Modified")
+        self.assertEqual(content._modified, True)
+
+
+    def test_modified_clone(self):
+        content = odf_xmlpart(ODF_CONTENT, self.container)
+        content.get_root()
+        clone = content.clone()
+        clone.get_element('//text:p').set_attribute('text:style-name', 'A')
+        self.assertEqual(clone._modified, True)
+        self.assertEqual(content._modified, False)
+
+
+    def test_modified_detached(self):
+        content = odf_xmlpart(ODF_CONTENT, self.container)
+        paragraph = content.get_element('//text:p')
+        paragraph.clone().set_text(u"Detached")
+        self.assertEqual(content._modified, False)
+        paragraph.delete()
+        self.assertEqual(content._modified, True)
+
+
     def test_delete(self):
         container = self.container
         content = odf_xmlpart(ODF_CONTENT, container)